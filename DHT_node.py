@@ -1,52 +1,77 @@
 from socket import socket, AF_INET, SOCK_DGRAM
-from threading import Thread
+from threading import Thread, Lock
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from itertools import count
 from hashlib import sha1
-from time import time, sleep
-from random import random, choice
+from time import time, sleep, perf_counter
+from random import random
 
+from routing_table import RoutingTable, DHTNodeInfo, BUCKET_SIZE, ID_BITS, distance
+from lookup import Lookup, RttEstimator, ALPHA
+from peer_store import PeerStore
+from node_state import NodeState, STATE_FLUSH_INTERVAL
+from metrics import metrics
+from workers import share_port
+from wire import (PING, PONG, FIND_NODE, NODES, FIND_PEERS, PEERS, STORE, STORE_BATCH, ID_MASK, RECEIVE_SIZE,
+                  encode_node_message, decode_node_message, encode_contacts, decode_contacts,
+                  encode_peers, decode_peers, decode_key, pack_peer, encode_store_batches, decode_store_batch)
 
-ROUTING_REFRESH_INTERVAL = 1800  # Refreshing routing table
-CLEANUP_REFRESH_INTERVAL = 1800 # Refreshing storage
-ROUTING_TABLE_SIZE = 10 # Number of records in routing tables
 
+ROUTING_REFRESH_INTERVAL = 1800  # Refreshing routing table
+CLEANUP_REFRESH_INTERVAL = 1800 # Stored peers expire unless announced again within this time
+STORE_NODES = 3 # Closest nodes a peer announcement is stored at
+BULK_LOOKUPS = 8 # Lookups a bulk announce keeps running at a time
+REPUBLISH_INTERVAL = 1200 # Own announcements are stored again before they expire
 
-# Info about dht nodes
-class DHTNodeInfo:
-    def __init__(self, ip, port, distance, id):
-        self.ip = ip
-        self.port = port
-        self.last_seen = time()
-        self.distance = distance
-        self.id = id
-    
-    def ping(self):
-        self.last_seen = time()
+# Counter of the messages received of each type
+MESSAGE_METRICS = {PING: "dht.received.ping", PONG: "dht.received.pong", FIND_NODE: "dht.received.find_node",
+                   NODES: "dht.received.nodes", FIND_PEERS: "dht.received.find_peers", PEERS: "dht.received.peers",
+                   STORE: "dht.received.store", STORE_BATCH: "dht.received.store_batch"}
 
 
-# Info about peers
-class PeerInfo:
-    def __init__(self, ip, port):
-        self.ip = ip
-        self.port = port
-        self.last_seen = time()
-    
-    def ping(self):
-        self.last_seen = time()
+# DHT key under which the peers sharing a file name are found. Content is keyed
+# by the root of its manifest instead, so peers seeding the same content under
+# different names form one swarm
+def name_key(file_name):
+    return sha1(file_name.encode()).digest()
 
 
 # DHT node class
 class DHTNode:
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, bind=True, state_path=None, group=None):
         # Node info
         self.ip = ip
         self.port = port
         self.node_id = sha1(str(random()).encode()).digest() # Random 120 bit id
+        # Worker processes serving the same port as one node (see workers.py), None when alone
+        self.group = group
+        if group:
+            self.node_id = group.node_id
+        # On-disk state: a node restarted with the same path keeps its id, contacts and stored peers
+        self.state = NodeState(state_path) if state_path else None
+        loaded = self.state.load() if self.state else None
+        if loaded is not None:
+            self.node_id = loaded[0]
         # Tables
-        self.routing_table = {}  # node_id -> DHTNodeInfo
-        self.storage = {}  # file_hash -> [PeerInfo]
-        # Socket
-        self.socket = socket(AF_INET, SOCK_DGRAM)
-        self.socket.bind((ip, port))
+        self.routing_table = RoutingTable(self.node_id)
+        self.info = DHTNodeInfo(ip, port, 0, self.node_id)
+        self.storage = PeerStore(CLEANUP_REFRESH_INTERVAL)  # file_hash -> peers
+        self.announced = {} # (ip, port) -> keys announced by this node, republished every REPUBLISH_INTERVAL
+        self.announced_lock = Lock()
+        if self.state:
+            self.restore_state(loaded)
+        # Queries waiting for their reply
+        self.pending = {} # transaction id -> (future, send time)
+        self.pending_lock = Lock()
+        self.transaction_ids = count(1)
+        self.rtt = RttEstimator()
+        # Socket (the asyncio runtime binds its own endpoint instead)
+        self.socket = None
+        if bind:
+            self.socket = socket(AF_INET, SOCK_DGRAM)
+            if group:
+                share_port(self.socket)
+            self.socket.bind((ip, port))
         self.running = True
         # Logs
         # print(f"Node {self.node_id.hex()[:8]} running at {ip}:{port}")
@@ -55,192 +80,412 @@ class DHTNode:
     def shutdown(self): 
         self.running = False
         self.socket.close()
+        if self.state:
+            self.state.close()
         exit()
 
+    # Fill the tables with the contacts and the unexpired peers of the loaded state, then
+    # start the log afresh with a snapshot of them and record every later change
+    def restore_state(self, loaded):
+        if loaded is not None:
+            _, contacts, peers = loaded
+            for node_id, ip, port in contacts:
+                self.routing_table.update(node_id, ip, port)
+            for file_hash, ip, port, expires in peers:
+                self.storage.store(file_hash, ip, port, expires=expires)
+        self.state.compact(self.node_id, self.routing_table.nodes, self.storage.all_records)
+        self.routing_table.journal = self.state
+        self.storage.journal = self.state
+
+    # Write the changes of the tables to the state log, compacting it once it grew too long
+    def save_state(self):
+        if self.state.should_compact(len(self.routing_table) + len(self.storage)):
+            self.state.compact(self.node_id, self.routing_table.nodes, self.storage.all_records)
+        else:
+            self.state.flush()
+
+    # Send a datagram to another node
+    def send(self, data, addr):
+        self.socket.sendto(data, addr)
+
+    # Gauges of the tables of this node in the metrics of the process
+    def register_metrics(self):
+        metrics.gauge("dht.contacts", lambda: len(self.routing_table))
+        metrics.gauge("dht.stored_peers", lambda: len(self.storage))
+        metrics.gauge("dht.stored_keys", lambda: len(self.storage.keys))
+        metrics.gauge("dht.pending_queries", lambda: len(self.pending))
+        metrics.gauge("dht.query_timeout", lambda: self.rtt.timeout)
+
     # Kademlia XOR distance measure
     def distance(self, id1, id2):
-        return int.from_bytes(bytes(a ^ b for a, b in zip(id1, id2)), 'big')
+        return distance(id1, id2)
 
-    # Add node to routing table
+    # Add node to routing table. If its bucket is full, the least recently seen
+    # node of the bucket is pinged and only replaced if it does not answer
     def update_routing_table(self, node_id, ip, port):
-        # Check if node is itself
-        if node_id == self.node_id:
-            return
-        # Check if node already exists
-        if node_id in self.routing_table:
-            self.routing_table[node_id].ping()
-            return
-        # Add new node if table is not full
-        new_node = DHTNodeInfo(ip, port, self.distance(self.node_id, node_id), node_id)
-        if len(self.routing_table) < ROUTING_TABLE_SIZE:
-            self.routing_table[node_id] = new_node
-        else:
-            # Replace the oldest node
-            last_time = time()
-            last_node = None
-            for node in self.routing_table.keys():
-                if last_time > self.routing_table[node].last_seen:
-                    last_time = self.routing_table[node].last_seen
-                    last_node = node
-            self.routing_table.pop(last_node)
-            self.routing_table[node_id] = new_node
+        oldest = self.routing_table.update(node_id, ip, int(port))
+        if oldest is not None:
+            self.send(encode_node_message(PING, 0, self.node_id), (oldest.ip, oldest.port))
     
-    # Connect to the dht net using bootstrap node
+    # Connect to the dht net: ask the bootstrap nodes for the nodes closest to our id, then look it up.
+    # A node restarted with its contacts looks itself up through them and only asks the
+    # bootstrap nodes if none of them answers
     def bootstrap(self, bootstrap_nodes):
-        for node in bootstrap_nodes:
-            self.find_node(self.node_id, node)
+        if len(self.routing_table) > 0 and self.lookup(self.node_id).responded:
+            return
+        queries = [self.rpc(FIND_NODE, self.node_id, node) for node in bootstrap_nodes]
+        wait([future for future, _ in queries], self.rtt.timeout)
+        for _, transaction_id in queries:
+            self.cancel(transaction_id)
+        self.lookup(self.node_id)
+
+    # Future of the reply to a query, the asyncio runtime creates event loop futures instead
+    def create_future(self):
+        return Future()
+
+    # Send a query (FIND_NODE or FIND_PEERS) that expects a reply. Returns (future, transaction id),
+    # the future resolves to the (node id, address) pairs and the (ip, port) peers of the reply
+    def rpc(self, msg_type, target_id, addr):
+        transaction_id = self.new_transaction_id()
+        future = self.create_future()
+        with self.pending_lock:
+            self.pending[transaction_id] = (future, time())
+        self.send(encode_node_message(msg_type, transaction_id, self.node_id, target_id), addr)
+        metrics.count("dht.queries")
+        return future, transaction_id
+
+    # Id of a new query, in a worker group it names this worker
+    def new_transaction_id(self):
+        number = next(self.transaction_ids)
+        return self.group.transaction_id(number) if self.group else number & ID_MASK
+
+    # Forget a query whose reply is no longer awaited
+    def cancel(self, transaction_id):
+        with self.pending_lock:
+            query = self.pending.pop(transaction_id, None)
+        if query is not None:
+            query[0].cancel()
+
+    # Complete the query a reply belongs to and sample the RTT
+    def resolve(self, transaction_id, nodes, peers):
+        with self.pending_lock:
+            query = self.pending.pop(transaction_id, None)
+        if query is None:
+            return
+        future, send_time = query
+        self.rtt.sample(time() - send_time)
+        metrics.observe("dht.query_rtt", time() - send_time)
+        if not future.done():
+            future.set_result((nodes, peers))
 
     # Start listening for queries and refreshing referencing table
     def start(self):
-        Thread(target=self.refresh).start()
-        Thread(target=self.listen).start()
+        Thread(target=self.refresh, daemon=True).start()
+        Thread(target=self.listen, daemon=True).start()
+        Thread(target=self.republish, daemon=True).start()
+        if self.state:
+            Thread(target=self.persist, daemon=True).start()
+        if self.group:
+            Thread(target=self.listen_group, daemon=True).start()
     
     # Periodically refresh routing table
     def refresh(self):
         while self.running:
             sleep(ROUTING_REFRESH_INTERVAL)
-            # Refresh a random node
-            rnd_node = self.routing_table[choice(self.routing_table.keys())]
-            self.find_node(rnd_node.id, (rnd_node.ip, rnd_node.port))
-    
-    # Delete old peers from storage
-    def cleanup_storage(self):
-        now = time()
-        for file_hash in self.storage.keys():
-            self.storage[file_hash] = [p for p in self.storage[file_hash] if now - p.last_seen < CLEANUP_REFRESH_INTERVAL]
-            if len(self.storage[file_hash]) == 0:
-                self.storage.pop(file_hash)
+            self.refresh_random_node()
+
+    # Periodically store the own announcements again, so they never expire
+    def republish(self):
+        while self.running:
+            sleep(REPUBLISH_INTERVAL)
+            for (ip, port), keys in self.announcements():
+                self.bulk_announce(keys, ip, port, remember=False)
+
+    # Record announcements to republish
+    def remember(self, keys, ip, port):
+        with self.announced_lock:
+            self.announced.setdefault((ip, port), {}).update(dict.fromkeys(keys))
+
+    # Stop republishing announcements
+    def forget(self, keys, ip, port):
+        with self.announced_lock:
+            announced = self.announced.get((ip, port), {})
+            for key in keys:
+                announced.pop(key, None)
+
+    # ((ip, port), keys) of the own announcements
+    def announcements(self):
+        with self.announced_lock:
+            return [(addr, list(keys)) for addr, keys in self.announced.items()]
+
+    # Periodically write the state log
+    def persist(self):
+        while self.running:
+            sleep(STATE_FLUSH_INTERVAL)
+            self.save_state()
 
+    # Look up a random id in every bucket that was not used during the last refresh interval
+    def refresh_random_node(self):
+        for target_id in self.routing_table.refresh_targets(ROUTING_REFRESH_INTERVAL):
+            for node in self.routing_table.closest(target_id, ALPHA):
+                self.find_node(target_id, (node.ip, node.port))
+    
     # Listen for messages
     def listen(self):
         while self.running:
             try:
-                data, addr = self.socket.recvfrom(1024)
+                data, addr = self.socket.recvfrom(RECEIVE_SIZE)
+                if not self.running:
+                    break
                 self.handle_message(data, addr)
             except Exception as e:
                 if self.running:
                     # Logs
                     print(f"Error in listener: {e}")
 
-    # Handle incomming message
-    def handle_message(self, data, addr):
+    # Listen for the messages passed on by the other workers of the group
+    def listen_group(self):
+        while self.running:
+            try:
+                data, addr = self.group.receive()
+                self.handle_message(data, addr, relayed=True)
+            except Exception as e:
+                if self.running:
+                    print(f"Error in group listener: {e}")
+
+    # In a worker group, a reply to another worker's query is passed on to it, and stored
+    # peers to every other worker. True if the message is not for this worker
+    def relay(self, msg_type, transaction_id, data, addr):
+        if msg_type in (PONG, NODES, PEERS):
+            owner = self.group.owner(transaction_id)
+            # Id 0 is for messages that expect no reply
+            if transaction_id and owner != self.group.index:
+                self.group.forward(data, addr, owner)
+                return True
+        elif msg_type in (STORE, STORE_BATCH):
+            self.group.broadcast(data, addr)
+        return False
+
+    # Handle incomming message. Every message carries the id of its sender, which is
+    # recorded in the routing table. `relayed` messages were passed on by another worker
+    def handle_message(self, data, addr, relayed=False):
+        start = perf_counter()
         try:
-            msg = data.decode().split('|')
-            if msg[0] == "PING":
-                self.socket.sendto(b"PONG", addr)
-            elif msg[0] == "FIND_NODE":
-                target_id = bytes.fromhex(msg[1])
-                sender_id = bytes.fromhex(msg[2])
-                self.update_routing_table(sender_id, addr[0], addr[1])
-                closest = self.find_closest_nodes(target_id, 3) # 3 - num of closest nodes
-                response = "NODES|" + "|".join([f"{nid.hex()}:{ip}:{port}" for nid, (ip, port) in closest])
-                self.socket.sendto(response.encode(), addr)
-            elif msg[0] == "NODES":
-                for node_info in msg[1:]:
-                    nid_hex, ip, port = node_info.split(':')
-                    nid = bytes.fromhex(nid_hex)
+            msg_type, transaction_id, sender_id, body = decode_node_message(data)
+            if self.group and not relayed and self.relay(msg_type, transaction_id, data, addr):
+                metrics.count("dht.relayed")
+                return
+            metrics.count(MESSAGE_METRICS.get(msg_type, "dht.received.other"))
+            self.update_routing_table(sender_id, addr[0], addr[1])
+            if msg_type == PING:
+                self.send(encode_node_message(PONG, transaction_id, self.node_id), addr)
+            elif msg_type == PONG:
+                self.resolve(transaction_id, [], [])
+            elif msg_type == FIND_NODE:
+                target_id = decode_key(body)
+                self.send(self.nodes_reply(transaction_id, target_id), addr)
+            elif msg_type == NODES:
+                nodes = decode_contacts(body)
+                for nid, (ip, port) in nodes:
                     self.update_routing_table(nid, ip, port)
-            elif msg[0] == "STORE":
-                file_hash = bytes.fromhex(msg[1])
-                peer_ip, peer_port = msg[2].split(':')
-                self.store_peer(file_hash, peer_ip, peer_port)
-            elif msg[0] == "FIND_PEERS":
-                file_hash = bytes.fromhex(msg[1])
-                sender_id = bytes.fromhex(msg[2])
-                self.update_routing_table(sender_id, addr[0], addr[1])
+                self.resolve(transaction_id, nodes, [])
+            elif msg_type == STORE:
+                file_hash, peers = decode_peers(body)
+                for peer_ip, peer_port in peers:
+                    self.store_peer(file_hash, peer_ip, peer_port)
+            elif msg_type == STORE_BATCH:
+                keys, peers = decode_store_batch(body)
+                for file_hash in keys:
+                    for peer_ip, peer_port in peers:
+                        self.store_peer(file_hash, peer_ip, peer_port)
+            elif msg_type == FIND_PEERS:
+                file_hash = decode_key(body)
                 peers = self.get_peers(file_hash)
                 if len(peers) > 0:
-                    response = "PEERS|" + file_hash.hex() + "|" + "|".join([f"{p.ip}:{p.port}" for p in peers])
+                    response = encode_peers(file_hash, [p.entry for p in peers])
+                    self.send(encode_node_message(PEERS, transaction_id, self.node_id, response), addr)
                 else:
-                    closest = self.find_closest_nodes(file_hash, 3)  # 3 - num of closest nodes
-                    response = "NODES|" + "|".join([f"{nid.hex()}:{ip}:{port}" for nid, (ip, port) in closest])
-                self.socket.sendto(response.encode(), addr)
-            elif msg[0] == "PEERS":
-                file_hash = bytes.fromhex(msg[1])
-                for p in msg[2:]:
-                    peer_ip, peer_port = p.split(':')
-                    self.store_peer(file_hash, peer_ip, peer_port)
+                    self.send(self.nodes_reply(transaction_id, file_hash), addr)
+            elif msg_type == PEERS:
+                _, peers = decode_peers(body)
+                self.resolve(transaction_id, [], peers)
         except Exception as e:
+            metrics.count("dht.message_errors")
             # Logs
             print(f"Error handling message from {addr}: {e}")
+        metrics.observe("dht.handle_message", perf_counter() - start)
+
+    # Reply to a query with the closest nodes to its target, this node included
+    def nodes_reply(self, transaction_id, target_id):
+        closest = self.routing_table.closest(target_id, BUCKET_SIZE) + [self.info]
+        closest.sort(key=lambda node: distance(node.id, target_id))
+        contacts = [node.contact for node in closest[:BUCKET_SIZE]]
+        return encode_node_message(NODES, transaction_id, self.node_id, encode_contacts(contacts))
 
-    # Find nodes closest to a specific node
+    # Find nodes closest to a specific node, only the buckets near the target are searched
     def find_closest_nodes(self, target_id, count):
-        # Collect all nodes
-        all_nodes = []
-        for n in self.routing_table.keys():
-            node = self.routing_table[n]
-            all_nodes.append((node.id, (node.ip, int(node.port))))
-        
+        start = perf_counter()
+        all_nodes = [(node.id, (node.ip, node.port)) for node in self.routing_table.closest(target_id, count)]
+
         # Include self in candidates
         all_nodes.append((self.node_id, (self.ip, self.port)))
-        
+
         # Sort by distance to target
-        all_nodes.sort(key=lambda x: self.distance(x[0], target_id))
+        all_nodes.sort(key=lambda x: distance(x[0], target_id))
+        metrics.observe("dht.find_closest_nodes", perf_counter() - start)
         return all_nodes[:count]
 
     # Query a node to find closest nodes to target
     def find_node(self, target_id, addr):
-        self.socket.sendto(f"FIND_NODE|{target_id.hex()}|{self.node_id.hex()}".encode(), addr)
+        self.send(encode_node_message(FIND_NODE, 0, self.node_id, target_id), addr)
 
-    # Update or add peer info:
+    # Update or add peer info, expired peers are dropped on the way
     def store_peer(self, file_hash, ip, port):
-        if file_hash in self.storage:
-            for p in self.storage[file_hash]:
-                if p.ip == ip and p.port == port:
-                    p.ping()
-                    return
-        else:
-            self.storage[file_hash] = []
-        self.storage[file_hash].append(PeerInfo(ip, port))
+        self.storage.store(file_hash, ip, int(port))
 
     # Get peers for a specific file
     def get_peers(self, file_hash):
-        self.cleanup_storage()
-        if file_hash in self.storage:
-            return self.storage[file_hash]
-        else:
-            return []
+        return self.storage.get(file_hash)
     
-    # DHT Lookup
-    def find_peers(self, file_name):
-        file_hash = sha1(file_name.encode()).digest()
-        contacted = set()
-        while True:
-            new_messages = 0
-            closest_nodes = self.find_closest_nodes(file_hash, 3)
-            for node_id, addr in closest_nodes:
-                if addr not in contacted:
-                    self.socket.sendto(f"FIND_PEERS|{file_hash.hex()}|{self.node_id.hex()}".encode(), addr)
-                    contacted.add(addr)
-                    new_messages += 1
-            if new_messages == 0:
-                break
-            sleep(2)
-        
-        peers = []
-        if file_hash in self.storage: 
-            for p in self.storage[file_hash]:
-                peers.append((p.ip, p.port))
-        return peers
-
-    # Announce a new peer for a file
-    def announce_peer(self, file_name, ip, port):
-        file_hash = sha1(file_name.encode()).digest()
-        # Find closest nodes
+    # Peers for a file collected in storage
+    def known_peers(self, file_hash):
+        return self.storage.addresses(file_hash)
+
+    # New lookup of the nodes closest to a key, or of the peers stored under it (own storage included)
+    def start_lookup(self, target_id, find_peers):
+        lookup = Lookup(target_id, self.node_id, self.find_closest_nodes(target_id, BUCKET_SIZE), find_peers)
+        lookup.started = perf_counter()
+        if find_peers:
+            lookup.add_peers(self.known_peers(target_id))
+        return lookup
+
+    # Fold the replies and timeouts of a lookup's queries into it and send its next queries.
+    # `queries` maps futures to (node id, transaction id, send time).
+    # Returns the seconds until the earliest query times out, None if none is in flight
+    def lookup_step(self, lookup, queries, target_id):
+        now = time()
+        for future, (node_id, transaction_id, send_time) in list(queries.items()):
+            if future.done():
+                del queries[future]
+                nodes, peers = future.result()
+                lookup.on_response(node_id, nodes, peers)
+            elif now - send_time >= self.rtt.timeout:
+                del queries[future]
+                self.cancel(transaction_id)
+                self.routing_table.fail(node_id)
+                lookup.on_timeout(node_id)
+                metrics.count("dht.query_timeouts")
+
+        msg_type = FIND_PEERS if lookup.find_peers else FIND_NODE
+        for node_id, addr in lookup.next_queries():
+            future, transaction_id = self.rpc(msg_type, target_id, addr)
+            queries[future] = (node_id, transaction_id, now)
+        if not queries:
+            return None
+        return max(0.0, min(send_time for _, _, send_time in queries.values()) + self.rtt.timeout - now)
+
+    # Cancel the queries of a finished lookup that are still in flight, record how long it took
+    def finish_lookup(self, lookup, queries):
+        for _, transaction_id, _ in queries.values():
+            self.cancel(transaction_id)
+        if lookup.find_peers:
+            metrics.observe("dht.find_peers", perf_counter() - lookup.started)
+            metrics.count("dht.find_peers_found" if lookup.peers else "dht.find_peers_empty")
+        else:
+            metrics.observe("dht.lookup", perf_counter() - lookup.started)
+
+    # Iterative lookup: ALPHA queries in flight, each new reply immediately lets the
+    # next closest node be queried, until the lookup is done
+    def lookup(self, target_id, find_peers=False):
+        lookup = self.start_lookup(target_id, find_peers)
+        queries = {}
         while True:
-            new_messages = 0
-            closest_nodes = self.find_closest_nodes(file_hash, 3)
-            for node_id, addr in closest_nodes:
-                if node_id not in self.routing_table and node_id != self.node_id:
-                    self.find_node(file_hash, addr)
-                    new_messages += 1
-            if new_messages == 0:
+            timeout = self.lookup_step(lookup, queries, target_id)
+            if lookup.done() or timeout is None:
                 break
-            sleep(2)
-        # Send store message
-        for node in self.find_closest_nodes(file_hash, 3):
-            self.socket.sendto(f"STORE|{file_hash.hex()}|{ip}:{port}".encode(), node[1])
+            wait(queries, timeout, return_when=FIRST_COMPLETED)
+        self.finish_lookup(lookup, queries)
+        return lookup
+
+    # DHT Lookup of the peers stored under a 20 byte key, returns once some are found
+    def find_peers(self, file_hash):
+        return self.lookup(file_hash, find_peers=True).peers
+
+    # Send store message to the closest nodes that answered the lookup, this node included if it is one of them
+    def store_at_closest(self, file_hash, ip, port, lookup):
+        nodes = lookup.result(STORE_NODES) + [(self.node_id, (self.ip, self.port))]
+        nodes.sort(key=lambda x: distance(x[0], file_hash))
+        for node_id, addr in nodes[:STORE_NODES]:
+            self.send(encode_node_message(STORE, 0, self.node_id, encode_peers(file_hash, [pack_peer(ip, port)])), addr)
+
+    # Announce a new peer under a 20 byte key
+    def announce_peer(self, file_hash, ip, port):
+        self.remember([file_hash], ip, port)
+        self.store_at_closest(file_hash, ip, port, self.lookup(file_hash))
+
+    # Run the lookups of many targets, BULK_LOOKUPS at a time, each one driven as in `lookup`.
+    # Returns target -> finished Lookup
+    def lookup_many(self, targets, find_peers=False):
+        waiting = list(targets)
+        running = {} # target -> (Lookup, queries)
+        finished = {}
+        while waiting or running:
+            while waiting and len(running) < BULK_LOOKUPS:
+                target_id = waiting.pop()
+                running[target_id] = (self.start_lookup(target_id, find_peers), {})
+            timeouts = self.lookup_many_step(running, finished)
+            # Lookups that finished make room for waiting ones right away
+            if running and (len(running) >= BULK_LOOKUPS or not waiting):
+                wait([future for _, queries in running.values() for future in queries], min(timeouts), return_when=FIRST_COMPLETED)
+        return finished
+
+    # Step every running lookup, the finished ones move to `finished`. Returns the timeouts of the others
+    def lookup_many_step(self, running, finished):
+        timeouts = []
+        for target_id, (lookup, queries) in list(running.items()):
+            timeout = self.lookup_step(lookup, queries, target_id)
+            if lookup.done() or timeout is None:
+                self.finish_lookup(lookup, queries)
+                finished[target_id] = lookup
+                del running[target_id]
+            else:
+                timeouts.append(timeout)
+        return timeouts
+
+    # Keys grouped by region of the key space, keyed by the middle of the region. Regions
+    # are about as wide as the gaps between nodes (the table holds nodes in about log2(N)
+    # buckets), so the nodes closest to the middle of a region are closest to all its keys
+    def regions(self, keys):
+        bits = min(ID_BITS - 1, self.routing_table.depth())
+        regions = {}
+        for key in keys:
+            prefix = int.from_bytes(key, 'big') >> (ID_BITS - bits)
+            middle = (prefix << 1 | 1) << (ID_BITS - bits - 1)
+            regions.setdefault(middle.to_bytes(ID_BITS // 8, 'big'), []).append(key)
+        return regions
+
+    # Send every key of the regions to its STORE_NODES closest nodes among those that answered
+    # the lookup of the region (this node included), the keys bound for a node packed together
+    def store_regions(self, regions, lookups, ip, port):
+        keys_by_node = {} # address -> keys
+        for target_id, keys in regions.items():
+            nodes = lookups[target_id].result(BUCKET_SIZE) + [(self.node_id, (self.ip, self.port))]
+            for key in keys:
+                nodes.sort(key=lambda node: distance(node[0], key))
+                for _, addr in nodes[:STORE_NODES]:
+                    keys_by_node.setdefault(addr, []).append(key)
+        peers = [pack_peer(ip, port)]
+        for addr, keys in keys_by_node.items():
+            for body in encode_store_batches(keys, peers):
+                self.send(encode_node_message(STORE_BATCH, 0, self.node_id, body), addr)
+
+    # Announce a peer under many keys: the keys of a region share one lookup, BULK_LOOKUPS
+    # lookups run at a time and the keys sent to the same node share STORE_BATCH datagrams
+    def bulk_announce(self, keys, ip, port, remember=True):
+        if remember:
+            self.remember(keys, ip, port)
+        regions = self.regions(keys)
+        self.store_regions(regions, self.lookup_many(regions), ip, port)
 
 
 # --- Example Usage ---
@@ -275,14 +520,14 @@ if __name__ == "__main__":
     sleep(2)
     
     # Announcing peers
-    node1.announce_peer("file_name", "127.0.0.1", "1")
-    node4.announce_peer("file_name", "127.0.0.1", "2")
+    node1.announce_peer(name_key("file_name"), "127.0.0.1", 1)
+    node4.announce_peer(name_key("file_name"), "127.0.0.1", 2)
 
     sleep(2)
     
     # Find peers for file
     print("\nNode finds file 'file_name'")
-    print(node4.find_peers("file_name"))
+    print(node4.find_peers(name_key("file_name")))
 
     # Clean up
     bootstrap1.shutdown()
@@ -0,0 +1,590 @@
+import asyncio
+import socket
+from itertools import count
+from time import time, perf_counter
+
+import DHT_node
+from peer import Peer, IP, MSS, SCAN_INTERVAL, DATAGRAM_SIZE, REQUEST_TIMEOUT, SIZE_ATTEMPTS, MANIFEST_ATTEMPTS, MANIFEST_TIMEOUT, bind_socket, fragment_writer, target_store, buffer_store
+from event_log import events, ERROR
+from metrics import metrics
+from dispatcher import send_response, RESPONSE_TYPES
+from transfer import SwarmScheduler
+from manifest import CorruptChunk, MANIFEST_SUFFIX, is_content_root
+from chunks import ChunkAssembler, max_window
+from download_manager import DownloadQueue, DEFAULT_PRIORITY, MAX_ACTIVE_DOWNLOADS
+from upload_scheduler import UploadScheduler, RECEIVE_BATCH, UPLOAD_BATCH
+from wire import SIZE, GET, FIND_NODE, ID_MASK, parse_message, encode_message, encode_get, decode_size_reply
+
+
+# Datagram endpoint of a peer: the asyncio counterpart of Dispatcher.
+# Responses complete the future waiting for their request id (or are consumed
+# in place by its sink), requests are answered by the handler, through the
+# UploadScheduler `uploads` if there is one
+class PeerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, handler=None, sock=None, uploads=None):
+        self.handler = handler # (type, request id, body, addr) -> response (bytes or datagrams) or None
+        self.socket = sock # raw socket for scatter-gather sends
+        self.uploads = uploads
+        self.serving = None # handle of the next run of serve_uploads
+        self.transport = None
+        self.pending = {} # request id -> asyncio.Future
+        self.ids = count(1)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        if self.serving:
+            self.serving.cancel()
+
+    # Send a request, the returned future resolves to (body, addr) of the response,
+    # or to (sink(body view, addr), addr) once the sink returns something else than None
+    def request(self, msg_type: int, body: bytes, addr, sink=None):
+        request_id = next(self.ids) & ID_MASK
+        future = asyncio.get_running_loop().create_future()
+        future.request_id = request_id
+        future.sink = sink
+        self.pending[request_id] = future
+        self.transport.sendto(encode_message(msg_type, request_id, body), addr)
+        return future
+
+    # Forget a request whose response is no longer awaited
+    def cancel(self, future):
+        self.pending.pop(future.request_id, None)
+        future.cancel()
+
+    def datagram_received(self, data, addr):
+        self.route(data, addr)
+        if self.uploads is not None and self.uploads.queued and self.serving is None:
+            # Everything already received is queued before the requests are served
+            self.drain()
+            self.serving = asyncio.get_running_loop().call_soon(self.serve_uploads)
+
+    # Takes in the datagrams waiting on the socket
+    def drain(self):
+        for _ in range(RECEIVE_BATCH):
+            try:
+                data, addr = self.socket.recvfrom(DATAGRAM_SIZE, socket.MSG_DONTWAIT)
+            except OSError:
+                return
+            self.route(data, addr)
+
+    def route(self, data, addr):
+        message = parse_message(data)
+        if message is None:
+            return
+        msg_type, request_id, body = message
+
+        if msg_type in RESPONSE_TYPES:
+            future = self.pending.get(request_id)
+            if future is None or future.done():
+                return
+            try:
+                result = future.sink(body, addr) if future.sink else bytes(body)
+                if result is None:
+                    return # more datagrams of the response to come
+                future.set_result((result, addr))
+            except Exception as e:
+                future.set_exception(e)
+            del self.pending[request_id]
+            return
+
+        if self.handler is None:
+            return
+        if self.uploads is not None:
+            self.uploads.push(msg_type, request_id, bytes(body), addr)
+            return
+        self.serve_request(msg_type, request_id, bytes(body), addr)
+
+    def serve_request(self, msg_type, request_id, body, addr):
+        start = perf_counter()
+        try:
+            response = self.handler(msg_type, request_id, body, addr)
+            if response is not None:
+                self.send(response, addr)
+        except Exception as e:
+            metrics.count("peer.serve_errors")
+            print(f"Error serving message type {msg_type} from {addr}: {e}")
+        metrics.observe("peer.serve_request", perf_counter() - start)
+
+    # Serves the queued requests the upload scheduler releases, then runs again when the
+    # rates allow more. A batch at a time so that receiving is not held up
+    def serve_uploads(self):
+        self.serving = None
+        if self.transport is None or self.transport.is_closing():
+            return
+        for _ in range(UPLOAD_BATCH):
+            request, delay = self.uploads.next(time())
+            if request is None:
+                if self.uploads.queued:
+                    self.serving = asyncio.get_running_loop().call_later(delay, self.serve_uploads)
+                return
+            self.serve_request(*request)
+        self.drain()
+        self.serving = asyncio.get_running_loop().call_soon(self.serve_uploads)
+
+    # Scatter-gather straight on the socket while the transport has nothing queued,
+    # otherwise the buffers are joined and queued by the transport
+    def send(self, response, addr):
+        if isinstance(response, (bytes, bytearray)):
+            self.transport.sendto(response, addr)
+            return
+        for datagram in response:
+            if not isinstance(datagram, (bytes, bytearray)):
+                if self.socket is not None and self.transport.get_write_buffer_size() == 0:
+                    try:
+                        send_response(self.socket, [datagram], addr)
+                        continue
+                    except BlockingIOError:
+                        pass
+                datagram = b"".join(datagram)
+            self.transport.sendto(datagram, addr)
+
+    # ICMP errors (e.g. port unreachable of a dead peer) surface as timeouts instead
+    def error_received(self, exc):
+        pass
+
+
+# Opens a peer endpoint on an already bound socket
+async def open_endpoint(sock, handler=None, uploads=None):
+    loop = asyncio.get_running_loop()
+    _, protocol = await loop.create_datagram_endpoint(lambda: PeerProtocol(handler, sock, uploads), sock=sock)
+    return protocol
+
+
+# Pipelined multi-source download over a PeerProtocol. The missing ranges of every
+# chunk are requested and the fragments are reassembled in place by `assembler`,
+# which stores complete chunks (a corrupt chunk is requested from another peer).
+# `on_packet(chunk number, addr)` is called for every new chunk, chunks in
+# `completed` are already stored and not requested. With a `scheduler` (DownloadScheduler)
+# the requests share its limits with the other transfers, with `priority`. Raises
+# TimeoutError if the transfer is not done by `deadline`
+async def fetch(protocol, peers, filename, assembler, on_packet=None, completed=(), deadline=None,
+                scheduler=None, priority=DEFAULT_PRIORITY):
+    transfer = SwarmScheduler(assembler.chunks, peers, time(), completed, max_window(assembler.chunk_size))
+    sink = fragment_writer(assembler)
+    responses = asyncio.Queue()
+    outstanding = set()
+    slot = scheduler.register(priority) if scheduler else None
+
+    try:
+        while not transfer.done():
+            if deadline is not None and time() > deadline:
+                raise TimeoutError(f"Transfer of {filename} timed out")
+            if slot:
+                requests, held_back = scheduler.take(slot, transfer, assembler.chunk_length(0), time())
+            else:
+                requests, held_back = transfer.take(time()), False
+            for pkt_num, peer_addr in requests:
+                request = encode_get(assembler.missing(pkt_num), filename)
+                future = protocol.request(GET, request, peer_addr, sink)
+                outstanding.add(future)
+                future.add_done_callback(responses.put_nowait)
+
+            future = None
+            if not responses.empty():
+                future = responses.get_nowait()
+            else:
+                timeout = transfer.next_timeout(time())
+                if held_back:
+                    timeout = min(timeout, scheduler.retry_delay(time()))
+                try:
+                    future = await asyncio.wait_for(responses.get(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            if future is not None and not future.cancelled():
+                outstanding.discard(future)
+                try:
+                    packet_number, addr = future.result()
+                except CorruptChunk as e:
+                    packet_number = -1
+                    transfer.on_corrupt(e.number, e.addr, time())
+                    metrics.count("peer.corrupt_chunks")
+                except ValueError:
+                    packet_number = -1
+                if packet_number >= 0 and transfer.on_packet(packet_number, addr, time()):
+                    metrics.count("peer.chunks_received")
+                    metrics.count("peer.bytes_received", assembler.chunk_length(packet_number))
+                    if on_packet:
+                        on_packet(packet_number, addr)
+
+            transfer.expire(time())
+    finally:
+        metrics.count("peer.retransmits", sum(transfer.retries.values()))
+        if slot:
+            scheduler.unregister(slot)
+        # Late responses of retransmitted packets are no longer awaited
+        for future in outstanding:
+            protocol.cancel(future)
+    return transfer
+
+
+# Datagram endpoint of a DHT node, hands every message to the node
+class DHTProtocol(asyncio.DatagramProtocol):
+    def __init__(self, node):
+        self.node = node
+
+    def connection_made(self, transport):
+        self.node.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.node.handle_message(data, addr)
+
+    def error_received(self, exc):
+        pass
+
+
+# DHT node served by the event loop instead of a listener thread
+class AsyncDHTNode(DHT_node.DHTNode):
+    def __init__(self, ip, port, state_path=None):
+        super().__init__(ip, port, bind=False, state_path=state_path)
+        self.transport = None
+        self.refresh_task = None
+        self.republish_task = None
+        self.persist_task = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: DHTProtocol(self), local_addr=(self.ip, self.port))
+        self.refresh_task = asyncio.create_task(self.refresh())
+        self.republish_task = asyncio.create_task(self.republish())
+        if self.state:
+            self.persist_task = asyncio.create_task(self.persist())
+
+    def send(self, data, addr):
+        self.transport.sendto(data, addr)
+
+    def shutdown(self):
+        self.running = False
+        if self.refresh_task:
+            self.refresh_task.cancel()
+        if self.republish_task:
+            self.republish_task.cancel()
+        if self.persist_task:
+            self.persist_task.cancel()
+        if self.transport:
+            self.transport.close()
+        if self.state:
+            self.state.close()
+
+    # Periodically refresh routing table
+    async def refresh(self):
+        while self.running:
+            await asyncio.sleep(DHT_node.ROUTING_REFRESH_INTERVAL)
+            self.refresh_random_node()
+
+    # Periodically store the own announcements again, so they never expire
+    async def republish(self):
+        while self.running:
+            await asyncio.sleep(DHT_node.REPUBLISH_INTERVAL)
+            for (ip, port), keys in self.announcements():
+                await self.bulk_announce(keys, ip, port, remember=False)
+
+    # Periodically write the state log, off the event loop
+    async def persist(self):
+        while self.running:
+            await asyncio.sleep(DHT_node.STATE_FLUSH_INTERVAL)
+            await asyncio.to_thread(self.save_state)
+
+    def create_future(self):
+        return asyncio.get_running_loop().create_future()
+
+    # Connect to the dht net, see DHTNode.bootstrap
+    async def bootstrap(self, bootstrap_nodes):
+        if len(self.routing_table) > 0 and (await self.lookup(self.node_id)).responded:
+            return
+        queries = [self.rpc(FIND_NODE, self.node_id, node) for node in bootstrap_nodes]
+        if queries:
+            await asyncio.wait([future for future, _ in queries], timeout=self.rtt.timeout)
+        for _, transaction_id in queries:
+            self.cancel(transaction_id)
+        await self.lookup(self.node_id)
+
+    # Iterative lookup with ALPHA queries in flight, see DHTNode.lookup
+    async def lookup(self, target_id, find_peers=False):
+        lookup = self.start_lookup(target_id, find_peers)
+        queries = {}
+        while True:
+            timeout = self.lookup_step(lookup, queries, target_id)
+            if lookup.done() or timeout is None:
+                break
+            await asyncio.wait(queries, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        self.finish_lookup(lookup, queries)
+        return lookup
+
+    # DHT Lookup of the peers stored under a 20 byte key, returns once some are found
+    async def find_peers(self, file_hash):
+        return (await self.lookup(file_hash, find_peers=True)).peers
+
+    # Announce a new peer under a 20 byte key
+    async def announce_peer(self, file_hash, ip, port):
+        self.remember([file_hash], ip, port)
+        self.store_at_closest(file_hash, ip, port, await self.lookup(file_hash))
+
+    # Lookups of many targets, BULK_LOOKUPS at a time, see DHTNode.lookup_many
+    async def lookup_many(self, targets, find_peers=False):
+        waiting = list(targets)
+        running = {}
+        finished = {}
+        while waiting or running:
+            while waiting and len(running) < DHT_node.BULK_LOOKUPS:
+                target_id = waiting.pop()
+                running[target_id] = (self.start_lookup(target_id, find_peers), {})
+            timeouts = self.lookup_many_step(running, finished)
+            if running and (len(running) >= DHT_node.BULK_LOOKUPS or not waiting):
+                await asyncio.wait([future for _, queries in running.values() for future in queries],
+                                   timeout=min(timeouts), return_when=asyncio.FIRST_COMPLETED)
+        return finished
+
+    # Announce a peer under many keys, see DHTNode.bulk_announce
+    async def bulk_announce(self, keys, ip, port, remember=True):
+        if remember:
+            self.remember(keys, ip, port)
+        regions = self.regions(keys)
+        self.store_regions(regions, await self.lookup_many(regions), ip, port)
+
+
+# Peer running on the event loop: serving and downloading share one endpoint
+# and thousands of requests can be in flight without a thread per packet
+class AsyncPeer(Peer):
+    def __init__(self, port: int, dht_port: int, dht_state: str = None, uploads: UploadScheduler = None):
+        self.init_state(port, uploads)
+        self.socket = bind_socket(port)
+        self.socket.setblocking(False)
+        self.protocol = None
+        self.node = AsyncDHTNode(IP, dht_port, dht_state)
+        self.closed = None
+        self.announcer = None
+        self.watcher = None
+        self.loads = set() # lookups running for the lookup cache
+
+    # Open the endpoints, bootstrap the DHT and announce local files
+    async def start(self):
+        self.closed = asyncio.get_running_loop().create_future()
+        self.protocol = await open_endpoint(self.socket, self.handle_request, self.uploads)
+        await self.node.start()
+        await self.node.bootstrap(self.get_dht())
+
+        events.log(self.log_source, "Connected")
+        events.log(self.log_source, f"Created node {self.node.ip}:{self.node.port}")
+
+        self.announcer = asyncio.create_task(self.announce_share())
+        self.watcher = asyncio.create_task(self.watch_share())
+
+    # Announces a shared file under its content root and its name
+    async def announce_file(self, file_name: str):
+        for key in self.file_keys(file_name):
+            await self.node.announce_peer(key, IP, self.port)
+        self.share_index.announced([file_name])
+
+    # Announces many shared files at once in the background, the manifests are computed off the event loop
+    async def announce_files(self, files: list):
+        keys = []
+        for file_name in files:
+            keys += await asyncio.to_thread(self.file_keys, file_name)
+        if keys:
+            await self.node.bulk_announce(keys, IP, self.port)
+            self.share_index.announced(files)
+
+    # Announces the shared files at startup, the storage is scanned and hashed off the event loop
+    async def announce_share(self):
+        await self.announce_files(await asyncio.to_thread(self.startup_announcements))
+
+    # Announces the files added to the storage or changed, every SCAN_INTERVAL
+    async def watch_share(self):
+        await self.announcer
+        while True:
+            await asyncio.sleep(SCAN_INTERVAL)
+            await self.announce_files(await asyncio.to_thread(self.share_changes))
+
+    # Queries other peers for the size of a file in packets
+    async def get_file_size(self, peers: list, filename: str, attempts: int = SIZE_ATTEMPTS):
+        return self.parse_size(filename, await self.request_size(peers, filename, attempts))
+
+    # Size response of a file, asking the peers in turn
+    async def request_size(self, peers: list, filename: str, attempts: int = SIZE_ATTEMPTS):
+        for attempt in range(attempts):
+            peer_ip, peer_port = peers[attempt % len(peers)]
+            future = self.protocol.request(SIZE, filename.encode(), (peer_ip, int(peer_port)))
+            try:
+                data, _ = await asyncio.wait_for(future, REQUEST_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.protocol.cancel(future)
+                continue
+
+            events.log(self.log_source, f"Recieved size({decode_size_reply(data)[0]} packets) From {peer_ip}:{peer_port}")
+            return data
+
+        raise Exception(f"Impossible to get {filename} size")
+
+    # Size of a file in packets, from the lookup cache when a peer sent it recently
+    async def file_size(self, peers: list, filename: str):
+        data = await self.cached(("size", filename), lambda: self.request_size(peers, filename))
+        return self.parse_size(filename, data)
+
+    # Peers of a DHT key, from the lookup cache when a recent lookup found them (or found none)
+    async def find_peers(self, key: bytes):
+        return await self.cached(("peers", key), lambda: self.node.find_peers(key))
+
+    # Value of a cached lookup, the coroutine `load()` runs on a miss. Concurrent misses of a key
+    # share one load, and an entry still in use when it is about to expire is reloaded in the background
+    async def cached(self, key, load):
+        hit, value, refresh = self.lookup_cache.lookup(key)
+        if refresh:
+            self.load_cached(key, load)
+        if hit:
+            return value
+        return await asyncio.shield(self.load_cached(key, load))
+
+    # Future of a cached lookup: the first miss of a key runs `load()` in a task, a waiter
+    # giving up does not cancel it for the others
+    def load_cached(self, key, load):
+        future, owner = self.lookup_cache.start_load(key, asyncio.get_running_loop().create_future)
+        if owner:
+            task = asyncio.create_task(self.run_load(key, load))
+            self.loads.add(task)
+            task.add_done_callback(self.loads.discard)
+        return future
+
+    async def run_load(self, key, load):
+        try:
+            value = await load()
+        except Exception as e:
+            self.lookup_cache.finish_load(key, error=e)
+            return
+        self.lookup_cache.finish_load(key, value)
+
+    # Peers seeding a file, given by name or content root, and its size. Recent lookups are
+    # answered by the lookup cache, a missing file is remembered for NEGATIVE_TTL
+    async def locate(self, filename: str):
+        peers = await self.find_peers(self.lookup_key(filename))
+        if len(peers) == 0:
+            events.log(self.log_source, "Error: No available peers", ERROR)
+            raise Exception("No available peers")
+
+        events.log(self.log_source, f"Requested {filename}", file=filename)
+
+        try:
+            await self.file_size(peers, filename)
+            if not is_content_root(filename):
+                # Seeders of the same content under any name
+                peers = await self.find_peers(bytes.fromhex(self.files_root[filename])) or peers
+        except Exception:
+            self.forget_lookups(filename)
+            raise
+        return peers
+
+    # Downloads a file, given by name or content root, from every peer seeding its content
+    async def download_file(self, filename: str, priority: int = DEFAULT_PRIORITY):
+        print(f'Requested {filename}')
+        start = perf_counter()
+        peers = await self.locate(filename)
+        try:
+            await self.fetch_file(peers, filename, priority)
+        except Exception:
+            self.forget_lookups(filename)
+            metrics.count("peer.failed_downloads")
+            raise
+        metrics.observe("peer.download", perf_counter() - start)
+
+        events.log(self.log_source, f"Recieved {filename}", file=filename)
+        events.log(self.log_source, self.lookup_stats(), **self.lookup_cache.stats())
+
+        print(f"\n{filename} successfully downloaded!")
+        await self.announce_file(filename)
+
+    # Downloads many files, [(file name or content root, priority)], `max_active` at a time,
+    # see Peer.download_files. Returns {file name: error} of the failed downloads
+    async def download_files(self, files: list, max_active: int = MAX_ACTIVE_DOWNLOADS):
+        queue = DownloadQueue(files)
+        failed = {}
+
+        async def worker():
+            while True:
+                item = queue.next()
+                if item is None:
+                    return
+                filename, priority = item
+                try:
+                    await self.download_file(filename, priority)
+                except Exception as e:
+                    failed[filename] = e
+                    print(f"Download of {filename} failed: {e}")
+
+        await asyncio.gather(*(worker() for _ in range(min(max_active, len(queue)))))
+        return failed
+
+    # Downloads the manifest of a content root from the whole swarm, then from one peer
+    # at a time until one hashes to the root
+    async def get_manifest(self, peers: list, root: str):
+        if root in self.manifests:
+            return self.manifests[root]
+        key = root + MANIFEST_SUFFIX
+        for sources in [peers] + [[peer] for peer in peers]:
+            try:
+                await self.get_file_size(sources, key, MANIFEST_ATTEMPTS * len(sources))
+                buffer = self.manifest_buffer(root, key)
+                chunk_size = self.negotiate_chunk_size(key, MSS)
+                assembler = ChunkAssembler(len(buffer), chunk_size, buffer_store(buffer, chunk_size))
+                await fetch(self.protocol, sources, key, assembler, deadline=time() + MANIFEST_TIMEOUT, scheduler=self.scheduler)
+            except Exception:
+                continue
+            manifest = self.check_manifest(root, buffer, sources)
+            if manifest is not None:
+                return manifest
+
+        events.log(self.log_source, f"Error: No valid manifest of {root}", ERROR)
+        raise Exception(f"No valid manifest of {root}")
+
+    # Pipelined multi-source download into the preallocated target in the peer storage,
+    # chunks of the negotiated size are requested by content root and verified against the manifest
+    async def fetch_file(self, peers: list, filename: str, priority: int = DEFAULT_PRIORITY):
+        root = self.files_root[filename]
+        manifest = await self.get_manifest(peers, root)
+        target = self.open_target(filename, manifest)
+        chunk_size = self.negotiate_chunk_size(filename, manifest.chunk_size)
+        assembler = ChunkAssembler(manifest.size, chunk_size, target_store(target, chunk_size))
+        try:
+            transfer = await fetch(self.protocol, peers, root, assembler,
+                                   completed=target.completed(chunk_size // manifest.chunk_size),
+                                   scheduler=self.scheduler, priority=priority)
+        finally:
+            target.close()
+        self.seed_cache.register(filename, manifest)
+
+        self.log_transfer(transfer, chunk_size)
+
+    # Serve until shutdown
+    async def serve(self):
+        await self.closed
+
+    def shutdown(self):
+        if self.protocol and self.protocol.transport:
+            self.protocol.transport.close()
+        self.node.shutdown()
+        self.seed_cache.close()
+        if self.closed and not self.closed.done():
+            self.closed.set_result(None)
+        events.log(self.log_source, self.upload_stats(), **self.uploads.stats())
+        events.log(self.log_source, f"Shut down Node {self.node.ip}:{self.node.port}")
+        events.log(self.log_source, "Disconnected")
+
+
+# Entry point of `peer.py --async`
+async def run_peer(peer_port: int, dht_port: int, files=(), dht_state=None, scheduler=None, max_active=MAX_ACTIVE_DOWNLOADS,
+                   uploads=None):
+    peer = AsyncPeer(peer_port, dht_port, dht_state, uploads)
+    if scheduler:
+        peer.scheduler = scheduler
+    peer.register_metrics()
+    await peer.start()
+    try:
+        if files:
+            await peer.download_files(files, max_active)
+        await peer.serve()
+    finally:
+        peer.shutdown()
@@ -0,0 +1,90 @@
+# Load test: hundreds of concurrent downloaders against one seeder on loopback.
+# The seeder runs in its own process. Reports served requests/sec and request latency percentiles
+import argparse
+import asyncio
+import io
+import multiprocessing
+import socket
+from time import time, sleep
+
+from loopback import enter_workdir, free_port, make_file, peer_module
+
+import async_runtime
+from chunks import ChunkAssembler
+
+
+# Client endpoint that records the latency of every answered request
+class TimedProtocol(async_runtime.PeerProtocol):
+    def __init__(self, latencies):
+        super().__init__()
+        self.latencies = latencies
+
+    def request(self, msg_type, body, addr, sink=None):
+        future = super().request(msg_type, body, addr, sink)
+        sent = time()
+        future.add_done_callback(lambda f: f.cancelled() or self.latencies.append(time() - sent))
+        return future
+
+
+async def download(seeder_addr, content, latencies):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(lambda: TimedProtocol(latencies), sock=sock)
+    try:
+        sink = io.BytesIO()
+
+        # One request per MSS chunk, every request is a single datagram each way
+        def store(number, data):
+            sink.seek(peer_module.MSS * number)
+            sink.write(data)
+
+        assembler = ChunkAssembler(len(content), peer_module.MSS, store)
+        await async_runtime.fetch(protocol, [seeder_addr], "load.bin", assembler)
+        if sink.getvalue() != content:
+            raise Exception("Downloaded content differs from the original")
+    finally:
+        transport.close()
+
+
+# Seeder process: serves until terminated
+def serve(runtime, port):
+    if runtime == "async":
+        asyncio.run(async_runtime.run_peer(port, free_port()))
+    else:
+        peer_module.Peer(port, free_port()).serve()
+
+
+async def run(runtime, clients, size_kb):
+    enter_workdir()
+    port = free_port()
+    path = make_file(port, "load.bin", size_kb * 1024)
+    with open(path, "rb") as file:
+        content = file.read()
+
+    seeder = multiprocessing.Process(target=serve, args=(runtime, port), daemon=True)
+    seeder.start()
+    sleep(0.5)
+
+    latencies = []
+    start = time()
+    await asyncio.gather(*(download(("127.0.0.1", port), content, latencies) for _ in range(clients)))
+    elapsed = time() - start
+    seeder.terminate()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(f"runtime: {runtime}, {clients} downloaders x {size_kb} KB")
+    print(f"requests/sec: {len(latencies) / elapsed:10.0f}")
+    print(f"latency p50: {p50:8.2f} ms, p99: {p99:8.2f} ms")
+    print(f"total: {clients * size_kb / 1024 / elapsed:.2f} MB/s in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runtime", choices=["async", "thread"], default="async")
+    parser.add_argument("--clients", type=int, default=300)
+    parser.add_argument("--size-kb", type=int, default=64)
+    args = parser.parse_args()
+    asyncio.run(run(args.runtime, args.clients, args.size_kb))
@@ -0,0 +1,59 @@
+# Sweeps the transfer chunk size of a sliding-window download from one seeder on loopback:
+# MB/s, get requests, datagrams per request and CPU time per MB for every chunk size
+import argparse
+import os
+from time import time, process_time
+
+from loopback import enter_workdir, free_port, add_file, start_seeder, same_content, peer_module
+from chunks import FRAGMENT_SIZE, MAX_CHUNK_SIZE
+from wire import GET
+
+
+CHUNK_SIZES_KB = [1, 4, 16, 64, 256, 1024]
+
+
+# Counts the get requests served by a seeder
+def count_requests(seeder, counter):
+    handler = seeder.dispatcher.handler
+
+    def counting_handler(msg_type, request_id, body, addr):
+        if msg_type == GET:
+            counter[0] += 1
+        return handler(msg_type, request_id, body, addr)
+    seeder.dispatcher.handler = counting_handler
+
+
+def run(size_mb, chunk_sizes_kb):
+    enter_workdir()
+    seeder = start_seeder()
+    requests = [0]
+    count_requests(seeder, requests)
+    original = add_file(seeder, "bench.bin", int(size_mb * 1024 * 1024))
+    downloader = peer_module.Peer(free_port(), free_port())
+    peers = [(peer_module.IP, seeder.port)]
+    downloader.get_file_size(peers, "bench.bin")
+    downloader.get_manifest(peers, downloader.files_root["bench.bin"])
+
+    print(f"{'chunk':>8} {'MB/s':>8} {'requests':>9} {'dgrams/req':>10} {'cpu ms/MB':>10}")
+    for chunk_kb in chunk_sizes_kb:
+        downloader.chunk_size = min(chunk_kb * 1024, MAX_CHUNK_SIZE)
+        target = f"./{downloader.address}/bench.bin"
+        for path in (target, target + ".journal"):
+            if os.path.exists(path):
+                os.remove(path)
+        requests[0] = 0
+        start, cpu_start = time(), process_time()
+        downloader.fetch_file(peers, "bench.bin")
+        elapsed, cpu = time() - start, process_time() - cpu_start
+        if not same_content(original, target):
+            raise Exception(f"{chunk_kb} KB chunks: downloaded file differs from the original")
+        datagrams = -(-downloader.chunk_size // FRAGMENT_SIZE)
+        print(f"{chunk_kb:>6}KB {size_mb / elapsed:8.2f} {requests[0]:9d} {datagrams:10d} {cpu * 1000 / size_mb:10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=32)
+    parser.add_argument("--chunk-kb", type=int, nargs="+", default=CHUNK_SIZES_KB)
+    args = parser.parse_args()
+    run(args.size_mb, args.chunk_kb)
@@ -0,0 +1,108 @@
+# One peer announces thousands of keys (two per shared file) in a network of DHT nodes on
+# loopback, one lookup and one STORE per key as before, or with a single bulk announce:
+# time, lookups and datagrams per key, how many keys landed on their STORE_NODES closest
+# nodes and how many can be found from another node afterwards
+import argparse
+import os
+import random
+import socket
+from time import perf_counter, sleep
+
+from loopback import check, free_port
+import wire
+from DHT_node import DHTNode, STORE_NODES, distance
+
+
+# DHT node counting the datagrams it sends and the lookups it starts
+class CountingNode(DHTNode):
+    sent = 0
+    lookups = 0
+
+    def send(self, data, addr):
+        self.sent += 1
+        super().send(data, addr)
+
+    def start_lookup(self, target_id, find_peers):
+        self.lookups += 1
+        return super().start_lookup(target_id, find_peers)
+
+
+def stop(node):
+    node.running = False
+    try:
+        node.socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    node.socket.close()
+
+
+# Share of the keys stored at every one of their STORE_NODES closest nodes, and of a sample
+# of keys found by a lookup from another node
+def placement(network, keys, port, rng, samples):
+    nodes = sorted(network, key=lambda node: node.node_id)
+    placed = 0
+    for key in keys:
+        closest = sorted(nodes, key=lambda node: distance(node.node_id, key))[:STORE_NODES]
+        placed += all(("127.0.0.1", port) in node.known_peers(key) for node in closest)
+    sample = rng.sample(keys, min(samples, len(keys)))
+    found = sum(("127.0.0.1", port) in rng.choice(network[1:]).find_peers(key) for key in sample)
+    return placed / len(keys), found / len(sample)
+
+
+def run(nodes, files, old_files, samples, seed):
+    rng = random.Random(seed)
+    network = [CountingNode("127.0.0.1", free_port()) for _ in range(nodes)]
+    for node in network:
+        node.start()
+    for node in network[1:]:
+        node.bootstrap([("127.0.0.1", network[0].port)])
+    print(f"network of {nodes} nodes, depth {network[0].routing_table.depth()} buckets")
+    print(f"{'announce':>9} {'keys':>6} {'seconds':>8} {'keys/s':>8} {'lookups':>8} {'dgrams/key':>11} {'placed':>7} {'found':>7}")
+    for name, count in (("per key", old_files), ("bulk", files)):
+        node = rng.choice(network)
+        keys = [os.urandom(20) for _ in range(2 * count)]
+        port = rng.randrange(1024, 65536)
+        sent, lookups = node.sent, node.lookups
+        start = perf_counter()
+        if name == "bulk":
+            node.bulk_announce(keys, "127.0.0.1", port)
+        else:
+            for key in keys:
+                node.announce_peer(key, "127.0.0.1", port)
+        seconds = perf_counter() - start
+        sent, lookups = node.sent - sent, node.lookups - lookups
+        sleep(0.5)
+        placed, found = placement(network, keys, port, rng, samples)
+        print(f"{name:>9} {len(keys):6d} {seconds:8.2f} {len(keys) / seconds:8.0f} {lookups:8d} {sent / len(keys):11.2f} "
+              f"{placed * 100:6.1f}% {found * 100:6.1f}%")
+    for node in network:
+        stop(node)
+    sleep(0.1)
+
+
+# STORE_BATCH datagrams fit under MAX_DATAGRAM and carry every key once
+def self_check():
+    keys = [os.urandom(20) for _ in range(1000)]
+    peers = [wire.pack_peer("10.0.0.1", 6881), wire.pack_peer("2001:db8::1", 6881)]
+    decoded = []
+    for body in wire.encode_store_batches(keys, peers):
+        data = wire.encode_node_message(wire.STORE_BATCH, 0, bytes(20), body)
+        check(len(data) <= wire.MAX_DATAGRAM, f"STORE_BATCH of {len(data)} bytes")
+        _, _, _, body = wire.decode_node_message(data)
+        batch, batch_peers = wire.decode_store_batch(body)
+        check(batch_peers == [("10.0.0.1", 6881), ("2001:db8::1", 6881)], "peers of a batch")
+        decoded += batch
+    check(decoded == keys, "keys of the batches")
+    print(f"self-check ok: {len(keys)} keys in {len(list(wire.encode_store_batches(keys, peers[:1])))} STORE_BATCH datagrams")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=100)
+    parser.add_argument("--files", type=int, default=5000, help="Files announced in bulk, two keys each")
+    parser.add_argument("--old-files", type=int, default=250, help="Files announced one key at a time")
+    parser.add_argument("--samples", type=int, default=100, help="Keys looked up from other nodes")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    self_check()
+    run(args.nodes, args.files, args.old_files, args.samples, args.seed)
@@ -0,0 +1,150 @@
+# Simulates Kademlia lookups in networks of 10 to 10,000 nodes without sockets:
+# hop count, latency and how often the closest node is found, for the k-bucket
+# routing table and for the former flat table of the 10 most recently seen nodes
+import argparse
+import heapq
+import random
+from hashlib import sha1
+from time import time
+
+import loopback # noqa: F401 (makes the project modules importable)
+from routing_table import RoutingTable, BUCKET_SIZE
+from lookup import Lookup
+
+
+FLAT_TABLE_SIZE = 10 # Entries of the former flat routing table
+MIN_DELAY = 0.005 # One-way access delay of a simulated node is drawn from [MIN_DELAY, MAX_DELAY] seconds
+MAX_DELAY = 0.050
+
+
+# The former routing table: a dict of at most FLAT_TABLE_SIZE nodes, the least
+# recently seen one is replaced, every query sorts the whole table
+class FlatTable:
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.nodes = {} # node id -> last seen
+
+    def update(self, node_id, ip, port, now=None):
+        if node_id == self.node_id:
+            return None
+        if node_id not in self.nodes and len(self.nodes) >= FLAT_TABLE_SIZE:
+            del self.nodes[min(self.nodes, key=self.nodes.get)]
+        self.nodes[node_id] = now
+        return None
+
+    def closest(self, target_id, count, now=None):
+        target = int.from_bytes(target_id, 'big')
+        return sorted((SimContact(n) for n in self.nodes), key=lambda c: int.from_bytes(c.id, 'big') ^ target)[:count]
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+class SimContact:
+    def __init__(self, node_id):
+        self.id = node_id
+
+
+# A simulated node: its routing table and access delay
+class SimNode:
+    def __init__(self, node_id, table_class, rng):
+        self.id = node_id
+        self.table = table_class(node_id)
+        self.delay = rng.uniform(MIN_DELAY, MAX_DELAY)
+
+
+class Network:
+    def __init__(self, table_class, seed):
+        self.table_class = table_class
+        self.rng = random.Random(seed)
+        self.nodes = {} # node id -> SimNode
+        self.ids = [] # node ids in join order
+        self.clock = 0.0
+
+    # Record that `node` heard from `other`. A full bucket pings its least recently
+    # seen node first; simulated nodes never fail, so that node is kept
+    def contact(self, node, other_id):
+        self.clock += 0.001
+        oldest = node.table.update(other_id, "127.0.0.1", 0, self.clock)
+        if oldest is not None:
+            node.table.update(oldest.id, "127.0.0.1", 0, self.clock)
+
+    def join(self):
+        node = SimNode(sha1(self.rng.randbytes(20)).digest(), self.table_class, self.rng)
+        if self.ids:
+            self.contact(node, self.rng.choice(self.ids))
+            self.lookup(node, node.id)
+        self.nodes[node.id] = node
+        self.ids.append(node.id)
+
+    # Iterative lookup driven by the same Lookup state machine as DHTNode: ALPHA queries
+    # in flight, replies arrive after the round trip between the two nodes.
+    # Returns (hops to the closest node found, latency, queries sent, closest node found)
+    def lookup(self, source, target_id):
+        contacts = source.table.closest(target_id, BUCKET_SIZE, self.clock)
+        lookup = Lookup(target_id, source.id, [(c.id, c.id) for c in contacts])
+        hops = {c.id: 1 for c in contacts}
+        replies = [] # (arrival time, node id)
+        now = 0.0
+        queries = 0
+        while not lookup.done():
+            for node_id, _ in lookup.next_queries():
+                queries += 1
+                heapq.heappush(replies, (now + 2 * (source.delay + self.nodes[node_id].delay), node_id))
+            if not replies:
+                break
+            now, node_id = heapq.heappop(replies)
+            remote = self.nodes[node_id]
+            self.contact(remote, source.id)
+            self.contact(source, node_id)
+            found = [c.id for c in remote.table.closest(target_id, BUCKET_SIZE, self.clock)]
+            for contact in found:
+                hops.setdefault(contact, hops[node_id] + 1)
+            lookup.on_response(node_id, [(n, n) for n in found], [])
+        closest = lookup.result(1)
+        if not closest:
+            return 0, now, queries, None
+        return hops[closest[0][0]], now, queries, closest[0][0]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(sizes, lookups, seed):
+    print(f"{'table':>8} {'nodes':>6} {'hops':>6} {'p95':>4} {'queries':>8} {'latency ms':>11} {'p95 ms':>7} {'found':>6} {'entries':>8} {'build s':>8}")
+    for size in sizes:
+        for name, table_class in (("k-bucket", RoutingTable), ("flat", FlatTable)):
+            network = Network(table_class, seed)
+            start = time()
+            for _ in range(size):
+                network.join()
+            build = time() - start
+
+            ids = network.ids
+            int_ids = [int.from_bytes(n, 'big') for n in ids]
+            hops, latencies, sent, found = [], [], 0, 0
+            for _ in range(lookups):
+                source = network.nodes[network.rng.choice(ids)]
+                target_id = network.rng.randbytes(20)
+                target = int.from_bytes(target_id, 'big')
+                depth, latency, queries, closest = network.lookup(source, target_id)
+                best = min((n for n in int_ids if n.to_bytes(20, 'big') != source.id), key=lambda n: n ^ target, default=None)
+                hops.append(depth)
+                sent += queries
+                latencies.append(latency)
+                found += closest is not None and int.from_bytes(closest, 'big') == best
+            entries = sum(len(n.table) for n in network.nodes.values()) / size
+            print(f"{name:>8} {size:6d} {sum(hops) / lookups:6.2f} {percentile(hops, 0.95):4d} {sent / lookups:8.1f} "
+                  f"{sum(latencies) / lookups * 1000:11.1f} {percentile(latencies, 0.95) * 1000:7.1f} "
+                  f"{found * 100 / lookups:5.1f}% {entries:8.1f} {build:8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    run(args.nodes, args.lookups, args.seed)
@@ -0,0 +1,153 @@
+# Restarts a DHT node in a network of nodes on loopback, once from scratch (cold: new id,
+# empty tables, join through the bootstrap nodes) and once from its state log (warm: same
+# id, kept contacts and stored peers): startup and join time, messages sent to join,
+# contacts after joining and stored peers still available. Also checks the state log:
+# replay, records cut short by a crash, and compaction
+import argparse
+import os
+import socket
+import tempfile
+from time import perf_counter, sleep
+
+from loopback import check, free_port
+from DHT_node import DHTNode, name_key
+from routing_table import RoutingTable
+from peer_store import PeerStore
+from node_state import NodeState, STATE_FLUSH_INTERVAL, COMPACT_MIN_RECORDS
+
+
+# DHT node counting the datagrams it sends
+class CountingNode(DHTNode):
+    sent = 0
+
+    def send(self, data, addr):
+        self.sent += 1
+        super().send(data, addr)
+
+
+# Stop a node and release its port: the shutdown wakes up the listener blocked on the socket
+def stop(node):
+    node.running = False
+    try:
+        node.socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    node.socket.close()
+    if node.state:
+        node.state.close()
+
+
+def join(port, state_path, bootstrap_nodes, key):
+    start = perf_counter()
+    node = CountingNode("127.0.0.1", port, state_path=state_path)
+    node.start()
+    started = perf_counter()
+    node.bootstrap(bootstrap_nodes)
+    joined = perf_counter()
+    sent = node.sent
+    found = node.find_peers(key)
+    looked_up = perf_counter()
+    return node, started - start, joined - started, sent, looked_up - joined, found
+
+
+def run(nodes, stored, seed_key_peers):
+    workdir = tempfile.mkdtemp(prefix="p2p-bench-")
+    bootstrap = [DHTNode("127.0.0.1", free_port()) for _ in range(2)]
+    network = list(bootstrap)
+    for node in bootstrap:
+        node.start()
+    bootstrap_nodes = [("127.0.0.1", node.port) for node in bootstrap]
+    for _ in range(nodes):
+        node = DHTNode("127.0.0.1", free_port())
+        node.start()
+        node.bootstrap(bootstrap_nodes)
+        network.append(node)
+    key = name_key("bench.bin")
+    for i in range(seed_key_peers):
+        network[-1].announce_peer(key, "10.0.0.1", 1000 + i)
+
+    port = free_port()
+    state_path = os.path.join(workdir, "dht_state")
+    print(f"{'start':>6} {'init ms':>8} {'join ms':>8} {'messages':>9} {'contacts':>9} {'stored':>7} {'lookup ms':>10} {'same id':>8}")
+    node, init, joined, sent, lookup, found = join(port, state_path, bootstrap_nodes, key)
+    assert found
+    for i in range(stored):
+        node.store_peer(os.urandom(20), f"10.1.{i >> 8 & 255}.{i & 255}", 6881)
+    print(f"{'cold':>6} {init * 1000:8.1f} {joined * 1000:8.1f} {sent:9d} {len(node.routing_table):9d} {0:7d} {lookup * 1000:10.1f} {'-':>8}")
+    node_id = node.node_id
+    sleep(STATE_FLUSH_INTERVAL * 2)
+    stop(node)
+
+    node, init, joined, sent, lookup, found = join(port, state_path, bootstrap_nodes, key)
+    assert found
+    print(f"{'warm':>6} {init * 1000:8.1f} {joined * 1000:8.1f} {sent:9d} {len(node.routing_table):9d} {len(node.storage):7d} "
+          f"{lookup * 1000:10.1f} {str(node.node_id == node_id):>8}")
+    stop(node)
+    for other in network:
+        stop(other)
+    sleep(0.1)
+
+
+# Tables of a node recording their changes into a state log
+def journaled_tables(path, node_id):
+    state = NodeState(path)
+    table, storage = RoutingTable(node_id), PeerStore()
+    state.compact(node_id, table.nodes, storage.all_records)
+    table.journal = storage.journal = state
+    return state, table, storage
+
+
+def contents(table, storage):
+    return ({(n.id, n.ip, n.port) for n in table.nodes()},
+            {(r.key, r.addr[0], r.addr[1], r.expires) for r in storage.all_records()})
+
+
+def loaded_contents(path):
+    node_id, contacts, peers = NodeState(path).load()
+    return node_id, (set(contacts), set(peers))
+
+
+# Replaying the log gives back the tables, also when the last record was cut short
+# by a crash, and compaction shrinks the log to the live records
+def self_check():
+    path = os.path.join(tempfile.mkdtemp(prefix="p2p-bench-"), "dht_state")
+    node_id = bytes(20)
+    state, table, storage = journaled_tables(path, node_id)
+    for i in range(1, 200):
+        table.update(i.to_bytes(20, 'big'), f"10.0.{i >> 8}.{i & 255}", 6881)
+    for i in range(1, 200, 3):
+        table.fail(i.to_bytes(20, 'big'))
+        table.fail(i.to_bytes(20, 'big'))
+        table.fail(i.to_bytes(20, 'big'))
+    table.update((5).to_bytes(20, 'big'), "10.9.9.9", 7000) # moved
+    for i in range(500):
+        storage.store(bytes([i % 7]) * 20, "2001:db8::1" if i % 5 == 0 else f"10.2.0.{i % 250}", 1000 + i)
+    state.flush()
+    check(loaded_contents(path) == (node_id, contents(table, storage)), "replayed log matches the tables")
+
+    with open(path, "ab") as file:
+        file.write(bytes([1, 0, 27, 0, 0]))
+    check(loaded_contents(path)[1] == contents(table, storage), "a record cut short is ignored")
+
+    for _ in range(COMPACT_MIN_RECORDS // 500 + 1):
+        for i in range(500):
+            storage.store(bytes([i % 7]) * 20, "2001:db8::1" if i % 5 == 0 else f"10.2.0.{i % 250}", 1000 + i)
+    state.flush()
+    size = os.path.getsize(path)
+    live = len(table) + len(storage)
+    check(state.should_compact(live), "renewals make the log compactable")
+    state.compact(node_id, table.nodes, storage.all_records)
+    check(state.records == live and os.path.getsize(path) < size, "compaction keeps only the live records")
+    check(loaded_contents(path) == (node_id, contents(table, storage)), "compacted log matches the tables")
+    state.close()
+    print(f"self-check ok: log of {size} bytes compacted to {os.path.getsize(path)} bytes")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=50, help="DHT nodes in the network besides the 2 bootstrap nodes")
+    parser.add_argument("--stored", type=int, default=10000, help="Peers stored at the restarted node")
+    parser.add_argument("--announced", type=int, default=5, help="Peers announced under the key looked up after joining")
+    args = parser.parse_args()
+    self_check()
+    run(args.nodes, args.stored, args.announced)
@@ -0,0 +1,155 @@
+# A million peer announcements into the storage of one DHT node: announce rate, FIND_PEERS
+# lookup time, expiry time and memory per record, for the indexed expiring PeerStore and
+# for the former storage (a list of peers per key, deduplicated by scanning it, with a
+# cleanup of every key on each lookup)
+import argparse
+import random
+import tracemalloc
+from time import perf_counter, time
+
+from loopback import check
+from peer_store import PeerStore, EXPIRY_GRANULARITY
+from DHT_node import CLEANUP_REFRESH_INTERVAL
+
+
+# The former storage of DHTNode
+class ListStorage:
+    class PeerInfo:
+        def __init__(self, ip, port):
+            self.ip = ip
+            self.port = port
+            self.last_seen = time()
+
+    def __init__(self):
+        self.storage = {} # file_hash -> [PeerInfo]
+
+    def store(self, file_hash, ip, port):
+        if file_hash in self.storage:
+            for p in self.storage[file_hash]:
+                if p.ip == ip and p.port == port:
+                    p.last_seen = time()
+                    return
+        else:
+            self.storage[file_hash] = []
+        self.storage[file_hash].append(self.PeerInfo(ip, port))
+
+    # Every key is cleaned up on each lookup. (The original popped emptied keys while
+    # iterating the dict, which raises; nothing expires during the benchmark.)
+    def get(self, file_hash):
+        now = time()
+        for key in list(self.storage):
+            self.storage[key] = [p for p in self.storage[key] if now - p.last_seen < CLEANUP_REFRESH_INTERVAL]
+            if len(self.storage[key]) == 0:
+                self.storage.pop(key)
+        return self.storage.get(file_hash, [])
+
+    def __len__(self):
+        return sum(len(peers) for peers in self.storage.values())
+
+
+# `count` announcements of peers under `keys` keys: popular keys get more peers and a
+# share of the announcements renew a peer that is already stored
+def announcements(count, keys, seed):
+    rng = random.Random(seed)
+    key_ids = [rng.randbytes(20) for _ in range(keys)]
+    announced = []
+    for _ in range(count):
+        if announced and rng.random() < 0.2:
+            yield announced[rng.randrange(len(announced))]
+            continue
+        key = key_ids[min(keys - 1, int(rng.paretovariate(1.2)) - 1)] if rng.random() < 0.3 else rng.choice(key_ids)
+        announcement = (key, f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}", rng.randrange(1024, 65536))
+        if len(announced) < 100000:
+            announced.append(announcement)
+        yield announcement
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def store_all(storage, items, clock):
+    for key, ip, port in items:
+        if clock is None:
+            storage.store(key, ip, port)
+        else:
+            storage.store(key, ip, port, clock)
+
+
+# Bytes allocated per stored record, traced while a fresh storage takes `items`
+def memory_per_record(storage_class, items, clock):
+    tracemalloc.start()
+    storage = storage_class()
+    base = tracemalloc.get_traced_memory()[0]
+    store_all(storage, items, clock)
+    memory = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return memory / len(storage)
+
+
+def run(name, storage, items, lookups, clock, memory):
+    start = perf_counter()
+    store_all(storage, items, clock)
+    announce = perf_counter() - start
+
+    keys = [key for key, _, _ in random.Random(3).sample(items, lookups)]
+    times = []
+    for key in keys:
+        start = perf_counter()
+        peers = storage.get(key) if clock is None else storage.get(key, clock)
+        times.append(perf_counter() - start)
+        assert peers
+    records = len(storage)
+
+    expiry = None
+    if clock is not None:
+        start = perf_counter()
+        storage.get(keys[0], clock + CLEANUP_REFRESH_INTERVAL + EXPIRY_GRANULARITY)
+        expiry = perf_counter() - start
+        assert len(storage) == 0 and not storage.keys and not storage.wheel
+    print(f"{name:>9} {len(items):9d} {records:9d} {len(items) / announce:11.0f} {sum(times) / len(times) * 1e6:10.1f} "
+          f"{percentile(times, 0.99) * 1e6:9.1f} {memory:9.0f} " + (f"{expiry * 1000:9.1f}" if expiry is not None else f"{'-':>9}"))
+
+
+# Renewal, expiry and the caps of the PeerStore, on a simulated clock
+def self_check():
+    store = PeerStore(ttl=600, max_per_key=3, max_records=5)
+    key1, key2 = b"1" * 20, b"2" * 20
+    store.store(key1, "10.0.0.1", 1, now=0)
+    store.store(key1, "10.0.0.2", 2, now=100)
+    store.store(key1, "10.0.0.1", 1, now=200) # renewed
+    check(store.addresses(key1, now=200) == [("10.0.0.2", 2), ("10.0.0.1", 1)], "renewal moves a peer last")
+    check(store.addresses(key1, now=650) == [("10.0.0.2", 2), ("10.0.0.1", 1)], "peers expire only after their TTL")
+    check(store.addresses(key1, now=700 + EXPIRY_GRANULARITY) == [("10.0.0.1", 1)], "expired peer dropped")
+    check(store.addresses(key1, now=800 + EXPIRY_GRANULARITY) == [] and key1 not in store, "expired key dropped")
+    for port in range(1, 5):
+        store.store(key1, "10.0.0.1", port, now=1000 + port)
+    check(store.addresses(key1, now=1000) == [("10.0.0.1", 2), ("10.0.0.1", 3), ("10.0.0.1", 4)], "per-key cap")
+    for port in range(1, 4):
+        store.store(key2, "10.0.0.2", port, now=1100 + port)
+    check(len(store) == 5 and len(store.addresses(key1, now=1100)) == 2, "total cap evicts the earliest expiry")
+    check(store.get(key2, now=1100)[0].entry[0] == 0, "records carry their PEERS entry")
+    check(len(store.get(key2, now=2000)) == 0 and len(store) == 0 and not store.wheel, "everything expires")
+    print("self-check ok")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--announcements", type=int, default=1000000)
+    parser.add_argument("--keys", type=int, default=100000)
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--old-announcements", type=int, default=100000,
+                        help="Announcements into the former storage, which scans the peers of a key on each one")
+    parser.add_argument("--old-lookups", type=int, default=20, help="Lookups on the former storage, each one scans it whole")
+    parser.add_argument("--memory-sample", type=int, default=100000, help="Announcements traced to measure memory per record")
+    args = parser.parse_args()
+    self_check()
+    items = list(announcements(args.announcements, args.keys, seed=1))
+    sample = items[:args.memory_sample]
+    now = time()
+    print(f"{'storage':>9} {'announces':>9} {'records':>9} {'announce/s':>11} {'lookup us':>10} {'p99 us':>9} {'B/record':>9} {'expire ms':>9}")
+    run("indexed", PeerStore(CLEANUP_REFRESH_INTERVAL), items, args.lookups, now,
+        memory_per_record(lambda: PeerStore(CLEANUP_REFRESH_INTERVAL), sample, now))
+    run("list", ListStorage(), items[:args.old_announcements], args.old_lookups, None,
+        memory_per_record(ListStorage, sample[:args.old_announcements], None))
@@ -0,0 +1,165 @@
+# Mirrors a catalog of files from a seeder found through a DHT network on loopback, one file
+# at a time and several at once under the download scheduler: total time, MB/s and requests.
+# Then two files downloaded at once with different priorities under a small in-flight cap
+# (time each one took) and a catalog under a bandwidth limit (achieved rate against the limit).
+# Also checks the scheduler, the download queue and the download list format
+import argparse
+import os
+import tempfile
+from time import perf_counter, sleep
+
+from loopback import check, enter_workdir, free_port, make_file, same_content, peer_module
+from DHT_node import DHTNode
+from download_manager import DownloadScheduler, DownloadQueue, read_download_list
+
+
+# Stop a peer without Peer.shutdown, which ends the process
+def stop(peer):
+    peer.dispatcher.stop()
+    peer.socket.close()
+    peer.seed_cache.close()
+    peer.node.running = False
+    peer.node.socket.close()
+
+
+# Downloads `files` [(name, priority)] with a new peer, returns (seconds, peer, {name: seconds to finish})
+def mirror(files, max_active, scheduler):
+    downloader = peer_module.Peer(free_port(), free_port())
+    downloader.scheduler = scheduler
+    # Stopped downloaders must not stay in the DHT as seeders of the next runs
+    downloader.announce_file = lambda filename: None
+    finished = {}
+    download_file = downloader.download_file
+    start = perf_counter()
+
+    def timed(filename, *args):
+        download_file(filename, *args)
+        finished[filename] = perf_counter() - start
+
+    downloader.download_file = timed
+    failed = downloader.download_files(files, max_active)
+    if failed:
+        raise Exception(f"Downloads failed: {failed}")
+    return perf_counter() - start, downloader, finished
+
+
+def run(nodes, files, size_mb, priority_mb, rate_mb):
+    enter_workdir()
+    network = [DHTNode("127.0.0.1", free_port()) for _ in range(nodes)]
+    for node in network:
+        node.start()
+    with open("./well_known_nodes.txt", "w") as file:
+        for node in network[:2]:
+            file.write(f"{('127.0.0.1', node.port)}\n")
+    for node in network[1:]:
+        node.bootstrap([("127.0.0.1", network[0].port)])
+
+    size = int(size_mb * 1024 * 1024)
+    seeder_port = free_port()
+    names = [f"file{i}.bin" for i in range(files)]
+    paths = {name: make_file(seeder_port, name, size) for name in names}
+    for name in ("low.bin", "high.bin"):
+        make_file(seeder_port, name, int(priority_mb * 1024 * 1024))
+    seeder = peer_module.Peer(seeder_port, free_port())
+    seeder.announcer.join()
+    catalog = [(name, 1) for name in names]
+    total_mb = files * size_mb
+
+    print(f"catalog of {files} files of {size_mb} MB")
+    print(f"{'parallel':>8} {'seconds':>8} {'MB/s':>7} {'requests':>9} {'held back':>10}")
+    for max_active in (1, 4, 8):
+        scheduler = DownloadScheduler()
+        seconds, downloader, _ = mirror(catalog, max_active, scheduler)
+        for name in names:
+            if not same_content(paths[name], f"./{downloader.address}/{name}"):
+                raise Exception(f"{name} differs from the original")
+        print(f"{max_active:8d} {seconds:8.2f} {total_mb / seconds:7.1f} {scheduler.requests:9d} {scheduler.throttled:10d}")
+        stop(downloader)
+
+    scheduler = DownloadScheduler(max_in_flight=4)
+    _, downloader, finished = mirror([("low.bin", 1), ("high.bin", 3)], 2, scheduler)
+    print(f"two files of {priority_mb} MB with priorities 1 and 3, 4 requests in flight: "
+          f"priority 3 done in {finished['high.bin']:.2f}s, priority 1 in {finished['low.bin']:.2f}s")
+    stop(downloader)
+
+    scheduler = DownloadScheduler(rate=rate_mb * 1024 * 1024)
+    seconds, downloader, _ = mirror(catalog, 4, scheduler)
+    print(f"limit {rate_mb} MB/s: {total_mb / seconds:.2f} MB/s in {seconds:.2f}s")
+    stop(downloader)
+
+    stop(seeder)
+    for node in network:
+        node.running = False
+        node.socket.close()
+    sleep(0.1)
+
+
+# Transfer that always wants `wanted` more requests, standing in for a SwarmScheduler
+class Hungry:
+    def __init__(self, wanted=1000):
+        self.wanted = wanted
+        self.sent = 0
+
+    def in_flight(self):
+        return self.sent
+
+    def wants_more(self, now):
+        return self.wanted > 0
+
+    def take(self, now, limit=None):
+        count = self.wanted if limit is None else min(limit, self.wanted)
+        self.sent += count
+        return [(0, None)] * count
+
+
+# Weighted shares of the requests in flight, a transfer alone uses everything, the token
+# bucket, the queue order and the download list
+def self_check():
+    scheduler = DownloadScheduler(max_in_flight=100)
+    alone, low, high = Hungry(), Hungry(), Hungry()
+    slot = scheduler.register()
+    check(len(scheduler.take(slot, alone, 1024, 0)[0]) == 100, "a transfer alone gets every request")
+    scheduler.unregister(slot)
+    low_slot, high_slot = scheduler.register(1), scheduler.register(3)
+    for _ in range(3):
+        scheduler.take(low_slot, low, 1024, 0)
+        scheduler.take(high_slot, high, 1024, 0)
+        low.sent, high.sent = low.sent // 2, high.sent // 2 # half of the requests got answered
+    check(low_slot.in_flight <= 25 < high_slot.in_flight <= 75, f"shares by priority: {low_slot.in_flight} and {high_slot.in_flight}")
+
+    # A transfer with nothing more to send is not held back and does not hold the others to their share
+    scheduler = DownloadScheduler(max_in_flight=100)
+    idle_slot, busy_slot = scheduler.register(), scheduler.register()
+    requests, held_back = scheduler.take(idle_slot, Hungry(0), 1024, 0)
+    check(not requests and not held_back and scheduler.throttled == 0, "an idle transfer is held back")
+    check(len(scheduler.take(busy_slot, Hungry(), 1024, 0)[0]) == 100, "an idle transfer limits the others")
+
+    scheduler = DownloadScheduler(rate=10240)
+    slot = scheduler.register()
+    transfer = Hungry()
+    requests, held_back = scheduler.take(slot, transfer, 512, scheduler.bucket.updated)
+    check(len(requests) == 2 and held_back, "the burst allows 0.1 s of bandwidth")
+    check(not scheduler.take(slot, transfer, 512, scheduler.bucket.updated)[0], "an empty bucket holds requests back")
+    check(len(scheduler.take(slot, transfer, 512, scheduler.bucket.updated + 0.05)[0]) == 1, "the bucket refills at the rate")
+
+    queue = DownloadQueue([("a", 1), ("b", 2), ("c", 1), ("a", 5), ("b", 1)])
+    order = [queue.next() for _ in range(4)]
+    check(order == [("a", 5), ("b", 2), ("c", 1), None], f"queue order {order}")
+
+    path = os.path.join(tempfile.mkdtemp(prefix="p2p-bench-"), "downloads.txt")
+    with open(path, "w") as file:
+        file.write("# catalog\nmovie.mkv 3\n\nnotes from the trip.txt\n" + "ab" * 32 + "  # by root\n")
+    check(read_download_list(path) == [("movie.mkv", 3), ("notes from the trip.txt", 1), ("ab" * 32, 1)], "download list")
+    print("self-check ok: scheduler shares, token bucket, queue order, download list")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=10)
+    parser.add_argument("--files", type=int, default=64)
+    parser.add_argument("--size-mb", type=float, default=0.25)
+    parser.add_argument("--priority-mb", type=float, default=16, help="Size of the two files downloaded with different priorities")
+    parser.add_argument("--rate-mb", type=float, default=4, help="Bandwidth limit of the last run (MB/s)")
+    args = parser.parse_args()
+    self_check()
+    run(args.nodes, args.files, args.size_mb, args.priority_mb, args.rate_mb)
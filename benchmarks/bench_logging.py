@@ -0,0 +1,121 @@
+# Download throughput with verbose logging on and off: the stop-and-wait batch download
+# (one thread and one log event per 1 KB packet) and the sliding window with 1 KB chunks
+# (one event per chunk). Verbose logging is compared as it was, opening and appending to
+# the log under a lock for every event, and through the buffered log, whole, sampled and
+# as JSON lines. Reports MB/s, CPU seconds per MB and the lines written.
+# Also checks levels, sampling, JSON lines, rotation and the flush on close
+import argparse
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime
+from time import time, process_time
+
+from loopback import check, enter_workdir, free_port, add_file, start_seeder, same_content, peer_module
+from bench_window import fetch_file_batched
+from event_log import EventLog, events, DEBUG, INFO, WARNING
+
+
+# The log before the buffered one: every event takes the lock, opens the file, writes a line and closes it
+class AppendLog:
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def packet(self, level=DEBUG):
+        return True
+
+    def log(self, source, message, level=INFO, **fields):
+        with self.lock:
+            with open('./log_file.txt', 'a') as log_file:
+                log_file.write(f"[{datetime.now().replace(microsecond=0).isoformat(sep=' ')}] {source} {message}\n")
+
+
+def lines():
+    events.flush()
+    with open('./log_file.txt') as log_file:
+        return sum(1 for _ in log_file)
+
+
+def run(size_mb, rounds):
+    enter_workdir()
+    seeder = start_seeder()
+    original = add_file(seeder, "bench.bin", int(size_mb * 1024 * 1024))
+    downloader = peer_module.Peer(free_port(), free_port())
+    downloader.chunk_size = peer_module.MSS
+    peers = [(peer_module.IP, seeder.port)]
+    downloader.get_file_size(peers, "bench.bin")
+    downloader.get_manifest(peers, downloader.files_root["bench.bin"])
+
+    fetches = {
+        "batch": lambda: fetch_file_batched(downloader, peers, "bench.bin"),
+        "window": lambda: downloader.fetch_file(peers, "bench.bin", progress=False),
+    }
+    logs = {
+        "off (info)": (events, dict(level=INFO, sample=1, json_lines=False)),
+        "open/append": (AppendLog(), None),
+        "buffered": (events, dict(level=DEBUG, sample=1, json_lines=False)),
+        "sampled 1/16": (events, dict(level=DEBUG, sample=16, json_lines=False)),
+        "json lines": (events, dict(level=DEBUG, sample=1, json_lines=True)),
+    }
+    print(f"{size_mb} MB, {size_mb * 1024:.0f} packets of 1 KB")
+    print(f"{'download':>8} {'logging':>13} {'MB/s':>7} {'CPU s/MB':>9} {'lines':>7}")
+    for mode, fetch in fetches.items():
+        for name, (log, settings) in logs.items():
+            if settings:
+                events.configure(**settings)
+            peer_module.events = log
+            best, cpu, written = 0.0, 0.0, 0
+            for _ in range(rounds):
+                target = f"./{downloader.address}/bench.bin"
+                if os.path.exists(target):
+                    os.remove(target)
+                before = lines()
+                start, start_cpu = time(), process_time()
+                fetch()
+                elapsed = time() - start
+                if size_mb / elapsed > best:
+                    best, cpu = size_mb / elapsed, (process_time() - start_cpu) / size_mb
+                written = lines() - before
+                if not same_content(original, target):
+                    raise Exception(f"{mode}: downloaded file differs from the original")
+            peer_module.events = events
+            print(f"{mode:>8} {name:>13} {best:7.2f} {cpu:9.3f} {written:7d}")
+
+
+# Levels and sampling decide what is queued, text and JSON lines, rotation by size, close writes everything
+def self_check():
+    path = os.path.join(tempfile.mkdtemp(prefix="p2p-bench-"), "log.txt")
+    log = EventLog(path, level=INFO, sample=4)
+    log.log("Peer a", "hidden", DEBUG)
+    log.log("Peer a", "Connected")
+    log.log(None, "Created well-known node")
+    check([log.packet() for _ in range(8)] == [False] * 8, "per-packet events follow the level")
+    log.configure(level=DEBUG)
+    check(sum(log.packet() for _ in range(8)) == 2, "one per-packet event in 4")
+    log.close()
+    with open(path) as file:
+        text = file.read().splitlines()
+    check(len(text) == 2 and text[0].endswith("] Peer a Connected") and text[1].endswith("] Created well-known node"), f"text lines {text}")
+
+    log = EventLog(path, json_lines=True, max_bytes=4096, backups=2)
+    for number in range(200):
+        log.log("Peer a", f"Recieved Chunk {number}", WARNING, chunk=number)
+        if number % 20 == 0:
+            log.flush()
+    log.close()
+    check(log.rotations >= 2 and os.path.exists(f"{path}.2") and not os.path.exists(f"{path}.3"), f"rotation {log.stats()}")
+    # A write that filled the log rotated it, the newest lines are then in log.txt.1
+    with open(path if os.path.exists(path) else f"{path}.1") as file:
+        record = json.loads(file.read().splitlines()[-1])
+    check(record["chunk"] == 199 and record["level"] == "warning" and record["source"] == "Peer a", f"JSON line {record}")
+    print(f"self-check ok: {log.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    self_check()
+    run(args.size_mb, args.rounds)
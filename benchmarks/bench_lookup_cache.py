@@ -0,0 +1,176 @@
+# Repeated and parallel requests for popular files (and some missing ones) from one peer in a
+# network of DHT nodes on loopback, with and without the lookup cache: DHT lookups and size
+# requests sent per requested file, and the time to locate a file (its peers and size).
+# Also checks the cache itself: TTL, negative entries, LRU bound, refresh-ahead and shared loads
+import argparse
+import random
+import threading
+from concurrent.futures import Future
+from time import perf_counter, sleep
+
+from loopback import check, enter_workdir, free_port, make_file, peer_module
+from DHT_node import DHTNode
+from lookup_cache import LookupCache, REFRESH_AHEAD
+from wire import SIZE
+
+
+# Counts the DHT lookups and the size requests a peer sends
+def count_requests(peer):
+    counts = {"lookups": 0, "sizes": 0}
+    start_lookup = peer.node.start_lookup
+    request = peer.dispatcher.request
+
+    def counted_lookup(*args):
+        counts["lookups"] += 1
+        return start_lookup(*args)
+
+    def counted_request(msg_type, *args, **kwargs):
+        if msg_type == SIZE:
+            counts["sizes"] += 1
+        return request(msg_type, *args, **kwargs)
+
+    peer.node.start_lookup = counted_lookup
+    peer.dispatcher.request = counted_request
+    return counts
+
+
+# Names requested by the clients: popular files first (Zipf-like), some of them missing
+def workload(files, requests, missing, rng):
+    weights = [1 / (rank + 1) for rank in range(files)]
+    names = []
+    for _ in range(requests):
+        if rng.random() < missing:
+            names.append(f"missing{rng.randrange(max(files // 10, 1))}.bin")
+        else:
+            names.append(f"file{rng.choices(range(files), weights)[0]}.bin")
+    return names
+
+
+def locate_all(client, names, threads):
+    times = []
+    lock = threading.Lock()
+    queue = list(names)
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                name = queue.pop()
+            start = perf_counter()
+            try:
+                client.locate(name)
+            except Exception:
+                pass
+            elapsed = perf_counter() - start
+            with lock:
+                times.append(elapsed)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    return sorted(times)
+
+
+# Stop a peer without Peer.shutdown, which ends the process
+def stop(peer):
+    peer.dispatcher.stop()
+    peer.socket.close()
+    peer.seed_cache.close()
+    peer.node.running = False
+    peer.node.socket.close()
+
+
+def run(nodes, files, requests, missing, threads, seed):
+    enter_workdir()
+    rng = random.Random(seed)
+    network = [DHTNode("127.0.0.1", free_port()) for _ in range(nodes)]
+    for node in network:
+        node.start()
+    with open("./well_known_nodes.txt", "w") as file:
+        for node in network[:2]:
+            file.write(f"{('127.0.0.1', node.port)}\n")
+    for node in network[1:]:
+        node.bootstrap([("127.0.0.1", network[0].port)])
+
+    seeder_port = free_port()
+    for i in range(files):
+        make_file(seeder_port, f"file{i}.bin", 4096)
+    seeder = peer_module.Peer(seeder_port, free_port())
+    seeder.announcer.join()
+    names = workload(files, requests, missing, rng)
+
+    print(f"network of {nodes} nodes, {files} files, {requests} requests ({missing * 100:.0f}% missing), {threads} threads")
+    print(f"{'cache':>6} {'lookups':>8} {'sizes':>6} {'trips/req':>10} {'mean ms':>8} {'p99 ms':>7} {'saved':>6} {'hits':>6} {'negative':>9} {'shared':>7}")
+    for cached in (False, True):
+        client = peer_module.Peer(free_port(), free_port())
+        if not cached:
+            client.cached = lambda key, load: load() # every request looks up the DHT, as before
+        counts = count_requests(client)
+        times = locate_all(client, names, threads)
+        stats = client.lookup_cache.stats()
+        trips = counts["lookups"] + counts["sizes"]
+        print(f"{'on' if cached else 'off':>6} {counts['lookups']:8d} {counts['sizes']:6d} {trips / requests:10.2f} "
+              f"{sum(times) / len(times) * 1000:8.2f} {times[int(len(times) * 0.99) - 1] * 1000:7.2f} "
+              f"{stats['saved']:6d} {stats['hits']:6d} {stats['negative_hits']:9d} {stats['shared']:7d}")
+        stop(client)
+    stop(seeder)
+    for node in network:
+        node.running = False
+        node.socket.close()
+    sleep(0.1)
+
+
+def load(cache, key, value, now):
+    future, owner = cache.start_load(key, Future)
+    check(owner, f"{key} loads")
+    cache.finish_load(key, value, now=now)
+    return future
+
+
+# TTL and negative TTL, LRU bound, a single refresh of a hot entry, shared loads and failed loads
+def self_check():
+    cache = LookupCache(ttl=60, negative_ttl=10, max_entries=3)
+    load(cache, "a", ["peer"], 0)
+    load(cache, "missing", [], 0)
+    check(cache.lookup("a", 30)[:2] == (True, ["peer"]), "fresh entry is a hit")
+    check(cache.lookup("missing", 5)[:2] == (True, []), "negative entry is a hit")
+    check(not cache.lookup("missing", 11)[0], "negative entry expires after the negative TTL")
+    check(not cache.lookup("a", 61)[0], "entry expires after the TTL")
+
+    load(cache, "a", ["peer"], 100)
+    late = 100 + 60 * (1 - REFRESH_AHEAD / 2)
+    check(cache.lookup("a", 110)[2] is False, "early hit does not refresh")
+    check(cache.lookup("a", late)[2] is True, "hit close to expiry refreshes")
+    check(cache.lookup("a", late)[2] is False, "an entry is refreshed once")
+    load(cache, "a", ["peer", "other"], late)
+    check(cache.lookup("a", late + 50)[:2] == (True, ["peer", "other"]), "refreshed entry lives on")
+
+    future, owner = cache.start_load("b", Future)
+    shared, shared_owner = cache.start_load("b", Future)
+    check(owner and not shared_owner and shared is future, "concurrent misses share one load")
+    cache.finish_load("b", error=TimeoutError())
+    check(isinstance(shared.exception(), TimeoutError), "waiters get the error of a failed load")
+    check(not cache.lookup("b", 200)[0], "a failed load is not cached")
+
+    for key in ("c", "d", "e"):
+        load(cache, key, [key], 200)
+    check(len(cache.entries) == 3 and "a" not in cache.entries, "least recently used entry is dropped")
+    stats = cache.stats()
+    check(stats["saved"] == stats["hits"] + stats["shared"] == 7, "saved round trips")
+    print(f"self-check ok: {stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=30)
+    parser.add_argument("--files", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=1000, help="Files located by the client")
+    parser.add_argument("--missing", type=float, default=0.1, help="Share of requests for files nobody has")
+    parser.add_argument("--threads", type=int, default=8, help="Clients locating files in parallel")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    self_check()
+    run(args.nodes, args.files, args.requests, args.missing, args.threads, args.seed)
@@ -0,0 +1,152 @@
+# Cost of the metrics on the hot paths: download MB/s with 1 KB chunks (every chunk counted)
+# and DHT lookups per second, with the metrics enabled and disabled. Then the stats endpoint
+# of a peer during a download: the snapshot it serves, and a profile and an allocation
+# trace switched on and off while the download runs.
+# Also checks the histograms, the rates and the snapshot file
+import argparse
+import json
+import os
+import tempfile
+import threading
+from time import perf_counter
+from urllib.request import urlopen
+from urllib.error import HTTPError
+
+from loopback import check, enter_workdir, free_port, add_file, start_seeder, same_content, peer_module
+from DHT_node import DHTNode, name_key
+from metrics import Metrics, Histogram, metrics
+from stats_server import StatsServer
+
+
+def get(port, path):
+    try:
+        with urlopen(f"http://127.0.0.1:{port}{path}") as response:
+            return response.status, response.read().decode()
+    except HTTPError as e:
+        return e.code, e.read().decode()
+
+
+def download(downloader, peers, original, name):
+    target = f"./{downloader.address}/{name}"
+    if os.path.exists(target):
+        os.remove(target)
+    start = perf_counter()
+    downloader.fetch_file(peers, name, progress=False)
+    elapsed = perf_counter() - start
+    if not same_content(original, target):
+        raise Exception("Downloaded file differs from the original")
+    return elapsed
+
+
+def run(nodes, size_mb, lookups, rounds):
+    enter_workdir()
+    network = [DHTNode("127.0.0.1", free_port()) for _ in range(nodes)]
+    for node in network:
+        node.start()
+    with open("./well_known_nodes.txt", "w") as file:
+        for node in network[:2]:
+            file.write(f"{('127.0.0.1', node.port)}\n")
+    for node in network[1:]:
+        node.bootstrap([("127.0.0.1", network[0].port)])
+    for number in range(100):
+        network[number % nodes].announce_peer(name_key(f"file{number}"), "127.0.0.1", 1000 + number)
+
+    seeder = start_seeder()
+    original = add_file(seeder, "bench.bin", int(size_mb * 1024 * 1024))
+    downloader = peer_module.Peer(free_port(), free_port())
+    downloader.chunk_size = peer_module.MSS
+    peers = [(peer_module.IP, seeder.port)]
+    downloader.get_file_size(peers, "bench.bin")
+    downloader.get_manifest(peers, downloader.files_root["bench.bin"])
+
+    print(f"{'metrics':>8} {'MB/s (1 KB chunks)':>19} {'lookups/s':>10}")
+    client = network[-1]
+    for enabled in (False, True, False, True):
+        metrics.enabled = enabled
+        best = max(size_mb / download(downloader, peers, original, "bench.bin") for _ in range(rounds))
+        start = perf_counter()
+        for number in range(lookups):
+            client.find_peers(name_key(f"file{number % 100}"))
+        rate = lookups / (perf_counter() - start)
+        print(f"{'on' if enabled else 'off':>8} {best:19.2f} {rate:10.0f}")
+
+    # The stats endpoint of the downloader after a download and lookups, seeder included as it runs in this process
+    metrics.reset()
+    downloader.register_metrics()
+    stats = StatsServer(free_port())
+    stats.start()
+    downloader.chunk_size = peer_module.CHUNK_SIZE
+    elapsed = download(downloader, peers, original, "bench.bin")
+    for number in range(lookups):
+        downloader.node.find_peers(name_key(f"file{number % 100}"))
+    snapshot = json.loads(get(stats.port, "/stats")[1])
+    histograms, counters, gauges = snapshot["histograms"], snapshot["counters"], snapshot["gauges"]
+    print(f"\n/stats after a {size_mb} MB download in {elapsed:.2f}s and {lookups} lookups:")
+    print(f"  received {counters['peer.bytes_received'] / 1024 / 1024:.1f} MB in {counters['peer.chunks_received']} chunks, "
+          f"{counters.get('peer.retransmits', 0)} retransmits")
+    for name in ("dht.find_peers", "dht.query_rtt", "dht.handle_message", "dht.find_closest_nodes", "peer.serve_request"):
+        summary = histograms[name]
+        print(f"  {name:>22}: {summary['count']:6d} x, p50 {summary['p50_ms']:8.3f} ms, p99 {summary['p99_ms']:8.3f} ms")
+    print(f"  contacts {gauges['dht.contacts']}, stored peers {gauges['dht.stored_peers']}, "
+          f"upload queue {gauges['peer.upload_queue']}")
+
+    # Profile and allocations of the next download, switched on and off through the endpoint
+    get(stats.port, "/profile/start")
+    get(stats.port, "/memory/start")
+    download(downloader, peers, original, "bench.bin")
+    _, profile = get(stats.port, "/profile/stop?top=8")
+    _, memory = get(stats.port, "/memory/stop?top=5")
+    print(f"\n/profile/stop:\n{profile}\n/memory/stop:\n{memory}")
+    stats.stop()
+
+
+# Percentiles within a factor of two, rates since the previous snapshot, gauges, disabled
+# metrics, the snapshot file and the capture switches
+def self_check():
+    histogram = Histogram()
+    for _ in range(98):
+        histogram.add(0.001)
+    histogram.add(0.5)
+    histogram.add(0.7)
+    check(0.001 <= histogram.percentile(0.5) < 0.002 and 0.5 <= histogram.percentile(0.99) <= 0.7, "percentiles")
+    check(histogram.summary()["max_ms"] == 700, "max")
+
+    registry = Metrics()
+    registry.snapshot(now=100)
+    registry.count("sent", 50)
+    registry.gauge("depth", lambda: 7)
+    registry.gauge("broken", lambda: 1 / 0)
+    snapshot = registry.snapshot(now=110)
+    check(snapshot["rates"]["sent"] == 5 and snapshot["gauges"]["depth"] == 7, f"rates and gauges {snapshot}")
+    check(snapshot["gauges"]["broken"].startswith("error"), "a failing gauge is reported")
+    registry.enabled = False
+    registry.count("sent")
+    registry.observe("latency", 0.1)
+    check(registry.counters["sent"] == 50 and "latency" not in registry.histograms, "disabled metrics")
+
+    path = os.path.join(tempfile.mkdtemp(prefix="p2p-bench-"), "stats.json")
+    stats = StatsServer(free_port(), path, registry=registry)
+    stats.write_snapshot()
+    with open(path) as file:
+        check(json.load(file)["counters"]["sent"] == 50, "snapshot file")
+    stats.start()
+    check(get(stats.port, "/profile/stop")[0] == 409 and get(stats.port, "/nothing")[0] == 404, "errors")
+    check(get(stats.port, "/profile/start?interval=0.001")[0] == 200, "profile start")
+    busy = threading.Thread(target=lambda: sum(i * i for i in range(2000000)))
+    busy.start()
+    busy.join()
+    status, report = get(stats.port, "/profile/stop")
+    check(status == 200 and "<genexpr>" in report, f"profile report {report}")
+    stats.stop()
+    print("self-check ok: histograms, rates, gauges, snapshot file, capture switches")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=20)
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    self_check()
+    run(args.nodes, args.size_mb, args.lookups, args.rounds)
@@ -0,0 +1,164 @@
+# Startup and rescans of a peer storage of many files with the persistent share index:
+#  - the index built from scratch, hashed in the scanning thread and by the process pool
+#  - a seeder restart without the index (every file hashed and announced again, as before)
+#    and with it (files stat()ed, nothing hashed, announcements still fresh are not repeated)
+#  - a rescan after files were added, changed and removed: what is hashed and announced
+#  - a file dropped into the storage of a running peer: seconds until the DHT finds it
+# Also checks the index against manifests built directly, across reloads and changes
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+from time import perf_counter, sleep
+
+from loopback import check, enter_workdir, free_port, make_file, peer_module
+from DHT_node import DHTNode, name_key
+from manifest import Manifest
+import share_index
+from share_index import ShareIndex, INDEX_SUFFIX
+from wire import SIZEOF, encode_message
+
+# Keys announced by bulk announces, counted by a wrapper of DHTNode.bulk_announce
+announced_keys = []
+bulk_announce = DHTNode.bulk_announce
+
+
+def counting_bulk_announce(node, keys, ip, port, remember=True):
+    announced_keys.extend(keys)
+    return bulk_announce(node, keys, ip, port, remember)
+
+
+DHTNode.bulk_announce = counting_bulk_announce
+
+
+# The port is free again once the dispatcher, woken up by a datagram (a response nobody waits for), has left its poll
+def stop(peer):
+    peer.dispatcher.stop()
+    peer.socket.close()
+    peer.seed_cache.close()
+    peer.node.running = False
+    peer.node.socket.close()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.sendto(encode_message(SIZEOF, 0), ("127.0.0.1", peer.port))
+    peer.dispatcher.thread.join()
+
+
+# Seconds until a new peer on `port` announced its storage, and the keys it announced
+def start_seeder(port):
+    announced_keys.clear()
+    start = perf_counter()
+    peer = peer_module.Peer(port, free_port())
+    peer.announcer.join()
+    return peer, perf_counter() - start, len(announced_keys)
+
+
+def run(files, size_mb, network):
+    enter_workdir()
+    nodes = [DHTNode("127.0.0.1", free_port()) for _ in range(network)]
+    for node in nodes:
+        node.start()
+    with open("./well_known_nodes.txt", "w") as file:
+        for node in nodes[:2]:
+            file.write(f"{('127.0.0.1', node.port)}\n")
+    for node in nodes[1:]:
+        node.bootstrap([("127.0.0.1", nodes[0].port)])
+
+    port = free_port()
+    storage = f"./{peer_module.IP}:{port}"
+    size = int(size_mb * 1024 * 1024)
+    for number in range(files):
+        make_file(port, f"file{number}.bin", size)
+    print(f"{files} files of {size_mb} MB, {os.cpu_count()} CPUs")
+
+    for workers in sorted({1, share_index.HASH_WORKERS}):
+        index = ShareIndex(storage, peer_module.MSS, path=tempfile.mkdtemp(prefix="p2p-index-"), workers=workers)
+        start = perf_counter()
+        index.scan()
+        elapsed = perf_counter() - start
+        print(f"index built by {workers} process{'es' if workers > 1 else ''}: {elapsed:.2f}s, {files * size_mb / elapsed:.0f} MB/s")
+        shutil.rmtree(index.path)
+
+    print(f"\n{'seeder start':>24} {'seconds':>8} {'keys announced':>15}")
+    peer, elapsed, keys = start_seeder(port)
+    print(f"{'first, no index':>24} {elapsed:8.2f} {keys:15d}")
+    stop(peer)
+    shutil.rmtree(storage + INDEX_SUFFIX)
+    peer, elapsed, keys = start_seeder(port)
+    print(f"{'restart without index':>24} {elapsed:8.2f} {keys:15d}")
+    stop(peer)
+    peer, elapsed, keys = start_seeder(port)
+    print(f"{'restart with index':>24} {elapsed:8.2f} {keys:15d}")
+
+    # A few files added, one changed and one removed, then a rescan
+    for number in range(files, files + 3):
+        make_file(port, f"file{number}.bin", size)
+    make_file(port, "file0.bin", size)
+    os.remove(f"{storage}/file1.bin")
+    announced_keys.clear()
+    start = perf_counter()
+    peer.announce_files(peer.share_changes())
+    print(f"\nrescan after 3 added, 1 changed, 1 removed: {perf_counter() - start:.2f}s, {len(announced_keys)} keys announced, "
+          f"{sum('file1.bin' == name for name in peer.share_index.names())} removed file left in the index")
+    stop(peer)
+
+    # A file dropped into the storage of a running peer, found through another node
+    peer_module.SCAN_INTERVAL = 0.5
+    peer, _, _ = start_seeder(port)
+    make_file(port, "dropped.bin", size)
+    start = perf_counter()
+    while not nodes[-1].find_peers(name_key("dropped.bin")):
+        sleep(0.05)
+    print(f"file dropped into a running peer's storage found in the DHT after {perf_counter() - start:.2f}s "
+          f"(scanned every {peer_module.SCAN_INTERVAL}s)")
+    stop(peer)
+
+
+# The indexed manifests are those built from the files, in the scanning thread and in the
+# pool, and survive a reload; changed and removed files are found, unchanged ones not hashed again
+def self_check():
+    directory = tempfile.mkdtemp(prefix="p2p-bench-")
+    contents = {"a": os.urandom(300000), "b": os.urandom(5000), "empty": b""}
+    for name, data in contents.items():
+        with open(f"{directory}/{name}", "wb") as file:
+            file.write(data)
+    with open(f"{directory}/partial", "wb") as file, open(f"{directory}/partial.journal", "wb"):
+        file.write(b"x")
+    index = ShareIndex(directory, 1024)
+    changed, removed = index.scan()
+    check(sorted(changed) == ["a", "b", "empty"] and not removed, f"first scan {changed} {removed}")
+    for name, data in contents.items():
+        version = share_index.file_version(os.stat(f"{directory}/{name}"))
+        check(index.manifest(name, version).root == Manifest.build(data, 1024).root, f"manifest of {name}")
+
+    # Hashed by two processes in slices of 64 KB, a file size that is not a multiple of it
+    slice_size, pool_min = share_index.HASH_SLICE, share_index.POOL_MIN_BYTES
+    share_index.HASH_SLICE, share_index.POOL_MIN_BYTES = 64 << 10, 0
+    pooled = ShareIndex(directory, 1024, path=tempfile.mkdtemp(prefix="p2p-index-"), workers=2)
+    pooled.scan()
+    share_index.HASH_SLICE, share_index.POOL_MIN_BYTES = slice_size, pool_min
+    check(pooled.roots().keys() == index.roots().keys(), "pool hashes differ")
+
+    reloaded = ShareIndex(directory, 1024)
+    check(reloaded.scan() == ([], []) and reloaded.unannounced() == index.names(), "reload")
+    reloaded.announced(["a", "b"], now=100)
+    old_root = reloaded.root("b")
+    with open(f"{directory}/a", "r+b") as file:
+        file.write(b"changed")
+    os.remove(f"{directory}/b")
+    changed, removed = reloaded.scan()
+    check(changed == ["a"] and removed == [("b", old_root)], f"changes {changed} {removed}")
+    check(sorted(reloaded.unannounced(50)) == ["a", "empty"], "a changed file is announced again")
+    check(not os.path.exists(f"{reloaded.path}/{old_root}.manifest"), "manifest of a removed file kept")
+    check(ShareIndex(directory, 2048).names() == [], "index of another chunk size used")
+    print("self-check ok: manifests, pool slices, reload, changed and removed files")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=64)
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--nodes", type=int, default=10)
+    args = parser.parse_args()
+    self_check()
+    run(args.files, args.size_mb, args.nodes)
@@ -0,0 +1,360 @@
+# Swarm simulation on loopback: N DHT nodes and M peers, in this process or spread over a pool
+# of processes, every datagram going through a link with loss and latency (udp_shim.py). The
+# first peers seed files of the given size, then a workload runs: DHT lookups of the seeded
+# files from random nodes and downloads by groups of peers at once. The report (JSON) gives
+# the join time of the nodes, lookup latency and success, transfer MB/s and the CPU and
+# memory of every process per node. Compared with a previous report (--baseline), slower
+# results beyond the tolerance are listed and the exit status is 1.
+# Also checks the link
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+from hashlib import sha1
+from threading import Thread
+from time import perf_counter, process_time
+
+from loopback import check, enter_workdir, free_port, make_file, peer_module
+from DHT_node import DHTNode, name_key
+import udp_shim
+
+
+# Same bytes for a file name in every process
+def content(name, size):
+    return random.Random(name).randbytes(size)
+
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+    return {"count": len(samples), "mean_ms": sum(samples) / len(samples) * 1000,
+            "p50_ms": samples[len(samples) // 2] * 1000, "p99_ms": samples[int(len(samples) * 0.99)] * 1000,
+            "max_ms": samples[-1] * 1000}
+
+
+# Resident memory of this process
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# The DHT nodes and peers of one process
+class Host:
+    def __init__(self, workdir, loss, latency, jitter, seed):
+        os.chdir(workdir)
+        # The peers print their progress, stdout is kept for the report
+        sys.stdout = sys.stderr
+        self.link = udp_shim.Link(loss, latency, jitter, seed)
+        udp_shim.install(self.link)
+        self.random = random.Random(seed)
+        self.nodes = []
+        self.peers = []
+        self.started = process_time()
+
+    # Start nodes joining through `bootstrap`, returns [(port, seconds to join)]
+    def start_nodes(self, count, bootstrap):
+        joined = []
+        for _ in range(count):
+            node = DHTNode("127.0.0.1", free_port())
+            node.start()
+            start = perf_counter()
+            if bootstrap:
+                node.bootstrap(bootstrap)
+            joined.append((node.port, perf_counter() - start))
+            self.nodes.append(node)
+        return joined
+
+    # Start peers seeding `files` [(name, size)], they join through well_known_nodes.txt.
+    # Returns the seconds every peer took to start
+    def start_peers(self, count, files):
+        started = []
+        for _ in range(count):
+            port = free_port()
+            for name, size in files:
+                make_file(port, name, size, content(name, size))
+            start = perf_counter()
+            peer = peer_module.Peer(port, free_port())
+            started.append(perf_counter() - start)
+            self.peers.append(peer)
+        return started
+
+    # Wait for the seeding peers to have announced their files
+    def announced(self):
+        for peer in self.peers:
+            peer.announcer.join()
+
+    # `count` lookups of random keys from random nodes: [(seconds, found)]
+    def lookups(self, count, keys):
+        results = []
+        for _ in range(count):
+            node = self.random.choice(self.nodes)
+            key = name_key(self.random.choice(keys))
+            start = perf_counter()
+            found = node.find_peers(key)
+            results.append((perf_counter() - start, bool(found)))
+        return results
+
+    # The peers at `indices` download `name` at once: [(seconds, intact)]
+    def downloads(self, indices, name, size):
+        results = {}
+        expected = sha1(content(name, size)).digest()
+
+        def download(index):
+            peer = self.peers[index]
+            start = perf_counter()
+            try:
+                peer.download_file(name, progress=False)
+                with open(f"./{peer.address}/{name}", "rb") as file:
+                    results[index] = (perf_counter() - start, sha1(file.read()).digest() == expected)
+            except Exception:
+                results[index] = (perf_counter() - start, False)
+
+        threads = [Thread(target=download, args=(index,)) for index in indices]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [results[index] for index in indices]
+
+    def usage(self):
+        return {"cpu_s": process_time() - self.started, "rss_mb": rss_mb(), "nodes": len(self.nodes),
+                "peers": len(self.peers), "link": self.link.stats()}
+
+    def stop(self):
+        for peer in self.peers:
+            peer.dispatcher.stop()
+            peer.socket.close()
+            peer.seed_cache.close()
+            peer.node.running = False
+            peer.node.socket.close()
+        for node in self.nodes:
+            node.running = False
+            node.socket.close()
+
+
+# Host in a process of its own, driven through a pipe
+def serve_host(conn, args):
+    host = Host(*args)
+    while True:
+        method, call_args = conn.recv()
+        try:
+            result = getattr(host, method)(*call_args)
+        except Exception as e:
+            result = e
+        conn.send(result)
+        if method == "stop":
+            conn.close()
+            # The DHT threads of the process are left as they are
+            os._exit(0)
+
+
+class RemoteHost:
+    def __init__(self, *args):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve_host, args=(child, args), daemon=True)
+        self.process.start()
+
+    def call(self, method, *args):
+        self.conn.send((method, args))
+        result = self.conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def __getattr__(self, method):
+        return lambda *args: self.call(method, *args)
+
+
+# Call `method` on every host at once, [(host, result)]
+def on_all(calls):
+    results = [None] * len(calls)
+
+    def call(number, host, method, args):
+        results[number] = getattr(host, method)(*args)
+
+    threads = [Thread(target=call, args=(number, *spec)) for number, spec in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# Items spread over `parts` as evenly as possible
+def spread(items, parts):
+    return [items[part::parts] for part in range(parts)]
+
+
+def simulate(nodes, peers, seeders, files, size, workload, processes, loss, latency, jitter, seed):
+    workdir = enter_workdir()
+    link = (loss, latency, jitter)
+    if processes > 1:
+        hosts = [RemoteHost(workdir, *link, seed + number) for number in range(processes)]
+    else:
+        hosts = [Host(workdir, *link, seed)]
+    names = [f"file{number}.bin" for number in range(files)]
+    start = perf_counter()
+
+    # The first two nodes are the well-known ones, the others join through them
+    first = hosts[0].start_nodes(2, [])
+    well_known = [("127.0.0.1", port) for port, _ in first]
+    with open("./well_known_nodes.txt", "w") as file:
+        for addr in well_known:
+            file.write(f"{addr}\n")
+    joins = [seconds for host_joins in on_all([(host, "start_nodes", (len(share), well_known))
+                                               for host, share in zip(hosts, spread(list(range(nodes - 2)), len(hosts)))])
+             for _, seconds in host_joins]
+    setup = {"nodes_seconds": perf_counter() - start}
+
+    # Seeders first, on every host, then the downloading peers
+    seeding = spread(list(range(seeders)), len(hosts))
+    on_all([(host, "start_peers", (len(share), [(name, size) for name in names])) for host, share in zip(hosts, seeding)])
+    on_all([(host, "announced", ()) for host in hosts])
+    clients = spread(list(range(peers - seeders)), len(hosts))
+    peer_starts = on_all([(host, "start_peers", (len(share), [])) for host, share in zip(hosts, clients)])
+    setup["peers_seconds"] = perf_counter() - start - setup["nodes_seconds"]
+    # Client number -> (host, index of its peer there)
+    client_peers = []
+    for number, (host, share) in enumerate(zip(hosts, clients)):
+        client_peers += [(host, len(seeding[number]) + position) for position in range(len(share))]
+    client_peers.sort(key=lambda item: item[1])
+
+    report = {"config": {"nodes": nodes, "peers": peers, "seeders": seeders, "files": files, "size": size,
+                         "processes": processes, "loss": loss, "latency_ms": latency * 1000, "jitter_ms": jitter * 1000},
+              "join": percentiles(joins), "peer_start": percentiles([s for host in peer_starts for s in host]),
+              "setup": setup, "steps": []}
+    used = 0
+    for step in workload:
+        if "lookups" in step:
+            shares = spread(list(range(step["lookups"])), len(hosts))
+            results = [result for host in on_all([(host, "lookups", (len(share), names)) for host, share in zip(hosts, shares)])
+                       for result in host]
+            report["steps"].append({"lookups": step["lookups"], "latency": percentiles([s for s, _ in results]),
+                                    "found": sum(found for _, found in results) / max(1, len(results))})
+        elif "download" in step:
+            count = min(step.get("clients", 1), len(client_peers) - used)
+            group = client_peers[used:used + count]
+            used += count
+            by_host = {}
+            for host, index in group:
+                by_host.setdefault(id(host), (host, []))[1].append(index)
+            started = perf_counter()
+            results = [result for host in on_all([(host, "downloads", (indices, step["download"], size))
+                                                  for host, indices in by_host.values()]) for result in host]
+            elapsed = perf_counter() - started
+            intact = sum(ok for _, ok in results)
+            report["steps"].append({"download": step["download"], "clients": count, "seconds": elapsed, "intact": intact,
+                                    "total_mb_s": intact * size / (1024 * 1024) / elapsed,
+                                    "client": percentiles([s for s, ok in results if ok])})
+
+    usages = on_all([(host, "usage", ()) for host in hosts])
+    for usage in usages:
+        members = max(1, usage["nodes"] + usage["peers"])
+        usage["cpu_s_per_node"] = usage["cpu_s"] / members
+        usage["rss_mb_per_node"] = usage["rss_mb"] / members
+    report["processes"] = usages
+    on_all([(host, "stop", ()) for host in hosts])
+    return report
+
+
+# Values of a report compared with a baseline: (path, larger is better)
+COMPARED = [(("join", "p50_ms"), False), (("join", "p99_ms"), False)]
+
+
+# Slower or costlier results than in `baseline` by more than `tolerance`
+def regressions(report, baseline, tolerance):
+    found = []
+
+    def compare(name, value, old, larger_is_better):
+        if old and (value < old * (1 - tolerance) if larger_is_better else value > old * (1 + tolerance)):
+            found.append(f"{name}: {old:.3f} -> {value:.3f}")
+
+    for path, larger_is_better in COMPARED:
+        compare(".".join(path), report[path[0]][path[1]], baseline[path[0]].get(path[1]), larger_is_better)
+    for number, (step, old) in enumerate(zip(report["steps"], baseline["steps"])):
+        if "latency" in step and "latency" in old:
+            compare(f"steps[{number}].latency.p50_ms", step["latency"]["p50_ms"], old["latency"].get("p50_ms"), False)
+            compare(f"steps[{number}].found", step["found"], old["found"], True)
+        if "total_mb_s" in step and "total_mb_s" in old:
+            compare(f"steps[{number}].total_mb_s", step["total_mb_s"], old["total_mb_s"], True)
+    cpu = sum(usage["cpu_s"] for usage in report["processes"])
+    old_cpu = sum(usage["cpu_s"] for usage in baseline["processes"])
+    compare("cpu_s", cpu, old_cpu, False)
+    return found
+
+
+# The link drops about the given share of datagrams and delivers the others after the latency
+def self_check():
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(("127.0.0.1", 0))
+    receiver.settimeout(0.1)
+    link = udp_shim.Link(loss=0.2, latency=0.02, seed=1)
+    sender = udp_shim.ShimSocket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM), link)
+    start = perf_counter()
+    first = None
+    received = 0
+    # In bursts the receive buffer could not hold every datagram
+    for burst in range(10):
+        for number in range(50):
+            sender.sendto(number.to_bytes(4, "big"), receiver.getsockname())
+        try:
+            while True:
+                receiver.recvfrom(16)
+                first = first or perf_counter() - start
+                received += 1
+        except socket.timeout:
+            pass
+    check(350 < received < 450 and link.dropped == 500 - received, f"loss: {received} of 500 received")
+    check(first >= 0.02, f"latency: first datagram after {first * 1000:.1f} ms")
+    sender.close()
+    receiver.close()
+    print(f"self-check ok: {received} of 500 datagrams through a 20% loss link, first after {first * 1000:.0f} ms",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=50, help="DHT nodes, besides those of the peers")
+    parser.add_argument("--peers", type=int, default=12)
+    parser.add_argument("--seeders", type=int, default=4, help="Peers seeding every file")
+    parser.add_argument("--files", type=int, default=2)
+    parser.add_argument("--size-mb", type=float, default=1)
+    parser.add_argument("--processes", type=int, default=1, help="Processes the nodes and peers are spread over")
+    parser.add_argument("--loss", type=float, default=0.0, help="Share of the datagrams dropped")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="One-way latency of every datagram")
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--workload", type=str, required=False,
+                        help='JSON list of steps, e.g. [{"lookups": 200}, {"download": "file0.bin", "clients": 4}]')
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--report", type=str, required=False, help="Also write the report to this file")
+    parser.add_argument("--baseline", type=str, required=False, help="Previous report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Change from the baseline counted as a regression")
+    args = parser.parse_args()
+    self_check()
+    clients = args.peers - args.seeders
+    if args.workload:
+        with open(args.workload) as file:
+            workload = json.load(file)
+    else:
+        workload = [{"lookups": args.lookups}]
+        workload += [{"download": f"file{number}.bin", "clients": clients // args.files} for number in range(args.files)]
+    report = simulate(args.nodes, args.peers, args.seeders, args.files, int(args.size_mb * 1024 * 1024), workload,
+                      args.processes, args.loss, args.latency_ms / 1000, args.jitter_ms / 1000, args.seed)
+    if args.baseline:
+        with open(args.baseline) as file:
+            report["regressions"] = regressions(report, json.load(file), args.tolerance)
+    output = json.dumps(report, indent=1)
+    if args.report:
+        with open(args.report, "w") as file:
+            file.write(output + "\n")
+    print(output, file=sys.__stdout__)
+    sys.exit(1 if report.get("regressions") else 0)
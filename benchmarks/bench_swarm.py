@@ -0,0 +1,72 @@
+# Downloads one file from a swarm of throttled seeders (some slow, some dead) and
+# compares the achieved rate with the combined capacity of the seeders
+import argparse
+import os
+from time import time, sleep
+
+from loopback import enter_workdir, free_port, make_file, peer_module
+
+
+# Serves requests at no more than `rate` packets per second
+def serve_throttled(seeder, rate):
+    handle_request = seeder.handle_request
+
+    def throttled(*args):
+        sleep(1 / rate)
+        return handle_request(*args)
+
+    seeder.dispatcher.handler = throttled
+
+
+def run(size_mb, seeders, slow, dead, rate):
+    enter_workdir()
+    size = int(size_mb * 1024 * 1024)
+    content = os.urandom(size)
+    peers = []
+    capacity = 0.0
+    for i in range(seeders):
+        # The file is in the storage before the seeder starts, so its startup scan indexes it
+        port = free_port()
+        make_file(port, "swarm.bin", size, content)
+        seeder = peer_module.Peer(port, free_port())
+        if i < dead:
+            seeder.dispatcher.handler = lambda *args: None # never answers
+        elif i < dead + slow:
+            serve_throttled(seeder, rate / 10)
+            capacity += rate / 10
+        else:
+            serve_throttled(seeder, rate)
+            capacity += rate
+        peers.append((peer_module.IP, seeder.port))
+
+    downloader = peer_module.Peer(free_port(), free_port())
+    # Seeders are throttled per request, so every request is a single MSS chunk
+    downloader.chunk_size = peer_module.MSS
+    downloader.get_file_size(peers[dead:], "swarm.bin")
+    start = time()
+    downloader.get_manifest(peers, downloader.files_root["swarm.bin"])
+    manifest_elapsed = time() - start
+    start = time()
+    downloader.fetch_file(peers, "swarm.bin")
+    elapsed = time() - start
+
+    target = f"./{downloader.address}/swarm.bin"
+    with open(target, "rb") as file:
+        if file.read() != content:
+            raise Exception("Downloaded file differs from the original")
+
+    capacity_mb = capacity * peer_module.MSS / (1024 * 1024)
+    print(f"seeders: {seeders} ({slow} slow, {dead} dead), capacity {capacity_mb:.2f} MB/s")
+    print(f"manifest: {manifest_elapsed:.2f}s")
+    print(f"download: {size_mb / elapsed:.2f} MB/s in {elapsed:.2f}s ({100 * size_mb / elapsed / capacity_mb:.0f}% of capacity)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--seeders", type=int, default=20)
+    parser.add_argument("--slow", type=int, default=4)
+    parser.add_argument("--dead", type=int, default=1)
+    parser.add_argument("--rate", type=float, default=200, help="packets per second of a normal seeder")
+    args = parser.parse_args()
+    run(args.size_mb, args.seeders, args.slow, args.dead, args.rate)
@@ -0,0 +1,174 @@
+# One aggressive downloader (a large window of requests) and several polite ones (a small
+# window) share a seeder limited to a fixed upload rate. The seeder runs in its own process
+# and serves in arrival order as before, or through the upload scheduler: fair queuing, with
+# a per-client rate, and with a small queue that drops load. Reports the rate every client got,
+# Jain's fairness index over the clients, and the queue depth and drops of the seeder.
+# Also checks the scheduler itself
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+from time import time, sleep
+
+from loopback import check, enter_workdir, free_port, make_file, peer_module
+
+import async_runtime
+from token_bucket import TokenBucket
+from upload_scheduler import UploadScheduler, QUANTUM
+from wire import GET, SIZE, encode_get
+
+
+# The clients ask for single datagrams instead of whole chunks, the fair queue turns over
+# every few of them as it does every chunk for real downloads
+QUANTUM_BYTES = 4 * peer_module.MSS
+
+
+# Seeder process: serves for `duration` seconds, then reports the counters of its upload scheduler
+def serve(mode, port, rate, duration, results):
+    if mode == "arrival order":
+        seeder = peer_module.Peer(port, free_port())
+        seeder.dispatcher.uploads = None
+        # Served as they come, the seeder waits for its rate after every request
+        bucket = TokenBucket(rate)
+        handle_request = seeder.handle_request
+
+        def limited(msg_type, request_id, body, addr):
+            sleep(bucket.delay(time()))
+            bucket.consume(peer_module.MSS)
+            return handle_request(msg_type, request_id, body, addr)
+
+        seeder.dispatcher.handler = limited
+    elif mode == "fair":
+        seeder = peer_module.Peer(port, free_port(), uploads=UploadScheduler(rate, quantum=QUANTUM_BYTES))
+    elif mode == "fair, client rate":
+        seeder = peer_module.Peer(port, free_port(), uploads=UploadScheduler(rate, client_rate=rate / 8, quantum=QUANTUM_BYTES))
+    else:
+        seeder = peer_module.Peer(port, free_port(), uploads=UploadScheduler(rate, max_queued=64, quantum=QUANTUM_BYTES))
+    sleep(duration + 1.5)
+    results.put(seeder.uploads.stats())
+    results.close()
+    results.join_thread()
+    # Peer.shutdown would save and announce, the process only has to end
+    os._exit(0)
+
+
+# Keeps `window` single-datagram requests in flight for `duration` seconds, returns the bytes per second received
+async def client(port, window, duration, file_size):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(async_runtime.PeerProtocol, sock=sock)
+    received = 0
+    deadline = time() + duration
+
+    async def worker():
+        nonlocal received
+        while time() < deadline:
+            offset = random.randrange(file_size // peer_module.MSS) * peer_module.MSS
+            future = protocol.request(GET, encode_get([(offset, peer_module.MSS)], "load.bin"), ("127.0.0.1", port))
+            try:
+                await asyncio.wait_for(future, peer_module.REQUEST_TIMEOUT)
+                received += peer_module.MSS
+            except asyncio.TimeoutError:
+                protocol.cancel(future)
+
+    await asyncio.gather(*(worker() for _ in range(window)))
+    transport.close()
+    return received / duration
+
+
+# Jain's fairness index: 1 when every client gets the same rate, 1/n when one gets everything
+def jain(rates):
+    return sum(rates) ** 2 / (len(rates) * sum(rate * rate for rate in rates)) if any(rates) else 0.0
+
+
+async def run(polite, window, greedy_window, rate_mb, duration):
+    enter_workdir()
+    port = free_port()
+    file_size = 4 * 1024 * 1024
+    make_file(port, "load.bin", file_size)
+    rate = rate_mb * 1024 * 1024
+    print(f"seeder limited to {rate_mb} MB/s, 1 client with {greedy_window} requests in flight, {polite} with {window}")
+    print(f"{'serving':>18} {'greedy MB/s':>12} {'polite MB/s':>12} {'min polite':>11} {'fairness':>9} {'peak queue':>11} {'dropped':>8}")
+    for mode in ("arrival order", "fair", "fair, client rate", "fair, small queue"):
+        results = multiprocessing.Queue()
+        seeder = multiprocessing.Process(target=serve, args=(mode, port, rate, duration, results), daemon=True)
+        seeder.start()
+        sleep(0.5)
+        rates = await asyncio.gather(client(port, greedy_window, duration, file_size),
+                                     *(client(port, window, duration, file_size) for _ in range(polite)))
+        stats = results.get()
+        seeder.join()
+        mb = [rate / (1024 * 1024) for rate in rates]
+        print(f"{mode:>18} {mb[0]:12.2f} {sum(mb[1:]) / polite:12.3f} {min(mb[1:]):11.3f} {jain(rates):9.2f} "
+              f"{stats['peak']:11d} {stats['dropped']:8d}")
+
+
+def get(length):
+    return GET, 0, encode_get([(0, length)], "load.bin")
+
+
+# Served bytes per client from a scheduler until nothing more is released
+def drain(uploads, now, limit=10000):
+    served = {}
+    for _ in range(limit):
+        request, _ = uploads.next(now)
+        if request is None:
+            break
+        addr = request[3]
+        served[addr] = served.get(addr, 0) + uploads.cost(request[0], request[2])
+    return served
+
+
+# Equal bytes per round for clients asking for large and small chunks, a client over its
+# rate waits while the others are served, a full queue drops from the longest one
+def self_check():
+    uploads = UploadScheduler()
+    for _ in range(40):
+        uploads.push(*get(QUANTUM), ("10.0.0.1", 1))
+    for _ in range(400):
+        uploads.push(*get(QUANTUM // 16), ("10.0.0.2", 1))
+    served = {}
+    for _ in range(16 + 160):
+        request, _ = uploads.next(0)
+        served[request[3]] = served.get(request[3], 0) + uploads.cost(request[0], request[2])
+    large, small = served[("10.0.0.1", 1)], served[("10.0.0.2", 1)]
+    check(large > 0 and small > 0 and abs(large - small) <= QUANTUM, f"equal bytes per round: {served}")
+
+    uploads = UploadScheduler(client_rate=100 * 1024)
+    for _ in range(20):
+        uploads.push(*get(10 * 1024), ("10.0.0.1", 1))
+        uploads.push(SIZE, 0, b"load.bin", ("10.0.0.2", 1))
+    now = time()
+    served = drain(uploads, now)
+    check(served[("10.0.0.1", 1)] == 10 * 1024 and served[("10.0.0.2", 1)] == 20 * 64, f"client rate: {served}")
+    check(uploads.next(now)[0] is None and uploads.queued == 19, "a limited client waits for its rate")
+    check(drain(uploads, now + 0.1)[("10.0.0.1", 1)] == 10 * 1024, "the rate refills the client")
+
+    uploads = UploadScheduler(rate=1024 * 1024)
+    uploads.push(*get(1024 * 1024), ("10.0.0.1", 1))
+    uploads.push(*get(1024), ("10.0.0.2", 1))
+    now = time()
+    uploads.push(*get(1024), ("10.0.0.2", 1))
+    check(len(drain(uploads, now)) == 2 and 0.85 < uploads.next(now)[1] < 0.95, "global rate")
+
+    uploads = UploadScheduler(max_queued=10)
+    for _ in range(10):
+        uploads.push(*get(1024), ("10.0.0.1", 1))
+    check(uploads.push(*get(1024), ("10.0.0.2", 1)), "a new client gets room in a full queue")
+    check(not uploads.push(*get(1024), ("10.0.0.1", 1)), "the longest queue loses its newest request")
+    check(uploads.dropped == 2 and uploads.queued == 10, "drop counters")
+    print(f"self-check ok: {uploads.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--polite", type=int, default=8, help="Clients with a small window")
+    parser.add_argument("--window", type=int, default=4, help="Requests in flight of a polite client")
+    parser.add_argument("--greedy-window", type=int, default=256, help="Requests in flight of the aggressive client")
+    parser.add_argument("--rate-mb", type=float, default=2, help="Upload limit of the seeder (MB/s)")
+    parser.add_argument("--duration", type=float, default=3)
+    args = parser.parse_args()
+    self_check()
+    asyncio.run(run(args.polite, args.window, args.greedy_window, args.rate_mb, args.duration))
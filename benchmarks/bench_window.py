@@ -0,0 +1,151 @@
+# Compares MB/s of the stop-and-wait batch download with the sliding-window pipeline on loopback
+import argparse
+import os
+import threading
+from random import randint
+from time import time, perf_counter
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from progress.bar import FillingSquaresBar
+
+from loopback import enter_workdir, free_port, add_file, start_seeder, same_content, peer_module
+from manifest import CorruptChunk
+from event_log import DEBUG
+from metrics import metrics
+from wire import GET, encode_get, decode_data
+
+
+# Configuration constants
+PACKETS_PER_BATCH = 10 # Packets requested at once by the batch download
+
+
+# The download before the sliding window: stop-and-wait in batches of PACKETS_PER_BATCH,
+# one thread per packet. Logs through `peer_module.events`, so benchmarks can swap the log
+def fetch_file_batched(downloader, peers, filename):
+    root = downloader.files_root[filename]
+    manifest = downloader.get_manifest(peers, root)
+    total_packets = manifest.chunks
+    target = downloader.open_target(filename, manifest)
+
+    bar = FillingSquaresBar('Downloading', max=total_packets)
+    bar.goto(target.count)
+
+    # Packets received in the current batch, filled by the packet threads
+    packets = {}
+    packets_lock = threading.Lock()
+
+    for current_packet in range(0, total_packets, PACKETS_PER_BATCH):
+        with packets_lock:
+            packets.clear()
+
+        batch = range(current_packet, min(current_packet + PACKETS_PER_BATCH, total_packets))
+        expected_packets = set(n for n in batch if not target.has(n))
+
+        # Loop until all packets in the batch are received and verified
+        while expected_packets:
+            while True:
+                with packets_lock:
+                    missing = expected_packets - set(packets.keys())
+
+                if not missing:
+                    break
+
+                threads = []
+                for pkt_num in missing:
+                    t = threading.Thread(target=fetch_packet,
+                                         args=(downloader, peers, pkt_num, root, packets, packets_lock))
+                    t.start()
+                    threads.append(t)
+
+                for t in threads:
+                    t.join()
+
+            corrupt = write_packets(packets, target)
+            for _ in expected_packets - corrupt:
+                bar.next()
+            expected_packets = corrupt
+            with packets_lock:
+                packets.clear()
+    target.close()
+    bar.finish()
+    downloader.seed_cache.register(filename, manifest)
+
+
+# Thread of the batch download: fetches a single packet into `packets`
+def fetch_packet(downloader, peers, packet_number, filename, packets, packets_lock):
+    peer_ip, peer_port = peers[randint(0, len(peers) - 1)]
+    peer_port = int(peer_port)
+
+    try:
+        request = encode_get([(packet_number * peer_module.MSS, peer_module.MSS)], filename)
+        start = perf_counter()
+        future = downloader.dispatcher.request(GET, request, (peer_ip, peer_port))
+        try:
+            data, _ = future.result(timeout=peer_module.REQUEST_TIMEOUT)
+        except FutureTimeout:
+            downloader.dispatcher.cancel(future)
+            metrics.count("peer.packet_timeouts")
+            return
+        metrics.observe("peer.packet_rtt", perf_counter() - start)
+        # A single fragment
+        offset, payload = decode_data(data)
+        received_number = offset // peer_module.MSS
+        metrics.count("peer.bytes_received", len(payload))
+
+        if peer_module.events.packet():
+            peer_module.events.log(downloader.log_source, f"Recieved Packet {packet_number} From {peer_ip}:{peer_port}",
+                                   DEBUG, packet=packet_number, sender=f"{peer_ip}:{peer_port}")
+
+        with packets_lock:
+            packets[received_number] = payload
+
+    except Exception as e:
+        print(f"Thread error: {e}")
+
+
+# Writes downloaded packets at their offsets in the preallocated file,
+# returns the packets that failed verification
+def write_packets(packets, target):
+    corrupt = set()
+    for key, packet in packets.items():
+        try:
+            target.write(key, packet)
+        except CorruptChunk:
+            corrupt.add(key)
+    return corrupt
+
+
+def run(size_mb, rounds):
+    enter_workdir()
+    seeder = start_seeder()
+    original = add_file(seeder, "bench.bin", int(size_mb * 1024 * 1024))
+    downloader = peer_module.Peer(free_port(), free_port())
+    peers = [(peer_module.IP, seeder.port)]
+    downloader.get_file_size(peers, "bench.bin")
+    downloader.get_manifest(peers, downloader.files_root["bench.bin"])
+
+    modes = {
+        "batch": lambda peers, filename: fetch_file_batched(downloader, peers, filename),
+        "window": downloader.fetch_file,
+    }
+    for mode, fetch in modes.items():
+        best = 0.0
+        for _ in range(rounds):
+            target = f"./{downloader.address}/bench.bin"
+            if os.path.exists(target):
+                os.remove(target)
+            start = time()
+            fetch(peers, "bench.bin")
+            elapsed = time() - start
+            if not same_content(original, target):
+                raise Exception(f"{mode}: downloaded file differs from the original")
+            best = max(best, size_mb / elapsed)
+        print(f"{mode:>8}: {best:8.2f} MB/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    run(args.size_mb, args.rounds)
@@ -0,0 +1,154 @@
+# Codec microbenchmark of the binary wire protocol against the former pipe-delimited
+# text messages (hex ids, "ip:port" strings): encode/decode rate and size per message.
+# Binary entries are packed once per contact or peer, as the DHT node keeps them.
+# Also checks that PEERS and NODES replies too large for one datagram are truncated
+# safely, on their own and end to end between two DHT nodes on loopback
+import argparse
+import os
+import random
+from time import perf_counter, sleep
+
+from loopback import check, free_port
+import wire
+from DHT_node import DHTNode
+
+
+# Former text encoding of a NODES reply and of a PEERS reply
+def text_nodes(transaction_id, sender_id, contacts):
+    return "|".join(["NODES", str(transaction_id), sender_id.hex()] + [f"{nid.hex()}:{ip}:{port}" for nid, (ip, port) in contacts]).encode()
+
+
+def parse_text_nodes(data):
+    msg = data.decode().split('|')
+    nodes = []
+    for node_info in msg[3:]:
+        nid_hex, ip, port = node_info.split(':')
+        nodes.append((bytes.fromhex(nid_hex), (ip, int(port))))
+    return int(msg[1]), bytes.fromhex(msg[2]), nodes
+
+
+def text_peers(transaction_id, sender_id, key, peers):
+    return "|".join(["PEERS", str(transaction_id), sender_id.hex(), key.hex()] + [f"{ip}:{port}" for ip, port in peers]).encode()
+
+
+def parse_text_peers(data):
+    msg = data.decode().split('|')
+    return int(msg[1]), bytes.fromhex(msg[2]), bytes.fromhex(msg[3]), [(ip, int(port)) for ip, port in (p.split(':') for p in msg[4:])]
+
+
+# Former parsing of a get request: the header split by the dispatcher, then the ranges and file name
+def parse_text_get(data):
+    _, _, body = data.split(b"|", 2)
+    ranges, _, file_name = body.partition(b"|")
+    return [(int(offset), int(length)) for offset, _, length in (part.partition(b"+") for part in ranges.split(b","))], file_name.decode()
+
+
+def binary_nodes(transaction_id, sender_id, packed_contacts):
+    return wire.encode_node_message(wire.NODES, transaction_id, sender_id, wire.encode_contacts(packed_contacts))
+
+
+def parse_binary_nodes(data):
+    _, transaction_id, sender_id, body = wire.decode_node_message(data)
+    return transaction_id, sender_id, wire.decode_contacts(body)
+
+
+def binary_peers(transaction_id, sender_id, key, packed_peers):
+    return wire.encode_node_message(wire.PEERS, transaction_id, sender_id, wire.encode_peers(key, packed_peers))
+
+
+def pack_contacts(contacts):
+    return [wire.pack_contact(node_id, ip, port) for node_id, (ip, port) in contacts]
+
+
+def pack_peers(peers):
+    return [wire.pack_peer(ip, port) for ip, port in peers]
+
+
+def parse_binary_peers(data):
+    _, transaction_id, sender_id, body = wire.decode_node_message(data)
+    key, peers = wire.decode_peers(body)
+    return transaction_id, sender_id, key, peers
+
+
+def random_ip(rng):
+    return ".".join(str(rng.randrange(1, 255)) for _ in range(4))
+
+
+# Operations per second of `function()`
+def rate(function, seconds):
+    count = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        for _ in range(100):
+            function()
+        count += 100
+    return count / (perf_counter() - start)
+
+
+def bench(seconds):
+    rng = random.Random(1)
+    sender_id = os.urandom(20)
+    key = os.urandom(20)
+    contacts = [(os.urandom(20), (random_ip(rng), rng.randrange(1024, 65536))) for _ in range(8)]
+    peers = [(random_ip(rng), rng.randrange(1024, 65536)) for _ in range(50)]
+    packed_contacts = pack_contacts(contacts)
+    packed_peers = pack_peers(peers)
+    cases = [
+        ("NODES x8", lambda: text_nodes(7, sender_id, contacts), parse_text_nodes,
+         lambda: binary_nodes(7, sender_id, packed_contacts), parse_binary_nodes),
+        ("PEERS x50", lambda: text_peers(7, sender_id, key, peers), parse_text_peers,
+         lambda: binary_peers(7, sender_id, key, packed_peers), parse_binary_peers),
+        ("get", lambda: b"get|7|" + ",".join(f"{o}+{n}" for o, n in [(1 << 20, 1 << 18)]).encode() + b"|bench.bin",
+         parse_text_get,
+         lambda: wire.encode_message(wire.GET, 7, wire.encode_get([(1 << 20, 1 << 18)], "bench.bin")),
+         lambda data: wire.decode_get(wire.parse_message(data)[2])),
+    ]
+    print(f"{'message':>10} {'codec':>7} {'bytes':>6} {'encode/s':>10} {'decode/s':>10}")
+    for name, text_encode, text_decode, binary_encode, binary_decode in cases:
+        for codec, encode, decode in (("text", text_encode, text_decode), ("binary", binary_encode, binary_decode)):
+            data = encode()
+            print(f"{name:>10} {codec:>7} {len(data):6d} {rate(encode, seconds):10.0f} {rate(lambda: decode(data), seconds):10.0f}")
+
+
+# Oversized replies fit in one datagram, decode, and only hold entries that were offered
+def self_check():
+    rng = random.Random(2)
+    sender_id = os.urandom(20)
+    key = os.urandom(20)
+
+    peers = [(random_ip(rng), rng.randrange(1024, 65536)) for _ in range(10000)]
+    peers += [(f"2001:db8::{i:x}", 6881) for i in range(1, 101)]
+    data = binary_peers(1, sender_id, key, pack_peers(peers))
+    _, _, decoded_key, decoded = parse_binary_peers(data)
+    check(len(data) <= wire.MAX_DATAGRAM, f"PEERS reply of {len(data)} bytes")
+    check(decoded_key == key and decoded and set(decoded) <= set(peers), "truncated PEERS reply")
+
+    contacts = sorted(((os.urandom(20), (random_ip(rng), 6881)) for _ in range(500)), key=lambda c: c[0])
+    data = binary_nodes(1, sender_id, pack_contacts(contacts))
+    decoded = parse_binary_nodes(data)[2]
+    check(len(data) <= wire.MAX_DATAGRAM, f"NODES reply of {len(data)} bytes")
+    check(decoded == contacts[:len(decoded)], "NODES reply keeps the closest contacts")
+
+    # End to end: a node storing thousands of peers under a key answers with one datagram
+    server = DHTNode("127.0.0.1", free_port())
+    client = DHTNode("127.0.0.1", free_port())
+    server.start()
+    client.start()
+    for ip, port in peers[:5000]:
+        server.store_peer(key, ip, port)
+    client.bootstrap([("127.0.0.1", server.port)])
+    found = client.find_peers(key)
+    check(found and set(found) <= set(peers[:5000]), f"find_peers returned {len(found)} peers")
+    print(f"self-check ok: PEERS reply carries {len(found)} of 5000 peers, NODES reply {len(decoded)} of 500 contacts")
+    server.running = client.running = False
+    server.socket.close()
+    client.socket.close()
+    sleep(0.1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=0.5, help="Measuring time per codec operation")
+    args = parser.parse_args()
+    self_check()
+    bench(args.seconds)
@@ -0,0 +1,183 @@
+# Serving throughput of a seeder and its DHT node run by 1, 2, 4 and 8 worker processes
+# sharing their ports (SO_REUSEPORT). Clients, each in a process of its own, download the
+# same file over and over, then query the DHT port with a window of lookups of a stored key.
+# Reports the MB/s and lookups/s served, and the memory of the workers: their proportional
+# set size counts the pages of the shared file mappings once, split between the workers.
+# Also checks that DHT replies reach the worker whose query they answer and that stored
+# peers reach every worker
+import argparse
+import multiprocessing
+import os
+import socket
+from hashlib import sha1
+from time import perf_counter, sleep, time
+
+from loopback import check, enter_workdir, free_port, make_file, peer_module
+from DHT_node import DHTNode, name_key
+from metrics import metrics
+from workers import WorkerGroup, open_channels
+from wire import FIND_NODE, FIND_PEERS, PEERS, STORE, encode_node_message, decode_node_message, encode_peers, pack_peer
+
+WINDOW = 32 # Lookups in flight per client
+CLIENT_ID = bytes(20)
+
+
+# Downloads `name` from the seeder until `deadline`, starting at `start`. Puts (bytes, seconds, intact)
+def download_client(results, seeder_port, name, digest, start, deadline):
+    peer = peer_module.Peer(free_port(), free_port())
+    peers = [("127.0.0.1", seeder_port)]
+    target = f"./{peer.address}/{name}"
+    peer.get_file_size(peers, name)
+    peer.get_manifest(peers, peer.files_root[name])
+    sleep(max(0.0, start - time()))
+    received = 0
+    intact = True
+    began = perf_counter()
+    while time() < deadline:
+        if os.path.exists(target):
+            os.remove(target)
+        peer.fetch_file(peers, name, progress=False)
+        received += peer.files_bytes[name]
+        with open(target, "rb") as file:
+            intact = intact and sha1(file.read()).digest() == digest
+    results.put((received, perf_counter() - began, intact))
+    results.close()
+    results.join_thread()
+    os._exit(0)
+
+
+# Looks up `key` at the DHT port with WINDOW queries in flight until `deadline`. Puts (replies, seconds, found)
+def lookup_client(results, dht_port, key, start, deadline):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(0.5)
+    query = encode_node_message(FIND_PEERS, 1, CLIENT_ID, key)
+    sleep(max(0.0, start - time()))
+    replies = found = 0
+    began = perf_counter()
+    for _ in range(WINDOW):
+        sock.sendto(query, ("127.0.0.1", dht_port))
+    while time() < deadline:
+        try:
+            data, _ = sock.recvfrom(65536)
+        except socket.timeout:
+            data = None
+        if data is not None:
+            replies += 1
+            found += decode_node_message(data)[0] == PEERS
+        sock.sendto(query, ("127.0.0.1", dht_port))
+    results.put((replies, perf_counter() - began, found))
+    results.close()
+    results.join_thread()
+    os._exit(0)
+
+
+# Runs `count` clients at once, returns their results
+def run_clients(count, target, args, duration):
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    start = time() + 1.0
+    processes = [context.Process(target=target, args=(results, *args, start, start + duration)) for _ in range(count)]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return collected
+
+
+# Proportional set size of a process in MB: its shared pages are split between the processes sharing them
+def pss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as file:
+            for line in file:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float("nan")
+
+
+def run(worker_counts, clients, size_mb, duration):
+    enter_workdir()
+    print(f"{os.cpu_count()} CPUs, {clients} clients, {size_mb} MB file, {duration}s per measure")
+    print(f"{'workers':>8} {'MB/s':>8} {'lookups/s':>10} {'found':>6} {'PSS MB/worker':>14}")
+    for count in worker_counts:
+        seeder_port, dht_port = free_port(), free_port()
+        original = make_file(seeder_port, "bench.bin", int(size_mb * 1024 * 1024))
+        with open(original, "rb") as file:
+            digest = sha1(file.read()).digest()
+        workers = peer_module.start_peer_workers(count, seeder_port, dht_port)
+        # Every worker binds the ports before the clients start, so none of them is moved to another worker
+        sleep(1.0)
+
+        downloads = run_clients(clients, download_client, (seeder_port, "bench.bin", digest), duration)
+        if not all(intact for _, _, intact in downloads):
+            raise Exception("Downloaded file differs from the original")
+        rate = sum(received for received, _, _ in downloads) / max(seconds for _, seconds, _ in downloads) / (1024 * 1024)
+
+        # A stored peer, announced through one worker, is found through all of them
+        key = name_key("bench.bin")
+        announcer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        announcer.sendto(encode_node_message(STORE, 0, CLIENT_ID, encode_peers(key, [pack_peer("127.0.0.1", seeder_port)])),
+                         ("127.0.0.1", dht_port))
+        announcer.close()
+        sleep(0.2)
+        lookups = run_clients(clients, lookup_client, (dht_port, key), duration)
+        replies = sum(replies for replies, _, _ in lookups)
+        lookup_rate = replies / max(seconds for _, seconds, _ in lookups)
+        found = sum(found for _, _, found in lookups) / max(1, replies)
+        memory = sum(pss_mb(worker.pid) for worker in workers) / count
+        print(f"{count:8d} {rate:8.1f} {lookup_rate:10.0f} {found:6.0%} {memory:14.1f}")
+
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
+# Two workers of a group in this process: the replies of eight nodes land on either of them
+# (by a hash of the sender) yet every query of both gets its reply, and a peer stored
+# through the group is known to both
+def self_check():
+    port = free_port()
+    channels = open_channels(2)
+    node_id = os.urandom(20)
+    group = [DHTNode("127.0.0.1", port, group=WorkerGroup(index, 2, node_id, channels)) for index in range(2)]
+    others = [DHTNode("127.0.0.1", free_port()) for _ in range(8)]
+    for node in group + others:
+        node.start()
+    metrics.reset()
+    queries = [node.rpc(FIND_NODE, node.node_id, ("127.0.0.1", other.port)) for node in group for other in others]
+    answered = 0
+    for future, _ in queries:
+        try:
+            future.result(timeout=2)
+            answered += 1
+        except Exception:
+            pass
+    relayed = metrics.counters.get("dht.relayed", 0)
+    check(answered == len(queries), f"{answered} of {len(queries)} queries answered")
+    check(relayed > 0, "no reply reached the other worker")
+    key = name_key("self-check")
+    others[0].send(encode_node_message(STORE, 0, others[0].node_id, encode_peers(key, [pack_peer("127.0.0.1", 4242)])),
+                   ("127.0.0.1", port))
+    sleep(0.2)
+    check(all(node.known_peers(key) == [("127.0.0.1", 4242)] for node in group), "stored peer not on every worker")
+    for node in group + others:
+        node.running = False
+        node.socket.close()
+    for channel in channels:
+        channel.close()
+    print(f"self-check ok: {answered} queries of 2 workers answered, {relayed} replies relayed, stored peer on both")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--duration", type=float, default=3.0, help="Seconds of every measure")
+    args = parser.parse_args()
+    self_check()
+    run(args.workers, args.clients, args.size_mb, args.duration)
@@ -0,0 +1,63 @@
+# Memory and allocation benchmark of the zero-copy data path on a large file:
+# bytes allocated per served packet (scatter-gather vs a joined response) and
+# throughput, traced peak and RSS of a full download
+import argparse
+import resource
+import tracemalloc
+from time import time
+
+from loopback import enter_workdir, free_port, add_file, start_seeder, same_content, peer_module
+from wire import GET, encode_get
+
+
+# Bytes allocated while building `count` single-fragment responses
+def allocated_per_response(seeder, count, total_packets, join):
+    allocated = 0
+    for i in range(count):
+        body = encode_get([((i % total_packets) * peer_module.MSS, peer_module.MSS)], "big.bin")
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        response = list(seeder.handle_request(GET, i, body, None))
+        if join:
+            response = [b"".join(datagram) for datagram in response]
+        allocated += tracemalloc.get_traced_memory()[1] - before
+        del response
+    return allocated / count
+
+
+def run(size_mb, samples):
+    enter_workdir()
+    seeder = start_seeder()
+    original = add_file(seeder, "big.bin", int(size_mb * 1024 * 1024))
+    total_packets = seeder.seed_cache.chunk_count("big.bin")
+
+    tracemalloc.start()
+    for mode, join in (("scatter-gather", False), ("joined bytes", True)):
+        print(f"serve {mode:>15}: {allocated_per_response(seeder, samples, total_packets, join):8.0f} bytes allocated per packet")
+    tracemalloc.stop()
+
+    downloader = peer_module.Peer(free_port(), free_port())
+    peers = [(peer_module.IP, seeder.port)]
+    downloader.get_file_size(peers, "big.bin")
+    downloader.get_manifest(peers, downloader.files_root["big.bin"])
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    start = time()
+    downloader.fetch_file(peers, "big.bin")
+    elapsed = time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if not same_content(original, f"./{downloader.address}/big.bin"):
+        raise Exception("Downloaded file differs from the original")
+    print(f"download {size_mb} MB: {size_mb / elapsed:.2f} MB/s (traced), traced peak {peak / 1024:.0f} KB, max RSS growth {(rss_after - rss_before) / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=float, default=64)
+    parser.add_argument("--samples", type=int, default=10000)
+    args = parser.parse_args()
+    run(args.size_mb, args.samples)
@@ -0,0 +1,59 @@
+import os
+import sys
+import socket
+import tempfile
+
+# Make the project modules importable when running `python benchmarks/<script>.py`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import peer as peer_module
+
+
+# Finds a free UDP port on loopback
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Switches to an empty working directory so peer storages and logs stay isolated
+def enter_workdir():
+    workdir = tempfile.mkdtemp(prefix="p2p-bench-")
+    os.chdir(workdir)
+    open("./well_known_nodes.txt", "w").close()
+    open("./log_file.txt", "w").close()
+    return workdir
+
+
+# Creates a file of `size` random bytes (or the given content) in the storage of a peer on `port`
+def make_file(port, name, size, content=None):
+    storage = f"./{peer_module.IP}:{port}"
+    os.makedirs(storage, exist_ok=True)
+    path = f"{storage}/{name}"
+    with open(path, "wb") as file:
+        file.write(os.urandom(size) if content is None else content)
+    return path
+
+
+# Creates a file in the storage of a running seeder and indexes it, the seeder serves it from then on
+def add_file(seeder, name, size, content=None):
+    path = make_file(seeder.port, name, size, content)
+    seeder.share_changes()
+    return path
+
+
+# Starts a seeding peer with its own DHT node, its dispatcher serves requests in the background
+def start_seeder(port=None):
+    return peer_module.Peer(port or free_port(), free_port())
+
+
+# Checks that a downloaded file matches the original
+def same_content(path_a, path_b):
+    with open(path_a, "rb") as a, open(path_b, "rb") as b:
+        return a.read() == b.read()
+
+
+# Fails a benchmark self-check
+def check(condition, message):
+    if not condition:
+        raise Exception(f"Self-check failed: {message}")
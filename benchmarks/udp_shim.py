@@ -0,0 +1,90 @@
+# Lossy, slow links on loopback: sockets whose outgoing datagrams are dropped with a given
+# probability and delivered after a given one-way latency (plus jitter, which also reorders
+# them). Delayed datagrams are sent by one thread per process at their due time
+import heapq
+import random
+import socket
+from threading import Thread, Condition
+from time import monotonic
+
+import DHT_node
+from loopback import peer_module
+
+
+class Link:
+    def __init__(self, loss=0.0, latency=0.0, jitter=0.0, seed=None):
+        self.loss = loss
+        self.latency = latency # seconds, one way
+        self.jitter = jitter # seconds, uniform in [-jitter, +jitter]
+        self.random = random.Random(seed)
+        self.queue = [] # (due, sequence, socket, datagram, addr)
+        self.sequence = 0
+        self.condition = Condition()
+        self.sent = 0
+        self.dropped = 0
+        self.thread = None
+
+    # Delivery time of a new datagram, None if it is lost
+    def due(self):
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            return None
+        self.sent += 1
+        delay = self.latency + (self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        return monotonic() + max(0.0, delay) if delay > 0 else 0
+
+    def send(self, sock, datagram, addr):
+        due = self.due()
+        if due is None:
+            return
+        if not due:
+            sock.sendto(datagram, addr)
+            return
+        with self.condition:
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.sequence += 1
+            heapq.heappush(self.queue, (due, self.sequence, sock, bytes(datagram), addr))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > monotonic():
+                    self.condition.wait(self.queue[0][0] - monotonic() if self.queue else None)
+                _, _, sock, datagram, addr = heapq.heappop(self.queue)
+            try:
+                sock.sendto(datagram, addr)
+            except OSError:
+                pass # closed meanwhile
+
+    def stats(self):
+        return {"sent": self.sent, "dropped": self.dropped}
+
+
+# Socket whose sends go through a Link, everything else is the wrapped socket's
+class ShimSocket:
+    def __init__(self, sock, link):
+        self.socket = sock
+        self.link = link
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+    def sendto(self, datagram, addr):
+        self.link.send(self.socket, datagram, addr)
+        return len(datagram)
+
+    # Scatter-gather sends are joined into one datagram
+    def sendmsg(self, buffers, ancdata=(), flags=0, addr=None):
+        datagram = b"".join(buffers)
+        self.link.send(self.socket, datagram, addr)
+        return len(datagram)
+
+
+# Every peer and DHT node created afterwards in this process sends through `link`
+def install(link):
+    bind_socket = peer_module.bind_socket
+    peer_module.bind_socket = lambda *args: ShimSocket(bind_socket(*args), link)
+    DHT_node.socket = lambda *args: ShimSocket(socket.socket(*args), link)
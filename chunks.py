@@ -0,0 +1,110 @@
+from threading import Lock
+
+from manifest import CorruptChunk
+from wire import data_header
+
+
+# Configuration constants
+FRAGMENT_SIZE = 1400 # Payload bytes of a data datagram, keeps datagrams under the Ethernet MTU
+CHUNK_SIZE = 256 * 1024 # Preferred transfer chunk size of a download
+MAX_CHUNK_SIZE = 1024 * 1024 # Largest number of bytes a seeder serves for one request
+MAX_IN_FLIGHT = 4 * 1024 * 1024 # Bytes requested from one peer at once
+MAX_RANGES = 32 # Ranges in one request, more missing runs are requested as one span
+
+
+# Datagrams answering a get request for `ranges` of `view`: data header with the offset, payload,
+# split every FRAGMENT_SIZE bytes from the start of each range and sent with scatter-gather.
+# At most MAX_CHUNK_SIZE bytes are served, the requester asks again for the rest
+def data_fragments(request_id, view, ranges):
+    budget = MAX_CHUNK_SIZE
+    for offset, length in ranges:
+        if offset < 0:
+            continue
+        end = min(offset + length, offset + budget, len(view))
+        budget -= max(0, end - offset)
+        for start in range(offset, end, FRAGMENT_SIZE):
+            yield [data_header(request_id, start), view[start:min(start + FRAGMENT_SIZE, end)]]
+
+
+# Window limit of a transfer, in chunks
+def max_window(chunk_size):
+    return max(2, MAX_IN_FLIGHT // chunk_size)
+
+
+# Reassembles transfer chunks from fragments. Every fragment is copied at its offset
+# into the buffer of its chunk; a complete chunk is handed to `store(number, data)`,
+# which may reject it with CorruptChunk, then it is requested again from scratch.
+# Fragments are aligned to FRAGMENT_SIZE from the chunk start, so a chunk whose
+# request timed out is asked again only for the fragments still missing
+class ChunkAssembler:
+    def __init__(self, size, chunk_size, store):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chunks = -(-size // chunk_size) # ceil
+        self.store = store
+        self.partial = {} # chunk number -> [buffer, received fragment flags, received count]
+        self.stored = set() # chunks stored or being stored, their late and duplicate fragments are ignored
+        self.lock = Lock()
+
+    def chunk_length(self, number):
+        return min(self.chunk_size, self.size - number * self.chunk_size)
+
+    # Byte ranges of a chunk still missing, merged into runs of consecutive fragments
+    # (into a single span if there are more than MAX_RANGES runs)
+    def missing(self, number):
+        start = number * self.chunk_size
+        with self.lock:
+            state = self.partial.get(number)
+            if state is None:
+                return [(start, self.chunk_length(number))]
+            ranges = []
+            for index, received in enumerate(state[1]):
+                if received:
+                    continue
+                offset = start + index * FRAGMENT_SIZE
+                length = min(FRAGMENT_SIZE, start + self.chunk_length(number) - offset)
+                if ranges and sum(ranges[-1]) == offset:
+                    ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+                else:
+                    ranges.append((offset, length))
+            if len(ranges) > MAX_RANGES:
+                return [(ranges[0][0], sum(ranges[-1]) - ranges[0][0])]
+            return ranges
+
+    # Add the fragment at `offset`, returns the chunk number once its chunk is complete
+    # and stored, None while fragments are missing. Raises ValueError for misaligned fragments
+    def add(self, offset, payload):
+        number = offset // self.chunk_size
+        relative = offset - number * self.chunk_size
+        if not 0 <= number < self.chunks or relative % FRAGMENT_SIZE:
+            raise ValueError(f"Unexpected fragment at {offset}")
+        length = self.chunk_length(number)
+        if len(payload) != min(FRAGMENT_SIZE, length - relative):
+            raise ValueError(f"Unexpected fragment length at {offset}")
+
+        with self.lock:
+            if number in self.stored:
+                return None
+            state = self.partial.get(number)
+            if state is None:
+                state = [bytearray(length), bytearray(-(-length // FRAGMENT_SIZE)), 0]
+                self.partial[number] = state
+            buffer, received, _ = state
+            index = relative // FRAGMENT_SIZE
+            if received[index]:
+                return None
+            buffer[relative:relative + len(payload)] = payload
+            received[index] = 1
+            state[2] += 1
+            if state[2] < len(received):
+                return None
+            del self.partial[number]
+            self.stored.add(number)
+
+        try:
+            self.store(number, memoryview(buffer))
+        except CorruptChunk:
+            with self.lock:
+                self.stored.discard(number)
+            raise CorruptChunk(number)
+        return number
@@ -0,0 +1,159 @@
+import select
+import socket
+from concurrent.futures import Future
+from itertools import count
+from threading import Thread, Lock
+from time import time, perf_counter
+
+from wire import SIZEOF, DATA, ID_MASK, parse_message, encode_message
+from upload_scheduler import RECEIVE_BATCH, UPLOAD_BATCH
+from metrics import metrics
+
+
+# Message types that answer a request, everything else is served by the handler
+RESPONSE_TYPES = {SIZEOF, DATA}
+
+
+# Send a response given as bytes or as an iterable of datagrams, each one bytes
+# or a list of buffers (header, payload view)
+def send_response(sock, response, addr):
+    if isinstance(response, (bytes, bytearray)):
+        sock.sendto(response, addr)
+        return
+    for datagram in response:
+        if isinstance(datagram, (bytes, bytearray)):
+            sock.sendto(datagram, addr)
+        else:
+            # Scatter-gather: the payload goes to the kernel without being joined to the header
+            sock.sendmsg(datagram, (), 0, addr)
+
+
+# Single receive loop of a peer socket. Every message is a wire header (version, type, request id) and a body:
+# responses complete the future waiting for their request id, requests are
+# passed to the serving handler whose return value is sent back.
+# Datagrams are received into one preallocated buffer; a request may register a
+# sink that consumes the response body in place instead of getting a bytes copy.
+# A response can span several datagrams: while the sink returns None the request
+# stays pending and its next datagrams go to the same sink.
+# With an UploadScheduler, every datagram waiting on the socket is taken in before the
+# queued requests are served, in its order and at its rates; otherwise requests are
+# served as they come
+class Dispatcher:
+    def __init__(self, sock, handler, buffer_size, uploads=None):
+        self.socket = sock
+        self.handler = handler # (type, request id, body, addr) -> response (bytes or datagrams) or None
+        self.uploads = uploads
+        self.buffer = bytearray(buffer_size)
+        self.pending = {} # request id -> Future
+        self.pending_lock = Lock()
+        self.ids = count(1)
+        self.running = True
+        self.thread = Thread(target=self.run, daemon=True)
+        self.poller = select.poll()
+        self.poller.register(sock, select.POLLIN)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        with self.pending_lock:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+
+    # Send a request, the returned future resolves to (body, addr) of the response,
+    # or to (sink(body view, addr), addr) once the sink returns something else than None
+    def request(self, msg_type: int, body: bytes, addr, sink=None):
+        request_id = next(self.ids) & ID_MASK
+        future = Future()
+        future.request_id = request_id
+        future.sink = sink
+        with self.pending_lock:
+            self.pending[request_id] = future
+        self.socket.sendto(encode_message(msg_type, request_id, body), addr)
+        return future
+
+    # Forget a request whose response is no longer awaited
+    def cancel(self, future):
+        with self.pending_lock:
+            self.pending.pop(future.request_id, None)
+        future.cancel()
+
+    def run(self):
+        timeout = None # seconds until queued requests may be served, None if there are none
+        while self.running:
+            try:
+                if timeout is None or self.poller.poll(timeout * 1000):
+                    length, addr = self.socket.recvfrom_into(self.buffer)
+                    self.dispatch(self.buffer, length, addr)
+                    if self.uploads:
+                        for _ in range(RECEIVE_BATCH):
+                            length, addr = self.socket.recvfrom_into(self.buffer, 0, socket.MSG_DONTWAIT)
+                            self.dispatch(self.buffer, length, addr)
+            except BlockingIOError:
+                pass
+            except OSError:
+                # Socket closed on shutdown
+                if not self.running:
+                    return
+                continue
+            if self.uploads:
+                timeout = self.serve_uploads()
+
+    # Forget a request that got its response, False if it was cancelled meanwhile
+    def complete(self, request_id, future):
+        with self.pending_lock:
+            self.pending.pop(request_id, None)
+        return future.set_running_or_notify_cancel()
+
+    # Route a single datagram
+    def dispatch(self, data, length, addr):
+        message = parse_message(data, length)
+        if message is None:
+            print(f"Malformed message from {addr}")
+            return
+        msg_type, request_id, body = message
+
+        if msg_type in RESPONSE_TYPES:
+            with self.pending_lock:
+                future = self.pending.get(request_id)
+            if future is None or future.cancelled():
+                return
+            try:
+                result = future.sink(body, addr) if future.sink else bytes(body)
+                if result is None:
+                    return
+            except Exception as e:
+                if self.complete(request_id, future):
+                    future.set_exception(e)
+                return
+            if self.complete(request_id, future):
+                future.set_result((result, addr))
+            return
+
+        if self.uploads:
+            self.uploads.push(msg_type, request_id, bytes(body), addr)
+            return
+        self.serve_request(msg_type, request_id, bytes(body), addr)
+
+    def serve_request(self, msg_type, request_id, body, addr):
+        start = perf_counter()
+        try:
+            response = self.handler(msg_type, request_id, body, addr)
+            if response is not None:
+                send_response(self.socket, response, addr)
+        except Exception as e:
+            metrics.count("peer.serve_errors")
+            print(f"Error serving message type {msg_type} from {addr}: {e}")
+        metrics.observe("peer.serve_request", perf_counter() - start)
+
+    # Serves the queued requests the upload scheduler releases, a batch at a time. Returns
+    # the seconds until more may be served, None once the queue is empty
+    def serve_uploads(self):
+        for _ in range(UPLOAD_BATCH):
+            request, delay = self.uploads.next(time())
+            if request is None:
+                return delay if self.uploads.queued else None
+            self.serve_request(*request)
+        return 0
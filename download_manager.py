@@ -0,0 +1,133 @@
+import heapq
+from itertools import count
+from math import ceil
+from threading import Lock
+
+from token_bucket import TokenBucket
+
+
+# Configuration constants
+MAX_IN_FLIGHT = 1024 # Chunk requests in flight across all the transfers of a peer
+MAX_ACTIVE_DOWNLOADS = 4 # Files downloaded at the same time
+DEFAULT_PRIORITY = 1 # Weight of a transfer in the share of the requests in flight
+RETRY_DELAY = 0.01 # Seconds a transfer held back by the scheduler waits before asking again
+
+
+# A running transfer as seen by the scheduler
+class TransferSlot:
+    __slots__ = ("priority", "in_flight", "hungry")
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.in_flight = 0
+        self.hungry = False # wanted to send more than it was allowed at its last turn
+
+
+# Shares the capacity of a peer between its transfers: at most `max_in_flight` chunk requests
+# in flight in total and, with a `rate`, at most that many bytes requested per second (token
+# bucket). A transfer may use whatever the others leave; while others want more, each one is
+# held to its share of the requests in flight, in proportion to its priority
+class DownloadScheduler:
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, rate=None):
+        self.max_in_flight = max_in_flight
+        self.bucket = TokenBucket(rate) if rate else None # bytes per second, None for no limit
+        self.slots = set()
+        self.requests = 0
+        self.bytes = 0
+        self.throttled = 0 # turns where a transfer was held back
+        self.lock = Lock()
+
+    def register(self, priority=DEFAULT_PRIORITY):
+        slot = TransferSlot(priority)
+        with self.lock:
+            self.slots.add(slot)
+        return slot
+
+    def unregister(self, slot):
+        with self.lock:
+            self.slots.discard(slot)
+
+    # Requests a transfer may send now. Called with the lock held
+    def allowance(self, slot, request_bytes, now):
+        allowed = self.max_in_flight - sum(other.in_flight for other in self.slots)
+        if any(other.hungry for other in self.slots if other is not slot):
+            share = max(1, self.max_in_flight * slot.priority // sum(other.priority for other in self.slots))
+            allowed = min(allowed, share - slot.in_flight)
+        if self.bucket:
+            tokens = self.bucket.available(now)
+            allowed = min(allowed, ceil(tokens / request_bytes)) if tokens > 0 else 0
+        return max(0, allowed)
+
+    # Requests of a transfer (SwarmScheduler) to send now, each asking for `request_bytes`, and
+    # whether the scheduler held some back, in which case the transfer asks again within retry_delay().
+    # Only a transfer whose windows would have sent more than it was allowed is held back
+    def take(self, slot, transfer, request_bytes, now):
+        with self.lock:
+            slot.in_flight = transfer.in_flight()
+            allowed = self.allowance(slot, request_bytes, now)
+            requests = transfer.take(now, allowed)
+            slot.hungry = len(requests) >= allowed and transfer.wants_more(now)
+            slot.in_flight += len(requests)
+            self.requests += len(requests)
+            self.bytes += len(requests) * request_bytes
+            if self.bucket:
+                self.bucket.consume(len(requests) * request_bytes)
+            if slot.hungry:
+                self.throttled += 1
+            return requests, slot.hungry
+
+    # Seconds until a held back transfer may get more requests
+    def retry_delay(self, now):
+        with self.lock:
+            if self.bucket:
+                return max(RETRY_DELAY, self.bucket.delay(now))
+            return RETRY_DELAY
+
+
+# Files waiting to be downloaded, highest priority first, then in the order they were added.
+# A file queued twice is downloaded once, with the higher priority
+class DownloadQueue:
+    def __init__(self, files=()):
+        self.heap = [] # (-priority, order, file name)
+        self.priorities = {} # file name -> priority it is queued with
+        self.order = count()
+        self.lock = Lock()
+        for filename, priority in files:
+            self.add(filename, priority)
+
+    def __len__(self):
+        return len(self.priorities)
+
+    def add(self, filename, priority=DEFAULT_PRIORITY):
+        with self.lock:
+            if self.priorities.get(filename, priority - 1) >= priority:
+                return
+            self.priorities[filename] = priority
+            heapq.heappush(self.heap, (-priority, next(self.order), filename))
+
+    # (file name, priority) of the next download, None once the queue is empty
+    def next(self):
+        with self.lock:
+            while self.heap:
+                priority, _, filename = heapq.heappop(self.heap)
+                if self.priorities.get(filename) == -priority:
+                    del self.priorities[filename]
+                    return filename, -priority
+            return None
+
+
+# (file name, priority) of the downloads listed in a text file: one file name or content
+# root per line, optionally followed by its priority. Blank lines and `#` comments are skipped
+def read_download_list(path):
+    files = []
+    with open(path, "r") as file:
+        for line in file:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            name, _, priority = line.rpartition(" ")
+            if name and priority.isdigit():
+                files.append((name.strip(), max(1, int(priority))))
+            else:
+                files.append((line, DEFAULT_PRIORITY))
+    return files
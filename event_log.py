@@ -0,0 +1,158 @@
+import atexit
+import json
+import os
+from collections import deque
+from datetime import datetime
+from itertools import count
+from threading import Thread, Event, Lock
+from time import time
+
+
+# Configuration constants
+LOG_PATH = './log_file.txt' # Log of every peer started from the same directory
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40 # Event levels
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+FLUSH_INTERVAL = 0.2 # Seconds between two writes of the queued events
+WRITE_BATCH = 4096 # Queued events that wake the writer before its interval
+MAX_PENDING = 1000000 # Events waiting to be written, beyond that new events are dropped
+PACKET_SAMPLE = 1 # One per-packet event in PACKET_SAMPLE is logged
+ROTATE_BACKUPS = 3 # Rotated log files kept next to the log, log_file.txt.1 being the newest
+
+
+# Timestamp of a text log line
+def line_time(timestamp):
+    return datetime.fromtimestamp(timestamp).replace(microsecond=0).isoformat(sep=" ")
+
+
+# Log of a process, written by a background thread. Logging an event only appends it to a
+# deque (atomic, no lock is taken) and the writer formats and writes everything queued in
+# one write every FLUSH_INTERVAL, to a file it keeps open. Events below `level` are
+# skipped, per-packet events are sampled, and lines are either text as before,
+# "[time] source message", or JSON objects with the structured fields of the event. With
+# `max_bytes`, the log is rotated once it grows larger. What is queued is written at exit
+class EventLog:
+    def __init__(self, path=LOG_PATH, level=INFO, sample=PACKET_SAMPLE, json_lines=False, max_bytes=None, backups=ROTATE_BACKUPS):
+        self.path = path
+        self.level = level
+        self.sample = sample
+        self.json_lines = json_lines
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.pending = deque() # (time, level, source, message, fields)
+        self.packets = count() # per-packet events seen, sampling picks every sample-th one
+        self.wake = Event()
+        self.write_lock = Lock() # one writer at a time: the thread, flush() and exit
+        self.file = None
+        self.writer = None
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        atexit.register(self.close)
+        os.register_at_fork(after_in_child=self.forked)
+
+    def configure(self, level=None, sample=None, json_lines=None, max_bytes=None):
+        if level is not None:
+            self.level = level
+        if sample is not None:
+            self.sample = max(1, sample)
+        if json_lines is not None:
+            self.json_lines = json_lines
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+
+    def enabled(self, level):
+        return level >= self.level
+
+    # Whether this per-packet event is to be logged: its level is enabled and it is picked by the sampling.
+    # Checked before the message is formatted
+    def packet(self, level=DEBUG):
+        return level >= self.level and (self.sample == 1 or next(self.packets) % self.sample == 0)
+
+    # Queue an event of `source` (e.g. "Peer 0.0.0.0:5000", or None), fields go to JSON lines only
+    def log(self, source, message, level=INFO, **fields):
+        if level < self.level:
+            return
+        if len(self.pending) >= MAX_PENDING:
+            self.dropped += 1
+            return
+        self.pending.append((time(), level, source, message, fields))
+        if self.writer is None:
+            self.start()
+        elif len(self.pending) >= WRITE_BATCH:
+            self.wake.set()
+
+    # A forked process writes its own events with a writer of its own, what the parent queued is left to the parent
+    def forked(self):
+        self.pending = deque()
+        self.wake = Event()
+        self.write_lock = Lock()
+        self.file = None
+        self.writer = None
+
+    def start(self):
+        with self.write_lock:
+            if self.writer is None:
+                self.writer = Thread(target=self.run, daemon=True)
+                self.writer.start()
+
+    def run(self):
+        while True:
+            self.wake.wait(FLUSH_INTERVAL)
+            self.wake.clear()
+            self.flush()
+
+    # Write every queued event
+    def flush(self):
+        with self.write_lock:
+            lines = []
+            pending = self.pending
+            while pending:
+                lines.append(self.format(*pending.popleft()))
+            if not lines:
+                return
+            if self.file is None:
+                self.file = open(self.path, 'a')
+            self.file.write("".join(lines))
+            self.file.flush()
+            self.written += len(lines)
+            if self.max_bytes and self.file.tell() >= self.max_bytes:
+                self.rotate()
+
+    def format(self, timestamp, level, source, message, fields):
+        if self.json_lines:
+            record = {"time": datetime.fromtimestamp(timestamp).isoformat(sep=" ", timespec="milliseconds"),
+                      "level": LEVEL_NAMES[level], "source": source, "message": message}
+            record.update(fields)
+            return json.dumps(record, default=str) + "\n"
+        if source is None:
+            return f"[{line_time(timestamp)}] {message}\n"
+        return f"[{line_time(timestamp)}] {source} {message}\n"
+
+    # log_file.txt becomes log_file.txt.1, the older ones move up and the oldest is deleted. Called with the lock held
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        for number in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{number}"):
+                os.replace(f"{self.path}.{number}", f"{self.path}.{number + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+
+    def close(self):
+        self.flush()
+        with self.write_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    # Events written and dropped
+    def stats(self):
+        return {"written": self.written, "pending": len(self.pending), "dropped": self.dropped, "rotations": self.rotations}
+
+
+# Log of the peers and nodes of this process
+events = EventLog()
@@ -0,0 +1,102 @@
+from bisect import insort
+
+from routing_table import BUCKET_SIZE
+
+
+# Configuration constants
+ALPHA = 3 # Queries a lookup keeps in flight
+RPC_TIMEOUT = 1.0 # Timeout of a DHT query before the first RTT sample (seconds)
+MIN_RPC_TIMEOUT = 0.05
+MAX_RPC_TIMEOUT = 5.0
+
+
+# Smoothed RTT of the answers a DHT node gets, the timeout of its queries follows it (RFC 6298)
+class RttEstimator:
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.timeout = RPC_TIMEOUT
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.timeout = min(MAX_RPC_TIMEOUT, max(MIN_RPC_TIMEOUT, self.srtt + 4 * self.rttvar))
+
+
+# State of one iterative Kademlia lookup, without any I/O. The shortlist holds
+# every node heard of, by distance to the target; up to `alpha` of the `k` closest
+# are queried at a time. The lookup is done once the k closest have answered,
+# when nothing is left to ask, or (peer lookups) as soon as peers were found
+class Lookup:
+    def __init__(self, target_id, own_id, contacts, find_peers=False, alpha=ALPHA, k=BUCKET_SIZE):
+        self.target = int.from_bytes(target_id, 'big')
+        self.own_id = own_id
+        self.find_peers = find_peers
+        self.alpha = alpha
+        self.k = k
+        self.candidates = {} # node id -> address
+        self.shortlist = [] # (distance, node id) of the candidates, closest first
+        self.queried = set()
+        self.in_flight = set()
+        self.responded = set()
+        self.peers = [] # (ip, port) of the peers found
+        self.add(contacts)
+
+    # Add (node id, address) pairs to the shortlist
+    def add(self, contacts):
+        for node_id, addr in contacts:
+            if node_id != self.own_id and node_id not in self.candidates:
+                self.candidates[node_id] = addr
+                insort(self.shortlist, (int.from_bytes(node_id, 'big') ^ self.target, node_id))
+
+    def add_peers(self, peers):
+        for peer in peers:
+            if peer not in self.peers:
+                self.peers.append(peer)
+
+    # The k closest nodes of the shortlist
+    def closest(self):
+        return [node_id for _, node_id in self.shortlist[:self.k]]
+
+    # Nodes to query now: (node id, address) pairs
+    def next_queries(self):
+        queries = []
+        if self.done():
+            return queries
+        for node_id in self.closest():
+            if len(self.in_flight) >= self.alpha:
+                break
+            if node_id not in self.queried:
+                self.queried.add(node_id)
+                self.in_flight.add(node_id)
+                queries.append((node_id, self.candidates[node_id]))
+        return queries
+
+    def on_response(self, node_id, contacts, peers):
+        self.in_flight.discard(node_id)
+        self.responded.add(node_id)
+        self.add(contacts)
+        self.add_peers(peers)
+
+    # A node did not answer in time, it leaves the shortlist
+    def on_timeout(self, node_id):
+        self.in_flight.discard(node_id)
+        if self.candidates.pop(node_id, None) is not None:
+            self.shortlist.remove((int.from_bytes(node_id, 'big') ^ self.target, node_id))
+
+    def done(self):
+        if self.find_peers and self.peers:
+            return True
+        closest = self.closest()
+        if all(node_id in self.responded for node_id in closest):
+            return True
+        return not self.in_flight and all(node_id in self.queried for node_id in closest)
+
+    # The closest nodes that answered: (node id, address) pairs
+    def result(self, count):
+        responded = [node_id for node_id in self.closest() if node_id in self.responded]
+        return [(node_id, self.candidates[node_id]) for node_id in responded[:count]]
@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+# Configuration constants
+LOOKUP_TTL = 60 # Seconds a lookup result is reused
+NEGATIVE_TTL = 10 # Seconds an empty result (no peers for a file) is reused
+REFRESH_AHEAD = 0.25 # Share of the TTL left when an entry in use is refreshed in the background
+MAX_LOOKUPS = 1024 # Cached results, the least recently used one is dropped first
+
+
+# A cached result and when it expires
+class CacheEntry:
+    __slots__ = ("value", "created", "expires", "refreshing")
+
+    def __init__(self, value, created, expires):
+        self.value = value
+        self.created = created
+        self.expires = expires
+        self.refreshing = False
+
+
+# Results of DHT lookups and size queries made by a peer: peer lists and file metadata.
+# Entries live for LOOKUP_TTL (NEGATIVE_TTL when nothing was found) in a bounded LRU.
+# An entry that is used in the last REFRESH_AHEAD of its life is reported for refresh,
+# so hot entries are reloaded in the background and never expire while in use.
+# Concurrent misses of a key share a single load: the first caller loads, the others
+# wait for its future. The counters tell how many lookups and queries were saved
+class LookupCache:
+    def __init__(self, ttl=LOOKUP_TTL, negative_ttl=NEGATIVE_TTL, max_entries=MAX_LOOKUPS):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> CacheEntry, least recently used first
+        self.loading = {} # key -> future of the load in progress
+        self.hits = 0
+        self.negative_hits = 0 # hits on empty results
+        self.misses = 0
+        self.shared = 0 # misses that waited for a load in progress
+        self.refreshes = 0
+        self.lock = Lock()
+
+    # (hit, value, refresh) for a key. `refresh` is True, once per entry, when a hot entry
+    # is about to expire and should be reloaded in the background
+    def lookup(self, key, now=None):
+        now = time() if now is None else now
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.expires <= now:
+                self.misses += 1
+                return False, None, False
+            self.entries.move_to_end(key)
+            self.hits += 1
+            if not entry.value:
+                self.negative_hits += 1
+            refresh = (not entry.refreshing and key not in self.loading
+                       and entry.expires - now <= REFRESH_AHEAD * (entry.expires - entry.created))
+            if refresh:
+                entry.refreshing = True
+                self.refreshes += 1
+            return True, entry.value, refresh
+
+    # (future, owner) of a load of a key: the caller that gets owner=True loads the value and
+    # calls finish_load, the others wait for the future. `create_future` makes a new future
+    def start_load(self, key, create_future):
+        with self.lock:
+            future = self.loading.get(key)
+            if future is not None:
+                self.shared += 1
+                return future, False
+            future = self.loading[key] = create_future()
+            return future, True
+
+    # Store the loaded value of a key and wake up the callers waiting for it. A failed
+    # load (error) caches nothing, the waiters get the error
+    def finish_load(self, key, value=None, error=None, now=None):
+        now = time() if now is None else now
+        with self.lock:
+            future = self.loading.pop(key, None)
+            if error is None:
+                self.entries.pop(key, None)
+                self.entries[key] = CacheEntry(value, now, now + (self.ttl if value else self.negative_ttl))
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            elif key in self.entries:
+                self.entries[key].refreshing = False
+        if future is None or future.done():
+            return
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+            future.exception() # retrieved here as well, there may be no waiter
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    # DHT lookups and size queries saved so far, and the counters behind them
+    def stats(self):
+        with self.lock:
+            return {"saved": self.hits + self.shared, "hits": self.hits, "negative_hits": self.negative_hits,
+                    "misses": self.misses, "shared": self.shared, "refreshes": self.refreshes, "entries": len(self.entries)}
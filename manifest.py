@@ -0,0 +1,89 @@
+import struct
+from hashlib import sha1
+
+
+# Configuration constants
+MANIFEST_SUFFIX = ".manifest" # Key suffix under which peers serve the manifest of a content root
+MANIFEST_MAGIC = b"P2PM"
+MANIFEST_VERSION = 1
+MANIFEST_HEADER = struct.Struct("!4sBQI") # magic, version, file size, chunk size
+HASH_SIZE = 20 # SHA-1 digest of a chunk
+MAX_MANIFEST_CHUNKS = 1 << 22 # Chunks of the largest manifest downloaded (4 GB files at 1 KB chunks, 80 MB of hashes)
+
+
+# Raised by a download sink when a chunk does not match its manifest hash
+class CorruptChunk(Exception):
+    def __init__(self, number, addr=None):
+        super().__init__(f"Chunk {number} failed verification")
+        self.number = number
+        self.addr = addr
+
+
+# Root of the binary hash tree over the chunk hashes, an odd node is carried up unchanged
+def merkle_root(hashes):
+    level = list(hashes)
+    if not level:
+        return sha1(b"").digest()
+    while len(level) > 1:
+        paired = [sha1(level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            paired.append(level[-1])
+        level = paired
+    return level[0]
+
+
+# True for keys that name content by its root (40 hex digits) rather than by file name
+def is_content_root(key):
+    if len(key) != 2 * HASH_SIZE:
+        return False
+    try:
+        bytes.fromhex(key)
+    except ValueError:
+        return False
+    return True
+
+
+# True for a byte count an encoded manifest of at most MAX_MANIFEST_CHUNKS chunks can have
+def valid_manifest_size(length):
+    hashes = length - MANIFEST_HEADER.size
+    return hashes >= 0 and hashes % HASH_SIZE == 0 and hashes // HASH_SIZE <= MAX_MANIFEST_CHUNKS
+
+
+# Description of a file content: size, chunk size and the hash of every chunk.
+# The content root (SHA-1 of the header and the Merkle root of the chunk hashes)
+# identifies the content in the DHT, whatever the file is called by its seeders
+class Manifest:
+    def __init__(self, size, chunk_size, hashes):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chunks = -(-size // chunk_size) # ceil
+        if len(hashes) != self.chunks * HASH_SIZE:
+            raise ValueError("Manifest hash list does not match the file size")
+        header = MANIFEST_HEADER.pack(MANIFEST_MAGIC, MANIFEST_VERSION, size, chunk_size)
+        self.data = header + bytes(hashes) # encoded form, served to other peers
+        self.hashes = memoryview(self.data)[MANIFEST_HEADER.size:]
+        chunk_hashes = [bytes(self.hashes[n * HASH_SIZE:(n + 1) * HASH_SIZE]) for n in range(self.chunks)]
+        self.root = sha1(header + merkle_root(chunk_hashes)).digest()
+
+    # Manifest of a buffer (e.g. the mapping of a shared file)
+    @staticmethod
+    def build(data, chunk_size):
+        view = memoryview(data)
+        hashes = b"".join(sha1(view[start:start + chunk_size]).digest() for start in range(0, len(view), chunk_size))
+        return Manifest(len(view), chunk_size, hashes)
+
+    # Parse an encoded manifest, raises ValueError if it is malformed
+    @staticmethod
+    def decode(data):
+        if len(data) < MANIFEST_HEADER.size:
+            raise ValueError("Manifest too short")
+        magic, version, size, chunk_size = MANIFEST_HEADER.unpack_from(data)
+        if magic != MANIFEST_MAGIC or version != MANIFEST_VERSION or chunk_size <= 0:
+            raise ValueError("Unsupported manifest")
+        return Manifest(size, chunk_size, data[MANIFEST_HEADER.size:])
+
+    def chunk_hash(self, number):
+        return self.hashes[number * HASH_SIZE:(number + 1) * HASH_SIZE]
+
+    def verify(self, number, data):
+        return 0 <= number < self.chunks and sha1(data).digest() == self.chunk_hash(number)
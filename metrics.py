@@ -0,0 +1,97 @@
+from threading import Lock
+from time import time
+
+
+# Configuration constants
+HISTOGRAM_BUCKETS = 26 # Latency buckets of powers of two microseconds, the last one holds everything above 33 s
+
+
+# Latencies in buckets of powers of two: bucket i holds the durations below 2**i microseconds
+# and at least half of that, so percentiles are known within a factor of two
+class Histogram:
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[min(HISTOGRAM_BUCKETS - 1, int(seconds * 1e6).bit_length())] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # Upper bound of the bucket holding the given fraction of the samples, in seconds
+    def percentile(self, fraction):
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.max, (1 << bucket) / 1e6)
+        return self.max
+
+    def summary(self):
+        return {"count": self.count, "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+                "p50_ms": self.percentile(0.5) * 1000, "p99_ms": self.percentile(0.99) * 1000, "max_ms": self.max * 1000}
+
+
+# Counters and latency histograms of a process, updated on the hot paths of the peers and
+# DHT nodes, and gauges read when a snapshot is taken (table sizes, queue depths). A
+# snapshot also gives the rate of every counter since the previous one
+class Metrics:
+    def __init__(self):
+        self.enabled = True
+        self.counters = {} # name -> count
+        self.histograms = {} # name -> Histogram
+        self.gauges = {} # name -> function returning a number
+        self.lock = Lock()
+        self.last = ({}, time()) # counters and time of the previous snapshot
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Record a duration in seconds
+    def observe(self, name, seconds):
+        if self.enabled:
+            with self.lock:
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = Histogram()
+                histogram.add(seconds)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def snapshot(self, now=None):
+        now = time() if now is None else now
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: histogram.summary() for name, histogram in self.histograms.items()}
+        previous, since = self.last
+        self.last = (counters, now)
+        elapsed = max(now - since, 1e-9)
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception as e:
+                gauges[name] = f"error: {e}"
+        return {"time": now, "counters": counters,
+                "rates": {name: (value - previous.get(name, 0)) / elapsed for name, value in counters.items()},
+                "histograms": histograms, "gauges": gauges}
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+        self.last = ({}, time())
+
+
+# Metrics of the peers and nodes of this process
+metrics = Metrics()
@@ -0,0 +1,167 @@
+import os
+import struct
+import zlib
+from threading import Lock
+
+from wire import unpack_contact, unpack_peer, KEY
+
+
+# Configuration constants
+STATE_MAGIC = b"P2PD"
+STATE_VERSION = 1
+STATE_HEADER = struct.Struct("!4sB20s") # magic, version, node id
+RECORD_HEADER = struct.Struct("!BHI") # record type, payload length, CRC-32 of the payload
+EXPIRES = struct.Struct("!d")
+STATE_FLUSH_INTERVAL = 1.0 # Seconds between writes of the buffered records
+COMPACT_MIN_RECORDS = 10000 # The log is not compacted below this many records
+COMPACT_RATIO = 4 # The log is compacted once it holds this many records per live one
+
+# Records of the log, every one replaces what an earlier one said about the same contact or peer
+CONTACT = 1 # family, packed contact (node id, ip, port)
+DROP_CONTACT = 2 # node id
+PEER = 3 # key, expiry time, family, packed peer (ip, port)
+DROP_PEER = 4 # key, family, packed peer (ip, port)
+
+
+# Path of the temporary snapshot written by a compaction
+def snapshot_path(path):
+    return path + ".tmp"
+
+
+def encode_record(record_type, payload):
+    return RECORD_HEADER.pack(record_type, len(payload), zlib.crc32(payload)) + payload
+
+
+def contact_record(node):
+    family, packed = node.contact
+    return encode_record(CONTACT, bytes((family,)) + packed)
+
+
+def peer_record(record):
+    family, packed = record.entry
+    return encode_record(PEER, record.key + EXPIRES.pack(record.expires) + bytes((family,)) + packed)
+
+
+def drop_peer_record(record):
+    family, packed = record.entry
+    return encode_record(DROP_PEER, record.key + bytes((family,)) + packed)
+
+
+# On-disk state of a DHT node: its id, the contacts of its routing table and the
+# peers it stores. Changes are appended to a log as they happen and written every
+# STATE_FLUSH_INTERVAL; once the log holds COMPACT_RATIO times more records than
+# there are live contacts and peers it is replaced by a snapshot of the live ones.
+# A record cut short by a crash, and everything after it, is ignored on load
+class NodeState:
+    def __init__(self, path):
+        self.path = path
+        self.buffer = [] # records not written yet
+        self.records = 0 # records in the log
+        self.fd = None
+        self.lock = Lock() # guards the buffer
+        self.file_lock = Lock() # serializes the writes to the log
+
+    # (node id, contacts [(node id, ip, port)], peers [(key, ip, port, expires)]) of the log
+    # in the order they were recorded, None if there is no usable log
+    def load(self):
+        try:
+            with open(self.path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < STATE_HEADER.size:
+            return None
+        magic, version, node_id = STATE_HEADER.unpack_from(data)
+        if (magic, version) != (STATE_MAGIC, STATE_VERSION):
+            return None
+
+        contacts = {} # node id -> (node id, ip, port)
+        peers = {} # (key, ip, port) -> expires
+        offset = STATE_HEADER.size
+        while offset + RECORD_HEADER.size <= len(data):
+            record_type, length, crc = RECORD_HEADER.unpack_from(data, offset)
+            payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            try:
+                if record_type == CONTACT:
+                    contact = unpack_contact(payload[0], payload[1:])
+                    contacts.pop(contact[0], None)
+                    contacts[contact[0]] = contact
+                elif record_type == DROP_CONTACT:
+                    contacts.pop(payload, None)
+                elif record_type == PEER:
+                    key = payload[:KEY.size]
+                    expires, = EXPIRES.unpack_from(payload, KEY.size)
+                    start = KEY.size + EXPIRES.size
+                    ip, port = unpack_peer(payload[start], payload[start + 1:])
+                    peers[(key, ip, port)] = expires
+                elif record_type == DROP_PEER:
+                    key = payload[:KEY.size]
+                    ip, port = unpack_peer(payload[KEY.size], payload[KEY.size + 1:])
+                    peers.pop((key, ip, port), None)
+            except (struct.error, IndexError, OSError, ValueError):
+                break
+            offset += RECORD_HEADER.size + length
+            self.records += 1
+        return node_id, list(contacts.values()), [(key, ip, port, expires) for (key, ip, port), expires in peers.items()]
+
+    def append(self, record):
+        with self.lock:
+            self.buffer.append(record)
+
+    # Journal interface of the routing table and the peer storage
+    def contact_added(self, node):
+        self.append(contact_record(node))
+
+    def contact_removed(self, node_id):
+        self.append(encode_record(DROP_CONTACT, node_id))
+
+    def peer_stored(self, record):
+        self.append(peer_record(record))
+
+    def peer_removed(self, record):
+        self.append(drop_peer_record(record))
+
+    # Write the buffered records at the end of the log
+    def flush(self):
+        with self.file_lock:
+            self.write_buffer()
+
+    # Called with the file lock held
+    def write_buffer(self):
+        with self.lock:
+            records, self.buffer = self.buffer, []
+        if records and self.fd is not None:
+            os.write(self.fd, b"".join(records))
+            os.fdatasync(self.fd)
+            self.records += len(records)
+
+    def should_compact(self, live):
+        return self.records >= COMPACT_MIN_RECORDS and self.records >= COMPACT_RATIO * live
+
+    # Replace the log with a snapshot of the live contacts and peers, returned by `contacts()`
+    # (DHTNodeInfo) and `peers()` (PeerRecord). The buffered records are flushed to the old log
+    # before the snapshot is taken; the ones buffered meanwhile are appended to the new log
+    # afterwards, replaying them again is harmless
+    def compact(self, node_id, contacts, peers):
+        with self.file_lock:
+            self.write_buffer()
+            snapshot = [contact_record(node) for node in contacts()] + [peer_record(record) for record in peers()]
+            fd = os.open(snapshot_path(self.path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.write(fd, STATE_HEADER.pack(STATE_MAGIC, STATE_VERSION, node_id) + b"".join(snapshot))
+            os.fsync(fd)
+            os.close(fd)
+            os.replace(snapshot_path(self.path), self.path)
+            if self.fd is not None:
+                os.close(self.fd)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            self.records = len(snapshot)
+
+    # Write what is buffered and close the log, later changes are not recorded
+    def close(self):
+        with self.file_lock:
+            self.write_buffer()
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
@@ -0,0 +1,149 @@
+import os
+import struct
+from hashlib import sha1
+from threading import Lock
+from time import time
+
+from manifest import HASH_SIZE, CorruptChunk
+
+
+# Configuration constants
+JOURNAL_SUFFIX = ".journal" # Partial-state journal stored next to a partial file
+JOURNAL_MAGIC = b"P2PJ"
+JOURNAL_VERSION = 1
+JOURNAL_HEADER = struct.Struct("!4sBQII") # magic, version, file size, chunk size, chunk count
+FLUSH_INTERVAL = 1.0 # Seconds between journal flushes while chunks arrive
+
+
+# Path of the journal of a file
+def journal_path(path):
+    return path + JOURNAL_SUFFIX
+
+
+# Download target: the file is preallocated to its final size and every chunk is
+# written at its offset with os.pwrite, from any thread, as soon as it arrives.
+# A journal next to the file holds the file size, a chunk bitmap and the hash of
+# every written chunk. It is flushed periodically, after the chunk data is synced,
+# so an interrupted download resumes with only the chunks that are really on disk.
+# With a manifest, chunks are verified before they are written
+class PartialFile:
+    def __init__(self, path, size, chunk_size, manifest=None):
+        self.path = path
+        self.size = size
+        self.chunk_size = chunk_size
+        self.manifest = manifest
+        self.chunks = -(-size // chunk_size) # ceil
+        self.bitmap = bytearray(-(-self.chunks // 8))
+        self.hashes = bytearray(self.chunks * HASH_SIZE)
+        self.count = 0
+        self.dirty = set() # chunks written since the last flush
+        self.flushed_at = time()
+        self.lock = Lock()
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.journal_fd = os.open(journal_path(path), os.O_RDWR | os.O_CREAT, 0o644)
+        if not self.load():
+            self.preallocate()
+            self.create_journal()
+
+    # Reserve the blocks of the whole file up front, falling back to a sparse file
+    def preallocate(self):
+        os.ftruncate(self.fd, self.size)
+        if self.size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, self.size)
+            except OSError:
+                pass
+
+    def create_journal(self):
+        header = JOURNAL_HEADER.pack(JOURNAL_MAGIC, JOURNAL_VERSION, self.size, self.chunk_size, self.chunks)
+        os.ftruncate(self.journal_fd, 0)
+        os.pwrite(self.journal_fd, header + self.bitmap + self.hashes, 0)
+        os.fsync(self.journal_fd)
+
+    # Restore the state of a previous download of the same file. Chunks whose data
+    # does not match the journaled hash (or the manifest) are requested again.
+    # Returns False if there is nothing to resume
+    def load(self):
+        length = JOURNAL_HEADER.size + len(self.bitmap) + len(self.hashes)
+        journal = os.pread(self.journal_fd, length, 0)
+        if len(journal) != length:
+            return False
+        if JOURNAL_HEADER.unpack_from(journal) != (JOURNAL_MAGIC, JOURNAL_VERSION, self.size, self.chunk_size, self.chunks):
+            return False
+        if os.fstat(self.fd).st_size != self.size:
+            return False
+
+        self.bitmap[:] = journal[JOURNAL_HEADER.size:JOURNAL_HEADER.size + len(self.bitmap)]
+        self.hashes[:] = journal[JOURNAL_HEADER.size + len(self.bitmap):]
+        for number in range(self.chunks):
+            if not self.has(number):
+                continue
+            data = os.pread(self.fd, self.chunk_size, number * self.chunk_size)
+            expected = self.manifest.chunk_hash(number) if self.manifest else self.chunk_hash(number)
+            if sha1(data).digest() == expected:
+                self.count += 1
+            else:
+                self.bitmap[number >> 3] &= ~(1 << (number & 7)) & 0xff
+        return True
+
+    def has(self, number):
+        return self.bitmap[number >> 3] & (1 << (number & 7)) != 0
+
+    def chunk_hash(self, number):
+        return bytes(self.hashes[number * HASH_SIZE:(number + 1) * HASH_SIZE])
+
+    # Chunks already on disk, or groups of `group` consecutive chunks that are all on disk
+    def completed(self, group=1):
+        return [g for g in range(-(-self.chunks // group))
+                if all(self.has(n) for n in range(g * group, min((g + 1) * group, self.chunks)))]
+
+    def done(self):
+        return self.count == self.chunks
+
+    # Write one or more consecutive chunks starting at chunk `number` with a single pwrite,
+    # they are recorded in the journal at the next flush. Raises CorruptChunk, before
+    # anything is written, if any of them does not match the manifest
+    def write(self, number, data):
+        count = -(-len(data) // self.chunk_size)
+        if number < 0 or number + count > self.chunks:
+            raise ValueError(f"Chunk {number} out of range")
+        digests = [sha1(data[i * self.chunk_size:(i + 1) * self.chunk_size]).digest() for i in range(count)]
+        if self.manifest:
+            for i, digest in enumerate(digests):
+                if digest != self.manifest.chunk_hash(number + i):
+                    raise CorruptChunk(number + i)
+        os.pwrite(self.fd, data, number * self.chunk_size)
+        with self.lock:
+            for i, digest in enumerate(digests):
+                self.hashes[(number + i) * HASH_SIZE:(number + i + 1) * HASH_SIZE] = digest
+                if not self.has(number + i):
+                    self.bitmap[(number + i) >> 3] |= 1 << ((number + i) & 7)
+                    self.count += 1
+                self.dirty.add(number + i)
+            if time() - self.flushed_at >= FLUSH_INTERVAL:
+                self.flush()
+
+    # Sync the chunk data, then journal the hashes and the bitmap of the span of new
+    # chunks, hashes first so a set bit always has its hash. Called with the lock held
+    def flush(self):
+        self.flushed_at = time()
+        if not self.dirty:
+            return
+        os.fdatasync(self.fd)
+        first, last = min(self.dirty), max(self.dirty)
+        hashes_offset = JOURNAL_HEADER.size + len(self.bitmap)
+        os.pwrite(self.journal_fd, self.hashes[first * HASH_SIZE:(last + 1) * HASH_SIZE], hashes_offset + first * HASH_SIZE)
+        os.pwrite(self.journal_fd, self.bitmap[first >> 3:(last >> 3) + 1], JOURNAL_HEADER.size + (first >> 3))
+        os.fdatasync(self.journal_fd)
+        self.dirty.clear()
+
+    # Close the file, the journal is removed once every chunk is written
+    def close(self):
+        with self.lock:
+            if not self.done():
+                self.flush()
+        os.close(self.journal_fd)
+        os.close(self.fd)
+        if self.done():
+            os.remove(journal_path(self.path))
@@ -3,66 +3,194 @@ import os
 import threading
 from random import randint
 import argparse
-import math
 from progress.bar import FillingSquaresBar
-from datetime import datetime
+from time import time, perf_counter, sleep
+from queue import Queue, Empty
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 import DHT_node
 import sys
+from transfer import SwarmScheduler
+from dispatcher import Dispatcher
+from seed_cache import SeedCache
+from share_index import ShareIndex, SCAN_INTERVAL
+from lookup_cache import LookupCache
+from metrics import metrics
+from event_log import events, LEVELS, DEBUG, WARNING, ERROR, PACKET_SAMPLE
+from stats_server import StatsServer, SNAPSHOT_INTERVAL
+from upload_scheduler import UploadScheduler, MAX_QUEUED_REQUESTS
+from workers import WorkerGroup, share_port, start_workers
+from node_state import NodeState
+from download_manager import DownloadScheduler, DownloadQueue, DEFAULT_PRIORITY, MAX_ACTIVE_DOWNLOADS, MAX_IN_FLIGHT, read_download_list
+from partial_file import PartialFile
+from manifest import Manifest, CorruptChunk, MANIFEST_SUFFIX, is_content_root, valid_manifest_size
+from chunks import ChunkAssembler, CHUNK_SIZE, MAX_CHUNK_SIZE, data_fragments, max_window
+from wire import SIZE, SIZEOF, GET, encode_message, encode_size_reply, decode_size_reply, encode_get, decode_get, decode_data
 
 # Configuration constants
 IP = "0.0.0.0"
-MSS = 1024
-PACKET_SIZE = MSS
-PACKETS_PER_BATCH = 10
+MSS = 1024 # Chunk size of the manifests, the unit of hashing and resuming
+DATAGRAM_SIZE = 65536 # Receive buffer of a single datagram
+SOCKET_BUFFER_SIZE = 4 << 20 # Room for a full window of responses
+REQUEST_TIMEOUT = 1.0 # Seconds to wait for the response to a single request
+SIZE_ATTEMPTS = 1000 # Size requests before a file is given up
+MANIFEST_ATTEMPTS = 3 # Size requests for a manifest before its peer is skipped
+MANIFEST_TIMEOUT = 10.0 # Seconds to download a manifest from one peer before trying the next
+ANNOUNCE_FRESH = 300 # Seconds an announcement is not repeated at restart, it outlives the first republish
 
 # Default bootstrap ports for DHT
 WELL_KNOWN_NODES_PORTS = [6881, 6882]
 
-# Threading locks for logging and shared data
-log_lock = threading.Lock()
-packet_map_lock = threading.Lock()
+# Dispatcher sink of data responses: hands the (offset, payload) fragment to the assembler
+# straight from the receive buffer. Returns the chunk number once the chunk is complete,
+# raises CorruptChunk with the sender address if it failed verification
+def fragment_writer(assembler: ChunkAssembler):
+    def write_fragment(body, addr):
+        offset, payload = decode_data(body)
+        try:
+            return assembler.add(offset, payload)
+        except CorruptChunk as e:
+            raise CorruptChunk(e.number, addr)
+    return write_fragment
+
+# Assembler store of a download: a complete transfer chunk is verified against the
+# manifest and written to the partial file with a single pwrite
+def target_store(target: PartialFile, chunk_size: int):
+    def store(number, data):
+        target.write(number * chunk_size // target.chunk_size, data)
+    return store
 
-# Stores received packets temporarily during download
-packet_map = {}
+# Assembler store collecting an encoded manifest into `buffer`
+def buffer_store(buffer: bytearray, chunk_size: int):
+    def store(number, data):
+        buffer[number * chunk_size:number * chunk_size + len(data)] = data
+    return store
 
-# Helper function to format timestamped log entries
-def log_time():
-    return datetime.now().replace(microsecond=0).isoformat(sep=" ")
+# Creates the UDP socket of a peer, `shared` with the other workers serving the port
+def bind_socket(port: int, shared: bool = False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    if shared:
+        share_port(sock)
+    sock.bind((IP, port))
+    return sock
 
 class Peer:
-    def __init__(self, port: int, dht_port: int):
+    def __init__(self, port: int, dht_port: int, dht_state: str = None, uploads: UploadScheduler = None,
+                 seed_cache: SeedCache = None, group: WorkerGroup = None):
         # Initialize the peer socket and DHT node
-        self.port = port
-        self.address = IP+':'+str(port)
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind((IP, port))
-        
-        # Caches file sizes
-        self.files_size = {} 
+        self.init_state(port, uploads, seed_cache)
+        self.group = group # worker processes serving the same ports, None when alone
+        self.socket = bind_socket(port, group is not None)
+
+        # Single receive loop: routes responses to waiting requests and queues incoming requests,
+        # which are served fairly and within the upload rates by the serving thread
+        self.dispatcher = Dispatcher(self.socket, self.handle_request, DATAGRAM_SIZE, self.uploads)
+        self.dispatcher.start()
         
         # Initialize and bootstrap DHT node
-        self.node = DHT_node.DHTNode(IP, dht_port)
+        self.node = DHT_node.DHTNode(IP, dht_port, state_path=dht_state, group=group)
         self.node.start()
         self.node.bootstrap(self.get_dht())
         
         # Log peer startup and node creation
-        with log_lock:
-            with open('./log_file.txt', 'a') as log_file:
-                log_file.write(f"[{log_time()}] Peer {self.address} Connected\n")
-                log_file.write(f"[{log_time()}] Peer {self.address} Created node {self.node.ip}:{self.node.port}\n")
+        events.log(self.log_source, "Connected")
+        events.log(self.log_source, f"Created node {self.node.ip}:{self.node.port}")
         
-        # If peer has local files, announce them to the DHT
-        if os.path.isdir('./'+self.address):
-            all_file_names = os.listdir('./'+self.address)
-            for file in all_file_names:
-                if not os.path.isdir('./'+self.address+'/'+file):
-                    
-                    with log_lock:
-                        with open('./log_file.txt', 'a') as log_file:
-                            log_file.write(f"[{log_time()}] Peer {self.address} Announced {file}\n")
-                    
-                    self.node.announce_peer(file, IP, port)
+        # Announce the shared files to the DHT in the background while serving, then watch the
+        # storage for new and changed files. In a worker group the first worker does it for all,
+        # the others follow the index it saves
+        self.announcer = None
+        if group is None or group.index == 0:
+            self.announcer = threading.Thread(target=self.announce_share, daemon=True)
+            self.announcer.start()
+            threading.Thread(target=self.watch_share, daemon=True).start()
+        else:
+            threading.Thread(target=self.follow_share, daemon=True).start()
     
+    # State shared by the threaded and the asyncio runtime
+    def init_state(self, port: int, uploads: UploadScheduler = None, seed_cache: SeedCache = None):
+        self.port = port
+        self.address = IP+':'+str(port)
+        self.log_source = f"Peer {self.address}"
+        self.uploads = uploads or UploadScheduler() # queue and rate limits of the requests served to other peers
+
+        # Caches file sizes in packets and in bytes
+        self.files_size = {}
+        self.files_bytes = {}
+        self.files_root = {} # file name -> content root (hex) reported by the peers
+        self.files_chunk_limit = {} # file name -> largest chunk size the peers serve
+        self.chunk_size = CHUNK_SIZE # preferred transfer chunk size
+        self.manifests = {} # content root (hex) -> verified Manifest
+        self.lookup_cache = LookupCache() # peer lists and size replies of recent lookups
+        self.scheduler = DownloadScheduler() # requests in flight and bandwidth shared by the downloads
+
+        # Persistent index of the shared files and their manifests, and the open handles,
+        # mappings and metadata of the files
+        self.share_index = seed_cache.share_index if seed_cache else ShareIndex('./'+self.address, MSS)
+        self.seed_cache = seed_cache or SeedCache('./'+self.address, MSS, self.share_index)
+
+    # DHT keys of a shared file: its content root, so it joins the swarm of identical
+    # content, and its name, so it can be found by name
+    def file_keys(self, file_name: str):
+        manifest = self.seed_cache.manifest(file_name)
+        events.log(self.log_source, f"Announced {file_name} (root {manifest.root.hex()})")
+        return [manifest.root, DHT_node.name_key(file_name)]
+
+    # DHT keys of an indexed file, without reading its manifest
+    def index_keys(self, file_name: str):
+        return [bytes.fromhex(self.share_index.root(file_name)), DHT_node.name_key(file_name)]
+
+    # Announces a shared file under its content root and its name
+    def announce_file(self, file_name: str):
+        for key in self.file_keys(file_name):
+            self.node.announce_peer(key, IP, self.port)
+        self.share_index.announced([file_name])
+
+    # Announces many shared files at once, see DHTNode.bulk_announce
+    def announce_files(self, files: list):
+        keys = [key for file_name in files for key in self.file_keys(file_name)]
+        if keys:
+            self.node.bulk_announce(keys, IP, self.port)
+            self.share_index.announced(files)
+
+    # Scans the storage for new, changed and removed files (see ShareIndex.scan). Removed files
+    # are no longer republished. Returns the files not announced since `since`, the new and
+    # changed ones included
+    def share_changes(self, since: float = 0.0):
+        _, removed = self.share_index.scan()
+        self.seed_cache.refresh()
+        for file_name, root in removed:
+            self.seed_cache.invalidate(file_name)
+            self.node.forget([bytes.fromhex(root), DHT_node.name_key(file_name)], IP, self.port)
+            events.log(self.log_source, f"Stopped sharing {file_name}")
+        return self.share_index.unannounced(since)
+
+    # Files to announce at startup: the files announced within ANNOUNCE_FRESH are still stored
+    # in the DHT and only scheduled for republishing
+    def startup_announcements(self):
+        files = self.share_changes(time() - ANNOUNCE_FRESH)
+        for file_name in set(self.share_index.names()) - set(files):
+            self.node.remember(self.index_keys(file_name), IP, self.port)
+        return files
+
+    def announce_share(self):
+        self.announce_files(self.startup_announcements())
+
+    # Announces the files added to the storage or changed, every SCAN_INTERVAL
+    def watch_share(self):
+        self.announcer.join()
+        while self.dispatcher.running:
+            sleep(SCAN_INTERVAL)
+            self.announce_files(self.share_changes())
+
+    # Reloads the index saved by the first worker of the group every SCAN_INTERVAL, so the
+    # files it found are served by content root by this worker too
+    def follow_share(self):
+        while self.dispatcher.running:
+            sleep(SCAN_INTERVAL)
+            self.share_index.load()
+            self.seed_cache.refresh()
+
     # Reads well-known nodes from a text file to use for DHT bootstrap
     def get_dht(self):
         parsed_addr = []
@@ -76,189 +204,419 @@ class Peer:
                     parsed_addr.append(dht_addr)
 
         except Exception as e:
-            with log_lock:
-                with open('./log_file.txt', 'a') as log_file:
-                    log_file.write(f"[{log_time()}] Peer {self.address} Error: {e}\n")
+            events.log(self.log_source, f"Error: {e}", ERROR)
                 
             print(f"Error in get_dht {e}")
         
         return parsed_addr
     
     # Queries other peers for the size of a file in packets
-    def get_file_size(self, peers: list, filename: str):
-        file_size = -1
-        counter = 0
-        while (file_size == -1):
+    def get_file_size(self, peers: list, filename: str, attempts: int = SIZE_ATTEMPTS):
+        return self.parse_size(filename, self.request_size(peers, filename, attempts))
+
+    # Size response of a file from a random peer
+    def request_size(self, peers: list, filename: str, attempts: int = SIZE_ATTEMPTS):
+        for _ in range(attempts):
             peer_ip, peer_port = peers[randint(0, len(peers) - 1)]
             peer_port = int(peer_port)
-            request = f"size|{filename}".encode()
-            self.socket.sendto(request, (peer_ip, peer_port))
-            
-            data, _ = self.socket.recvfrom(PACKET_SIZE)
-            if (data):
-                parsed_data = data.split(b'|')
-                if (parsed_data[0].decode("utf-8") == "sizeof"):
-                    file_size = int(parsed_data[1].decode("utf-8"))
-                    self.files_size[filename] = file_size
-                
-                    with log_lock:
-                        with open('./log_file.txt', 'a') as log_file:
-                            log_file.write(f"[{log_time()}] Peer {self.address} Recieved size({file_size} packets) From {peer_ip}:{peer_port}\n")
-                        
-            counter += 1
-            if (counter == 1000):
-                with log_lock:
-                    with open('./log_file.txt', 'a') as log_file:
-                        log_file.write(f"[{log_time()}] Peer {self.address} Error: Impossible to get {filename} size\n")
-                
-                raise Exception(f"Impossible to get {filename} size")
-            
-    # Listens for incoming packet or size requests from other peers
-    def send_packet(self):
-        data, addr = self.socket.recvfrom(MSS) 
-        if (data):
-            parsed_data = data.split(b'|')
-            if (parsed_data[0].decode("utf-8") == "size"):
-                # Return file size if requested
-                file_size = math.ceil(os.path.getsize('./'+self.address+'/'+parsed_data[1].decode("utf-8")) / MSS)
-                response = f"sizeof|{file_size}".encode()
-            else:
-                # Return actual data packet
-                bytes_ = self.get_file_packet(parsed_data[1].decode("utf-8"), int(parsed_data[0].decode("utf-8")))
-                response = bytes(f"{parsed_data[0].decode()}|", "utf-8") + bytes_
-            self.socket.sendto(response, (addr))
-            
-                
-    # Retrieves specific file packet from disk
-    def get_file_packet(self, file_name, packet_number):
-        if not os.path.exists('./'+self.address+'/'+file_name):
-            with log_lock:
-                with open('./log_file.txt', 'a') as log_file:
-                    log_file.write(f"[{log_time()}] Peer {self.address} Error: don't have file {file_name}\n")
+            future = self.dispatcher.request(SIZE, filename.encode(), (peer_ip, peer_port))
+            try:
+                data, _ = future.result(timeout=REQUEST_TIMEOUT)
+            except FutureTimeout:
+                self.dispatcher.cancel(future)
+                continue
+
+            events.log(self.log_source, f"Recieved size({decode_size_reply(data)[0]} packets) From {peer_ip}:{peer_port}")
+            return data
+
+        events.log(self.log_source, f"Error: Impossible to get {filename} size", ERROR)
+
+        raise Exception(f"Impossible to get {filename} size")
+
+    # Size of a file in packets, from the lookup cache when a peer sent it recently
+    def file_size(self, peers: list, filename: str):
+        data = self.cached(("size", filename), lambda: self.request_size(peers, filename))
+        return self.parse_size(filename, data)
+
+    # Peers of a DHT key, from the lookup cache when a recent lookup found them (or found none)
+    def find_peers(self, key: bytes):
+        return self.cached(("peers", key), lambda: self.node.find_peers(key))
+
+    # Value of a cached lookup, `load()` runs on a miss. Concurrent misses of a key share one
+    # load, and an entry still in use when it is about to expire is reloaded in the background
+    def cached(self, key, load):
+        hit, value, refresh = self.lookup_cache.lookup(key)
+        if refresh:
+            threading.Thread(target=self.refresh_cached, args=(key, load), daemon=True).start()
+        if hit:
+            return value
+        return self.load_cached(key, load)
+
+    def load_cached(self, key, load):
+        future, owner = self.lookup_cache.start_load(key, Future)
+        if not owner:
+            return future.result()
+        try:
+            value = load()
+        except Exception as e:
+            self.lookup_cache.finish_load(key, error=e)
+            raise
+        self.lookup_cache.finish_load(key, value)
+        return value
+
+    # A failed refresh keeps the entry until it expires
+    def refresh_cached(self, key, load):
+        try:
+            self.load_cached(key, load)
+        except Exception:
+            pass
+
+    # Drops the cached lookups of a file, after its peers failed to serve it
+    def forget_lookups(self, filename: str):
+        self.lookup_cache.invalidate(("peers", self.lookup_key(filename)))
+        self.lookup_cache.invalidate(("size", filename))
+        if filename in self.files_root:
+            self.lookup_cache.invalidate(("peers", bytes.fromhex(self.files_root[filename])))
+
+    # What every peer of a finished transfer delivered
+    def log_transfer(self, transfer: SwarmScheduler, chunk_size: int):
+        for stats in transfer.peers.values():
+            events.log(self.log_source, f"Got {stats.delivered} chunks of {chunk_size} bytes From {stats.addr[0]}:{stats.addr[1]} "
+                       f"(failures: {stats.total_failures}, corrupt: {stats.corrupt})", sender=f"{stats.addr[0]}:{stats.addr[1]}",
+                       chunks=stats.delivered, chunk_size=chunk_size, failures=stats.total_failures, corrupt=stats.corrupt)
+
+    # Gauges of this peer and its DHT node in the metrics of the process
+    def register_metrics(self):
+        self.node.register_metrics()
+        metrics.gauge("peer.active_transfers", lambda: len(self.scheduler.slots))
+        metrics.gauge("peer.upload_queue", lambda: self.uploads.queued)
+        metrics.gauge("peer.uploaded_bytes", lambda: self.uploads.served_bytes)
+        metrics.gauge("peer.upload_drops", lambda: self.uploads.dropped)
+        metrics.gauge("peer.lookup_cache", lambda: self.lookup_cache.stats())
+        metrics.gauge("peer.shared_files", lambda: len(self.share_index.names()))
+        metrics.gauge("log.pending", lambda: len(events.pending))
+
+    # Counters of the upload scheduler for the log
+    def upload_stats(self):
+        stats = self.uploads.stats()
+        return (f"Served {stats['served']} requests ({stats['served_bytes']} bytes), {stats['queued']} queued "
+                f"(peak {stats['peak']}), {stats['dropped']} dropped")
+
+    # Counters of the lookup cache for the log
+    def lookup_stats(self):
+        stats = self.lookup_cache.stats()
+        return (f"Lookup cache saved {stats['saved']} DHT lookups and size requests ({stats['hits']} hits, "
+                f"{stats['negative_hits']} negative, {stats['shared']} shared, {stats['misses']} misses, {stats['refreshes']} refreshes)")
+
+    # Stores a size response (packets, bytes, max chunk size, content root), returns the size in packets
+    def parse_size(self, filename: str, data: bytes):
+        file_size, file_bytes, chunk_limit, root = decode_size_reply(data)
+        self.files_size[filename] = file_size
+        self.files_bytes[filename] = file_bytes
+        if root is not None:
+            self.files_root[filename] = root.hex()
+        self.files_chunk_limit[filename] = chunk_limit
+        return file_size
+
+    # Transfer chunk size negotiated for a file: the preferred chunk size, limited by what
+    # the peers serve and rounded down to a whole number of `unit` bytes
+    def negotiate_chunk_size(self, filename: str, unit: int):
+        limit = min(self.chunk_size, self.files_chunk_limit.get(filename, unit))
+        return max(unit, limit // unit * unit)
+
+    # Serves packet and size requests from other peers, called by the dispatcher.
+    # Files are requested by name or content root, `<root>.manifest` is the manifest of a root
+    def handle_request(self, msg_type: int, request_id: int, body: bytes, addr):
+        if msg_type == SIZE:
+            # Return file size if requested
+            key = body.decode("utf-8")
+            if key.endswith(MANIFEST_SUFFIX):
+                data = self.seed_cache.manifest(key[:-len(MANIFEST_SUFFIX)]).data
+                return encode_message(SIZEOF, request_id, encode_size_reply(-(-len(data) // MSS), len(data), MAX_CHUNK_SIZE))
+            manifest = self.seed_cache.manifest(key)
+            return encode_message(SIZEOF, request_id, encode_size_reply(manifest.chunks, manifest.size, MAX_CHUNK_SIZE, manifest.root))
+        if msg_type == GET:
+            # Return the requested byte ranges, fragmented
+            ranges, file_name = decode_get(body)
+            view = self.get_file_view(file_name)
+            # Headers and views of the mapped file, sent with scatter-gather
+            return data_fragments(request_id, view, ranges)
+        return None
+
+    # Blocks while the dispatcher serves requests
+    def serve(self):
+        while self.dispatcher.thread.is_alive():
+            self.dispatcher.thread.join(1)
+
+    # Retrieves the content of a file (or manifest) from disk
+    def get_file_view(self, file_name):
+        try:
+            if file_name.endswith(MANIFEST_SUFFIX):
+                return memoryview(self.seed_cache.manifest(file_name[:-len(MANIFEST_SUFFIX)]).data)
+            return self.seed_cache.view(file_name)
+        except FileNotFoundError:
+            events.log(self.log_source, f"Error: don't have file {file_name}", ERROR)
                 
             raise NameError(f"Peer {self.address} don't have file {file_name}")
         
-        with open('./'+self.address+'/'+file_name, 'rb') as file:
-            file.seek(MSS * packet_number)
-            bytes_ = file.read(MSS)
-            return bytes_
-        
-    # Downloads a file by requesting packets from random peers
-    def download_file(self, filename: str):
-        print(f'Requested {filename}')
-        peers = self.node.find_peers(filename)
+    # DHT key of a file given by name or by content root
+    def lookup_key(self, filename: str):
+        if is_content_root(filename):
+            return bytes.fromhex(filename)
+        return DHT_node.name_key(filename)
+
+    # Peers seeding a file, given by name or content root, and its size. Recent lookups are
+    # answered by the lookup cache, a missing file is remembered for NEGATIVE_TTL
+    def locate(self, filename: str):
+        peers = self.find_peers(self.lookup_key(filename))
         if (len(peers) == 0):
-            with log_lock:
-                with open('./log_file.txt', 'a') as log_file:
-                    log_file.write(f"[{log_time()}] Peer {self.address} Error: No available peers\n")
+            events.log(self.log_source, "Error: No available peers", ERROR)
                 
             raise Exception("No available peers")
         
-        with log_lock:
-            with open('./log_file.txt', 'a') as log_file:
-                log_file.write(f"[{log_time()}] Peer {self.address} Requested {filename}\n")
-            
-        self.get_file_size(peers, filename)
-        total_packets = self.files_size[filename]
+        events.log(self.log_source, f"Requested {filename}", file=filename)
 
-        bar = FillingSquaresBar('Downloading', max = total_packets)
-        current_packet = 0
+        try:
+            self.file_size(peers, filename)
+            if not is_content_root(filename):
+                # Seeders of the same content under any name
+                peers = self.find_peers(bytes.fromhex(self.files_root[filename])) or peers
+        except Exception:
+            self.forget_lookups(filename)
+            raise
+        return peers
 
-        # Download in batches of 10
-        while (current_packet < self.files_size[filename]):
-            with packet_map_lock:
-                packet_map.clear()
+    # Downloads a file, given by name or content root, from every peer seeding its content
+    def download_file(self, filename: str, priority: int = DEFAULT_PRIORITY, progress: bool = True):
+        print(f'Requested {filename}')
+        start = perf_counter()
+        peers = self.locate(filename)
+        try:
+            self.fetch_file(peers, filename, priority, progress)
+        except Exception:
+            self.forget_lookups(filename)
+            metrics.count("peer.failed_downloads")
+            raise
+        metrics.observe("peer.download", perf_counter() - start)
 
-            expected_packets = set(range(current_packet, min(current_packet + PACKETS_PER_BATCH, total_packets)))
+        # Log file completion and announce to DHT
+        events.log(self.log_source, f"Recieved {filename}", file=filename)
+        events.log(self.log_source, self.lookup_stats(), **self.lookup_cache.stats())
+        
+        print(f"\n{filename} successfully downloaded!")
+        self.announce_file(filename)
 
-            # Loop until all packets in the batch are received
+    # Downloads many files, [(file name or content root, priority)], `max_active` at a time: the
+    # highest priorities start first and get a larger share of the requests in flight. Every
+    # transfer keeps its own state. Returns {file name: error} of the failed downloads
+    def download_files(self, files: list, max_active: int = MAX_ACTIVE_DOWNLOADS):
+        queue = DownloadQueue(files)
+        progress = len(queue) == 1
+        failed = {}
+
+        def worker():
             while True:
-                with packet_map_lock:
-                    missing = expected_packets - set(packet_map.keys())
+                item = queue.next()
+                if item is None:
+                    return
+                filename, priority = item
+                try:
+                    self.download_file(filename, priority, progress)
+                except Exception as e:
+                    failed[filename] = e
+                    print(f"Download of {filename} failed: {e}")
 
-                if not missing:
-                    break
+        workers = [threading.Thread(target=worker) for _ in range(min(max_active, len(queue)))]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        return failed
 
-                threads = []
-                for pkt_num in missing:
-                    t = threading.Thread(target=self.thread_function,
-                                        args=(peers, pkt_num, filename))
-                    t.start()
-                    threads.append(t)
+    # Downloads the manifest of a content root. A manifest can only be checked as a whole, so
+    # if the one fetched from the whole swarm does not hash to the root, it is fetched from
+    # one peer at a time until a peer serves a valid one
+    def get_manifest(self, peers: list, root: str):
+        if root in self.manifests:
+            return self.manifests[root]
+        key = root + MANIFEST_SUFFIX
+        for sources in [peers] + [[peer] for peer in peers]:
+            try:
+                self.get_file_size(sources, key, MANIFEST_ATTEMPTS * len(sources))
+                buffer = self.manifest_buffer(root, key)
+                chunk_size = self.negotiate_chunk_size(key, MSS)
+                assembler = ChunkAssembler(len(buffer), chunk_size, buffer_store(buffer, chunk_size))
+                transfer = SwarmScheduler(assembler.chunks, sources, time(), max_window=max_window(chunk_size))
+                self.run_transfer(transfer, key, assembler, deadline=time() + MANIFEST_TIMEOUT)
+            except Exception:
+                continue
+            manifest = self.check_manifest(root, buffer, sources)
+            if manifest is not None:
+                return manifest
 
-                for t in threads:
-                    t.join()
+        events.log(self.log_source, f"Error: No valid manifest of {root}", ERROR)
+        raise Exception(f"No valid manifest of {root}")
 
-            for _ in range(PACKETS_PER_BATCH):
-                bar.next()
-            
-            self.write_file(packet_map, filename)
-            current_packet += len(packet_map)
-        
-        # Log file completion and announce to DHT
-        with log_lock:
-            with open('./log_file.txt', 'a') as log_file:    
-                log_file.write(f"[{log_time()}] Peer {self.address} Recieved {filename}\n")
-                log_file.write(f"[{log_time()}] Peer {self.address} Announced {filename}\n")
-        
-        print(f"\n{filename} successfully downloaded!")
-        self.node.announce_peer(filename, IP, self.port)
-
-    # Thread function to download a single packet
-    def thread_function(self, peers: list, packet_number: int, filename: str):
-        peer_ip, peer_port = peers[randint(0, len(peers) - 1)]
-        peer_port = int(peer_port)
+    # Buffer the manifest of `root` is downloaded into, sized from the byte count its seeders
+    # reported. Raises ValueError, before allocating anything, for a count no manifest has
+    def manifest_buffer(self, root: str, key: str):
+        size = self.files_bytes[key]
+        if not valid_manifest_size(size):
+            events.log(self.log_source, f"Rejected manifest size {size} of {root}", WARNING)
+            raise ValueError(f"Bad manifest size {size}")
+        return bytearray(size)
 
+    # Decodes a manifest downloaded from `sources` and caches it, None if it does not hash to the requested root
+    def check_manifest(self, root: str, data, sources: list):
         try:
-            request = f"{packet_number}|{filename}".encode()
-            self.socket.sendto(request, (peer_ip, peer_port))
-                
-            data, _ = self.socket.recvfrom(PACKET_SIZE + len(str(packet_number)) + 1)
-            parsed_data = data.split(b'|')
-            received_number = -1
-            if (parsed_data):
-                received_number = int(parsed_data[0].decode("utf-8"))
-
-            with log_lock:
-                with open('./log_file.txt', 'a') as log_file:    
-                    log_file.write(f"[{log_time()}] Peer {self.address} Recieved Packet {packet_number} From {peer_ip}:{peer_port}\n")
-                
-            # Store packet to the map where key is a packet number, value is a packet itself
-            with packet_map_lock:
-                packet_map[received_number] = data
+            manifest = Manifest.decode(bytes(data))
+        except ValueError:
+            manifest = None
+        if manifest is None or manifest.root.hex() != root:
+            events.log(self.log_source, f"Rejected invalid manifest of {root} From {len(sources)} peers", WARNING)
+            return None
+        self.manifests[root] = manifest
+        return manifest
 
-        except Exception as e:
-            print(f"Thread error: {e}")
-
-    # Writes downloaded packets to file in correct order
-    def write_file(self, packets:dict, file_name:str):
-        keys = list(packets.keys())
-        keys.sort()
-        
+    # Opens the preallocated download target of a file, resuming a previous partial download
+    def open_target(self, filename: str, manifest: Manifest):
         if not os.path.exists('./'+self.address):
             os.makedirs('./' + self.address)
-        
-        # If it is the first backet of packets, then create a file
-        if (keys[0] == 0):
-            file = open('./'+self.address+'/'+file_name, mode='w')
-            file.close()
+        self.seed_cache.invalidate(filename)
+        target = PartialFile('./'+self.address+'/'+filename, manifest.size, manifest.chunk_size, manifest)
+        if target.count > 0:
+            print(f"Resuming {filename}: {target.count}/{target.chunks} packets on disk")
+            events.log(self.log_source, f"Resumed {filename} ({target.count}/{target.chunks} packets on disk)")
+        return target
 
-        file = open('./'+self.address+'/'+file_name, mode='ab')
+    # Drives a transfer through the dispatcher: requests the missing ranges of the chunks of `key`
+    # as the peer windows allow, reassembles the fragments and re-requests lost and corrupt chunks.
+    # The requests of all the transfers of the peer go through its scheduler, with `priority`.
+    # Raises TimeoutError if the transfer is not done by `deadline`
+    def run_transfer(self, transfer: SwarmScheduler, key: str, assembler: ChunkAssembler, on_packet=None, deadline=None,
+                     priority: int = DEFAULT_PRIORITY):
+        responses = Queue()
+        outstanding = set()
+        # Fragments are reassembled by the dispatcher from its receive buffer
+        sink = fragment_writer(assembler)
+        slot = self.scheduler.register(priority)
+
+        try:
+            while not transfer.done():
+                if deadline is not None and time() > deadline:
+                    raise TimeoutError(f"Transfer of {key} timed out")
+                requests, held_back = self.scheduler.take(slot, transfer, assembler.chunk_length(0), time())
+                for pkt_num, peer_addr in requests:
+                    request = encode_get(assembler.missing(pkt_num), key)
+                    future = self.dispatcher.request(GET, request, peer_addr, sink)
+                    outstanding.add(future)
+                    future.add_done_callback(responses.put)
+
+                timeout = transfer.next_timeout(time())
+                if held_back:
+                    timeout = min(timeout, self.scheduler.retry_delay(time()))
+                try:
+                    future = responses.get(timeout=timeout)
+                    outstanding.discard(future)
+                    packet_number, addr = future.result()
+                except CorruptChunk as e:
+                    packet_number = -1
+                    transfer.on_corrupt(e.number, e.addr, time())
+                    metrics.count("peer.corrupt_chunks")
+                    events.log(self.log_source, f"Rejected corrupt Chunk {e.number} From {e.addr[0]}:{e.addr[1]}", WARNING)
+                except (Empty, ValueError):
+                    packet_number = -1
+
+                if packet_number >= 0 and transfer.on_packet(packet_number, addr, time()):
+                    metrics.count("peer.chunks_received")
+                    metrics.count("peer.bytes_received", assembler.chunk_length(packet_number))
+                    if on_packet:
+                        on_packet(packet_number, addr)
+
+                transfer.expire(time())
+        finally:
+            metrics.count("peer.retransmits", sum(transfer.retries.values()))
+            self.scheduler.unregister(slot)
+            # Late responses of retransmitted packets are no longer awaited
+            for future in outstanding:
+                self.dispatcher.cancel(future)
+
+    # Pipelined multi-source download: keeps a window of chunk requests in flight per peer,
+    # re-requests the missing fragments of a chunk on timeouts and writes chunks at their offsets
+    # as they complete. Chunks of the negotiated size are requested by content root and verified
+    # against the manifest before they are written. The progress bar is left out when
+    # several files are downloaded at once
+    def fetch_file(self, peers: list, filename: str, priority: int = DEFAULT_PRIORITY, progress: bool = True):
+        root = self.files_root[filename]
+        manifest = self.get_manifest(peers, root)
+        target = self.open_target(filename, manifest)
+        chunk_size = self.negotiate_chunk_size(filename, manifest.chunk_size)
+        assembler = ChunkAssembler(manifest.size, chunk_size, target_store(target, chunk_size))
+        completed = target.completed(chunk_size // manifest.chunk_size)
+        transfer = SwarmScheduler(assembler.chunks, peers, time(), completed, max_window(chunk_size))
+        bar = FillingSquaresBar('Downloading', max = assembler.chunks) if progress else None
+        if bar:
+            bar.goto(len(completed))
+
+        def on_packet(chunk_number, addr):
+            if bar:
+                bar.next()
+            if events.packet():
+                events.log(self.log_source, f"Recieved Chunk {chunk_number} From {addr[0]}:{addr[1]}", DEBUG,
+                           chunk=chunk_number, sender=f"{addr[0]}:{addr[1]}")
+
+        try:
+            self.run_transfer(transfer, root, assembler, on_packet, priority=priority)
+        finally:
+            target.close()
+        if bar:
+            bar.finish()
+        self.seed_cache.register(filename, manifest)
+
+        self.log_transfer(transfer, chunk_size)
 
-        for key in keys:
-            # len(str(key)) + 1 to offset packet number and '|' symbol
-            file.write(packets[key][len(str(key)) + 1:])
-        file.close()
-    
     # Shutdown of a peer
     def shutdown(self):
+        self.dispatcher.stop()
         self.socket.close()
+        self.seed_cache.close()
+        events.log(self.log_source, self.upload_stats(), **self.uploads.stats())
+        events.log(self.log_source, f"Shut down Node {self.node.ip}:{self.node.port}")
+        events.log(self.log_source, "Disconnected")
+        # Ends the process, the queued events are written on exit
         self.node.shutdown()
-        with log_lock:
-            with open('./log_file.txt', 'a') as log_file:
-                log_file.write(f"[{log_time()}] Peer {self.address} Shut down Node {self.node.ip}:{self.node.port}\n")
-                log_file.write(f"[{log_time()}] Peer {self.address} Disconnected\n")
-        
+
+
+# Serving worker of a peer started with --workers: a Peer of its own on the shared ports, serving
+# the files the parent process mapped and hashed. Worker i serves its metrics on STATS_PORT + i
+# and writes them to STATS_FILE.i
+def serve_worker(group: WorkerGroup, port: int, dht_port: int, dht_state: str, uploads: UploadScheduler,
+                 seed_cache: SeedCache, stats_port: int = None, stats_file: str = None, stats_interval: float = SNAPSHOT_INTERVAL):
+    peer = Peer(port, dht_port, dht_state if group.index == 0 else None, uploads, seed_cache, group)
+    peer.register_metrics()
+    if stats_port is not None or stats_file:
+        StatsServer(None if stats_port is None else stats_port + group.index,
+                    f"{stats_file}.{group.index}" if stats_file else None, stats_interval).start()
+    try:
+        peer.serve()
+    except KeyboardInterrupt:
+        peer.shutdown()
+
+# Starts `count` worker processes serving the ports of a peer. The shared files are indexed and
+# mapped once, before the workers are forked. A client is always served by the same worker,
+# so the global upload rate is split between them and the rate of a client holds as it is.
+# Only the first worker keeps the DHT state, the others start with its node id
+def start_peer_workers(count: int, port: int, dht_port: int, dht_state: str = None, upload_rate: float = None,
+                       client_upload_rate: float = None, max_queued: int = MAX_QUEUED_REQUESTS, stats: tuple = ()):
+    share_index = ShareIndex('./'+IP+':'+str(port), MSS)
+    share_index.scan()
+    seed_cache = SeedCache('./'+IP+':'+str(port), MSS, share_index)
+    seed_cache.preload()
+    uploads = UploadScheduler(upload_rate / count if upload_rate else None, client_upload_rate, max_queued)
+    loaded = NodeState(dht_state).load() if dht_state else None
+    return start_workers(count, serve_worker, (port, dht_port, dht_state, uploads, seed_cache, *stats),
+                         node_id=loaded[0] if loaded else None)
+
 
 if __name__ == '__main__':
     # Ensure log file exists
@@ -269,7 +627,29 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('peer_port', type=int)
     parser.add_argument('dht_port', type=int)
-    parser.add_argument('--file', type=str, required=False)
+    parser.add_argument('--file', type=str, nargs='+', required=False, help='Files (names or content roots) to download')
+    parser.add_argument('--file-list', type=str, required=False, help='Text file of files to download, one per line, optionally followed by a priority')
+    parser.add_argument('--max-downloads', type=int, default=MAX_ACTIVE_DOWNLOADS, help='Files downloaded at the same time')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT, help='Chunk requests in flight across all downloads')
+    parser.add_argument('--max-rate', type=float, required=False, help='Download bandwidth limit across all downloads (KB/s)')
+    parser.add_argument('--upload-rate', type=float, required=False, help='Upload bandwidth limit across all clients (KB/s)')
+    parser.add_argument('--client-upload-rate', type=float, required=False, help='Upload bandwidth limit of each client (KB/s)')
+    parser.add_argument('--max-queued', type=int, default=MAX_QUEUED_REQUESTS, help='Requests waiting to be served before new ones are dropped')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='Run the peer on the asyncio runtime')
+    parser.add_argument('--workers', type=int, default=1, help='Processes serving the peer and DHT ports (SO_REUSEPORT), serving only')
+    parser.add_argument('--dht-state', type=str, required=False, help='File keeping the DHT node id, contacts and stored peers across restarts')
+    parser.add_argument('--log-level', choices=LEVELS, default='info', help='Least level of the logged events, debug logs every received packet')
+    parser.add_argument('--log-sample', type=int, default=PACKET_SAMPLE, help='Log one per-packet event in LOG_SAMPLE')
+    parser.add_argument('--log-json', action='store_true', help='Write the log as JSON lines')
+    parser.add_argument('--log-max-mb', type=float, required=False, help='Rotate the log once it is larger (MB)')
+    parser.add_argument('--stats-port', type=int, required=False, help='Serve metrics and profiling on http://127.0.0.1:STATS_PORT/')
+    parser.add_argument('--stats-file', type=str, required=False, help='Write a metrics snapshot (JSON) to this file periodically')
+    parser.add_argument('--stats-interval', type=float, default=SNAPSHOT_INTERVAL, help='Seconds between two snapshots written to --stats-file')
+    args = parser.parse_args()
+    if args.max_queued < 1:
+        parser.error('--max-queued must be at least 1')
+    events.configure(LEVELS[args.log_level], args.log_sample, args.log_json,
+                     int(args.log_max_mb * 1024 * 1024) if args.log_max_mb else None)
 
     # Create bootstrap DHT nodes if needed
     if not os.path.exists('./well_known_nodes.txt'):
@@ -285,26 +665,48 @@ if __name__ == '__main__':
                 well_known_nodes.append(addr)
                 file.write(f"{addr}\n")
                 
-                with log_lock:
-                    with open('./log_file.txt', 'a') as log_file:
-                        log_file.write(f"[{log_time()}] Created well-known node {IP}:{port}\n")
+                events.log(None, f"Created well-known node {IP}:{port}")
 
     # Create peer and either serve or download
-    args = parser.parse_args()
-    peer = Peer(args.peer_port, args.dht_port)
+    files = [(file, DEFAULT_PRIORITY) for file in args.file or []]
+    if args.file_list:
+        files += read_download_list(args.file_list)
+    if args.workers > 1:
+        if files or args.use_async:
+            parser.error('--workers only serves, it runs without --file, --file-list and --async')
+        processes = start_peer_workers(args.workers, args.peer_port, args.dht_port, args.dht_state,
+                                       args.upload_rate * 1024 if args.upload_rate else None,
+                                       args.client_upload_rate * 1024 if args.client_upload_rate else None, args.max_queued,
+                                       (args.stats_port, args.stats_file, args.stats_interval))
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            # The workers got the interrupt too and shut down
+            for process in processes:
+                process.join()
+        sys.exit(0)
+    scheduler = DownloadScheduler(args.max_in_flight, args.max_rate * 1024 if args.max_rate else None)
+    uploads = UploadScheduler(args.upload_rate * 1024 if args.upload_rate else None,
+                              args.client_upload_rate * 1024 if args.client_upload_rate else None, args.max_queued)
+    if args.stats_port is not None or args.stats_file:
+        StatsServer(args.stats_port, args.stats_file, args.stats_interval).start()
+    if args.use_async:
+        import asyncio
+        import async_runtime
+        try:
+            asyncio.run(async_runtime.run_peer(args.peer_port, args.dht_port, files, args.dht_state, scheduler, args.max_downloads, uploads))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    peer = Peer(args.peer_port, args.dht_port, args.dht_state, uploads)
+    peer.scheduler = scheduler
+    peer.register_metrics()
     try:
-        if not args.file:
-            while True:
-                peer.send_packet()
-        else:
-            peer.download_file(args.file)
-            while True:
-                peer.send_packet()
+        if files:
+            peer.download_files(files, args.max_downloads)
+        peer.serve()
     except KeyboardInterrupt:
         peer.shutdown()
-        with log_lock:
-            with open('./log_file.txt', 'a') as log_file:
-                log_file.write(f"[{log_time()}] Peer {peer.address} Shut down Node {peer.node.ip}:{peer.node.port}\n")
-                log_file.write(f"[{log_time()}] Peer {peer.address} Disconnected\n")
-
         sys.exit(0)
\ No newline at end of file
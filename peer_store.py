@@ -0,0 +1,134 @@
+from threading import Lock
+from time import time
+
+from wire import pack_peer
+
+
+# Configuration constants
+PEER_TTL = 1800 # Seconds an announcement is kept unless it is renewed
+EXPIRY_GRANULARITY = 60 # Width of a timer wheel slot (seconds), a record outlives its TTL by less than this
+MAX_PEERS_PER_KEY = 1000 # Peers kept under one key, the least recently announced one is dropped first
+MAX_RECORDS = 1000000 # Peers kept under all keys (about 500 MB), the one closest to expiry is dropped first
+
+
+# A peer stored under a key: its entry in PEERS replies and when it expires
+class PeerRecord:
+    __slots__ = ("key", "addr", "entry", "expires")
+
+    def __init__(self, key, addr, entry, expires):
+        self.key = key
+        self.addr = addr
+        self.entry = entry
+        self.expires = expires
+
+
+# Peers announced under DHT keys. Every key maps (ip, port) to the record of the peer,
+# least recently announced first, so storing, renewing and reading peers never scans
+# other keys. Records are also filed in a timer wheel by expiry time: expiring drops
+# the slots that ended as a whole and never visits the records that are still alive
+class PeerStore:
+    def __init__(self, ttl=PEER_TTL, max_per_key=MAX_PEERS_PER_KEY, max_records=MAX_RECORDS):
+        self.ttl = ttl
+        self.max_per_key = max_per_key
+        self.max_records = max_records
+        self.keys = {} # key -> {(ip, port): PeerRecord}
+        self.wheel = {} # expiry slot -> {PeerRecord}
+        self.records = 0
+        self.expired_until = 0 # slots before this one are expired
+        self.journal = None # NodeState recording the stored and evicted peers, if any
+        self.lock = Lock()
+
+    def __len__(self):
+        return self.records
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    # Timer wheel slot of an expiry time
+    def slot(self, expires):
+        return int(expires // EXPIRY_GRANULARITY)
+
+    # Add a peer under a key or renew its announcement, until `expires` (by default the TTL from now)
+    def store(self, key, ip, port, now=None, expires=None):
+        now = time() if now is None else now
+        addr = (ip, port)
+        expires = now + self.ttl if expires is None else expires
+        if expires <= now:
+            return
+        with self.lock:
+            self.expire(now)
+            peers = self.keys.get(key)
+            record = peers.get(addr) if peers is not None else None
+            if record is None:
+                if peers is not None and len(peers) >= self.max_per_key:
+                    self.remove(key, next(iter(peers)))
+                elif self.records >= self.max_records:
+                    self.evict()
+                peers = self.keys.setdefault(key, {})
+                record = peers[addr] = PeerRecord(key, addr, pack_peer(ip, port), expires)
+                self.records += 1
+            else:
+                self.wheel[self.slot(record.expires)].discard(record)
+                record.expires = expires
+                del peers[addr]
+                peers[addr] = record
+            self.wheel.setdefault(self.slot(expires), set()).add(record)
+            if self.journal:
+                self.journal.peer_stored(record)
+
+    # Records of the peers stored under a key
+    def get(self, key, now=None):
+        with self.lock:
+            self.expire(time() if now is None else now)
+            peers = self.keys.get(key)
+            return list(peers.values()) if peers is not None else []
+
+    # (ip, port) of the peers stored under a key
+    def addresses(self, key, now=None):
+        with self.lock:
+            self.expire(time() if now is None else now)
+            peers = self.keys.get(key)
+            return list(peers) if peers is not None else []
+
+    # Records of every stored peer
+    def all_records(self, now=None):
+        with self.lock:
+            self.expire(time() if now is None else now)
+            return [record for peers in self.keys.values() for record in peers.values()]
+
+    # Drop a record to make room, the journal records it so it stays dropped after a restart.
+    # Called with the lock held
+    def remove(self, key, addr):
+        peers = self.keys[key]
+        record = peers.pop(addr)
+        if not peers:
+            del self.keys[key]
+        self.wheel[self.slot(record.expires)].discard(record)
+        self.records -= 1
+        if self.journal:
+            self.journal.peer_removed(record)
+
+    # Drop a record of the earliest slot to make room. Called with the lock held
+    def evict(self):
+        while self.wheel:
+            slot = min(self.wheel)
+            if self.wheel[slot]:
+                record = next(iter(self.wheel[slot]))
+                self.remove(record.key, record.addr)
+                return
+            del self.wheel[slot]
+
+    # Drop the records of every slot that ended. Only runs when a new slot began since
+    # the last call, since new records always land in later slots. Called with the lock held
+    def expire(self, now):
+        current = self.slot(now)
+        if current <= self.expired_until:
+            return
+        self.expired_until = current
+        for slot in [slot for slot in self.wheel if slot < current]:
+            for record in self.wheel.pop(slot):
+                peers = self.keys[record.key]
+                del peers[record.addr]
+                if not peers:
+                    del self.keys[record.key]
+                self.records -= 1
@@ -0,0 +1,190 @@
+from collections import OrderedDict
+from random import getrandbits
+from threading import Lock
+from time import time
+
+from wire import pack_contact
+
+
+# Configuration constants
+ID_BITS = 160 # Length of node ids and keys (SHA-1), one bucket per bit
+BUCKET_SIZE = 8 # Nodes per k-bucket (Kademlia k)
+PING_TIMEOUT = 2.0 # Seconds the least recently seen node of a full bucket has to answer a ping
+STALE_FAILURES = 3 # Unanswered queries in a row after which a node is dropped
+
+
+# Kademlia XOR distance of two ids as an integer
+def distance(id1, id2):
+    return int.from_bytes(id1, 'big') ^ int.from_bytes(id2, 'big')
+
+
+# Info about dht nodes
+class DHTNodeInfo:
+    def __init__(self, ip, port, distance, id):
+        self.ip = ip
+        self.port = port
+        self.last_seen = time()
+        self.distance = distance
+        self.id = id
+        self.failures = 0
+        self.contact = pack_contact(id, ip, port) # entry of the node in NODES replies
+
+    def ping(self):
+        self.last_seen = time()
+        self.failures = 0
+
+
+# Nodes whose distance from the own id has the same highest bit, least recently seen first.
+# Nodes met while the bucket is full wait in the replacement cache
+class KBucket:
+    def __init__(self):
+        self.nodes = OrderedDict() # node id -> DHTNodeInfo
+        self.replacements = OrderedDict() # node id -> DHTNodeInfo, most recently seen last
+        self.updated_at = time()
+
+
+# Kademlia routing table: ID_BITS k-buckets, bucket i holds the nodes at a distance
+# in [2^i, 2^(i+1)) from the own id. Live nodes are never evicted: when a bucket is
+# full the newcomer goes to the replacement cache and the least recently seen node
+# is returned to be pinged; it is replaced only if it does not answer within PING_TIMEOUT
+class RoutingTable:
+    def __init__(self, node_id, bucket_size=BUCKET_SIZE):
+        self.node_id = node_id
+        self.id = int.from_bytes(node_id, 'big')
+        self.bucket_size = bucket_size
+        self.buckets = [KBucket() for _ in range(ID_BITS)]
+        self.pinging = {} # node id -> deadline of its ping, in ping order
+        self.journal = None # NodeState recording the nodes that join and leave the buckets, if any
+        self.lock = Lock()
+
+    # Bucket of a node id, -1 for the own id
+    def bucket_index(self, node_id):
+        return (self.id ^ int.from_bytes(node_id, 'big')).bit_length() - 1
+
+    def __len__(self):
+        return sum(len(bucket.nodes) for bucket in self.buckets)
+
+    def __contains__(self, node_id):
+        index = self.bucket_index(node_id)
+        return index >= 0 and node_id in self.buckets[index].nodes
+
+    def get(self, node_id):
+        index = self.bucket_index(node_id)
+        return self.buckets[index].nodes.get(node_id) if index >= 0 else None
+
+    # Buckets that hold nodes, about log2 of the size of the network
+    def depth(self):
+        return sum(1 for bucket in self.buckets if bucket.nodes)
+
+    # All nodes of the table
+    def nodes(self):
+        with self.lock:
+            return [node for bucket in self.buckets for node in bucket.nodes.values()]
+
+    # Record a node that was heard from. Returns the node that has to be pinged
+    # before it can be evicted for this one, None otherwise
+    def update(self, node_id, ip, port, now=None):
+        now = time() if now is None else now
+        with self.lock:
+            self.expire(now)
+            index = self.bucket_index(node_id)
+            if index < 0:
+                return None
+            bucket = self.buckets[index]
+            bucket.updated_at = now
+            node = bucket.nodes.get(node_id)
+            if node is not None:
+                node.ping()
+                if (node.ip, node.port) != (ip, port):
+                    node.ip, node.port = ip, port
+                    node.contact = pack_contact(node_id, ip, port)
+                    if self.journal:
+                        self.journal.contact_added(node)
+                bucket.nodes.move_to_end(node_id)
+                self.pinging.pop(node_id, None)
+                return None
+            new_node = DHTNodeInfo(ip, port, self.id ^ int.from_bytes(node_id, 'big'), node_id)
+            if len(bucket.nodes) < self.bucket_size:
+                bucket.nodes[node_id] = new_node
+                if self.journal:
+                    self.journal.contact_added(new_node)
+                return None
+
+            bucket.replacements.pop(node_id, None)
+            bucket.replacements[node_id] = new_node
+            if len(bucket.replacements) > self.bucket_size:
+                bucket.replacements.popitem(last=False)
+            oldest_id, oldest = next(iter(bucket.nodes.items()))
+            if oldest_id in self.pinging:
+                return None
+            self.pinging[oldest_id] = now + PING_TIMEOUT
+            return oldest
+
+    # Drop a node that stopped answering, the most recently seen replacement takes its place
+    def remove(self, node_id):
+        index = self.bucket_index(node_id)
+        if index < 0:
+            return
+        bucket = self.buckets[index]
+        self.pinging.pop(node_id, None)
+        if bucket.nodes.pop(node_id, None) is None:
+            return
+        if self.journal:
+            self.journal.contact_removed(node_id)
+        if bucket.replacements:
+            replacement_id, replacement = bucket.replacements.popitem()
+            bucket.nodes[replacement_id] = replacement
+            if self.journal:
+                self.journal.contact_added(replacement)
+
+    # Count a query the node did not answer, it is dropped after STALE_FAILURES in a row
+    def fail(self, node_id):
+        with self.lock:
+            node = self.get(node_id)
+            if node is None:
+                return
+            node.failures += 1
+            if node.failures >= STALE_FAILURES:
+                self.remove(node_id)
+
+    # Evict the pinged nodes whose ping timed out. Called with the lock held
+    def expire(self, now):
+        for node_id, deadline in list(self.pinging.items()):
+            if deadline > now:
+                break
+            self.remove(node_id)
+
+    # The `count` nodes closest to a target. Buckets are visited in order of distance
+    # from the target: its own bucket, then every closer bucket, then the farther ones
+    # one by one, so only the buckets that can hold the result are sorted
+    def closest(self, target_id, count, now=None):
+        target = self.id ^ int.from_bytes(target_id, 'big')
+        index = target.bit_length() - 1
+        with self.lock:
+            self.expire(time() if now is None else now)
+            groups = []
+            if index >= 0:
+                groups.append(self.buckets[index].nodes.values())
+                groups.append([node for bucket in self.buckets[:index] for node in bucket.nodes.values()])
+            groups.extend(bucket.nodes.values() for bucket in self.buckets[index + 1:])
+
+            candidates = []
+            for group in groups:
+                candidates.extend(group)
+                if len(candidates) >= count:
+                    break
+        target = int.from_bytes(target_id, 'big')
+        candidates.sort(key=lambda node: int.from_bytes(node.id, 'big') ^ target)
+        return candidates[:count]
+
+    # Random ids in the range of every non-empty bucket that saw no traffic for `interval` seconds
+    def refresh_targets(self, interval, now=None):
+        now = time() if now is None else now
+        targets = []
+        with self.lock:
+            for index, bucket in enumerate(self.buckets):
+                if bucket.nodes and now - bucket.updated_at >= interval:
+                    bucket.updated_at = now
+                    target = self.id ^ (1 << index | getrandbits(index)) if index > 0 else self.id ^ 1
+                    targets.append(target.to_bytes(ID_BITS // 8, 'big'))
+        return targets
@@ -0,0 +1,177 @@
+import os
+import mmap
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+from manifest import Manifest, is_content_root
+from partial_file import JOURNAL_SUFFIX, journal_path
+
+
+# Configuration constants
+MAX_OPEN_FILES = 64 # Shared files kept open and mapped at once
+CHECK_INTERVAL = 1.0 # Seconds a file's metadata is trusted before it is checked again
+
+
+# Metadata and read-only mapping of one shared file
+class SharedFile:
+    def __init__(self, name, path, stat, chunk_size):
+        self.name = name
+        self.path = path
+        self.size = stat.st_size
+        self.version = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        self.chunks = -(-self.size // chunk_size) # ceil
+        self.manifest = None
+        self.checked_at = time()
+        self.file = open(path, 'rb')
+        # Empty files can't be mapped
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else b""
+        self.view = memoryview(self.map)
+
+    def close(self):
+        self.view.release()
+        if self.size > 0:
+            try:
+                self.map.close()
+            except BufferError:
+                # A chunk view is still being sent, the mapping is closed when it is released
+                pass
+        self.file.close()
+
+
+# Serving-side cache of a peer storage: a bounded LRU pool of open, mapped files
+# with their size, chunk count and manifest. A file is stat()ed at most once per
+# CHECK_INTERVAL and remapped when it changed, so hot chunks are served from the
+# mapping without any filesystem calls. Files can be looked up by name or by the
+# content root (hex) of their manifest. With a ShareIndex, only the files it lists are served
+# and the known roots are those of the index, refreshed after each of its scans; manifests are
+# read from it and the ones computed here are added to it. Partial downloads and their journals
+# are never served nor hashed
+class SeedCache:
+    def __init__(self, directory, chunk_size, share_index=None, max_open=MAX_OPEN_FILES):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.share_index = share_index
+        self.max_open = max_open
+        self.files = OrderedDict() # file name -> SharedFile, least recently used first
+        self.roots = share_index.roots() if share_index else {} # content root (hex) -> (file name, file version) the manifest was computed for
+        self.names = {file_name for file_name, _ in self.roots.values()} # complete files served by name
+        self.lock = Lock()
+
+    # Cached entry of a file given by name or content root. Raises FileNotFoundError
+    # for files that are not in the storage (or not indexed), for unknown roots and for content that changed on disk
+    def get(self, key):
+        known = self.roots.get(key)
+        if known is None:
+            if is_content_root(key) or (self.share_index and key not in self.names):
+                raise FileNotFoundError(key)
+            return self.open(key)
+        file_name, version = known
+        entry = self.open(file_name)
+        if entry.version != version:
+            del self.roots[key]
+            raise FileNotFoundError(key)
+        return entry
+
+    # Take the roots of the index, after it was scanned or reloaded
+    def refresh(self):
+        if self.share_index:
+            roots = self.share_index.roots()
+            with self.lock:
+                self.roots = roots
+                self.names = {file_name for file_name, _ in roots.values()}
+
+    # Open, map and read the manifest of every indexed file now. Processes forked afterwards share
+    # the mappings (the same pages of the page cache) and the manifests instead of building their own
+    def preload(self):
+        with self.lock:
+            for file_name, version in list(self.roots.values()):
+                try:
+                    entry = self.open(file_name)
+                except FileNotFoundError:
+                    continue
+                if entry.version == version and entry.manifest is None:
+                    self.add_manifest(entry)
+
+    def add_manifest(self, entry):
+        entry.manifest = self.share_index.manifest(entry.name, entry.version) if self.share_index else None
+        if entry.manifest is None:
+            entry.manifest = Manifest.build(entry.map, self.chunk_size)
+            if self.share_index:
+                self.share_index.add(entry.name, entry.version, entry.manifest)
+        self.roots[entry.manifest.root.hex()] = (entry.name, entry.version)
+        self.names.add(entry.name)
+
+    # Cached entry of a file, (re)opened if it is new or changed on disk. Partial files are not opened
+    def open(self, file_name):
+        now = time()
+        entry = self.files.get(file_name)
+        if entry is not None and now - entry.checked_at < CHECK_INTERVAL:
+            self.files.move_to_end(file_name)
+            return entry
+
+        if '/' in file_name or file_name in ('', '.', '..'):
+            raise FileNotFoundError(file_name)
+        path = self.directory + '/' + file_name
+        if file_name.endswith(JOURNAL_SUFFIX) or os.path.exists(journal_path(path)):
+            raise FileNotFoundError(file_name)
+        stat = os.stat(path)
+        if entry is not None:
+            if entry.version == (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+                entry.checked_at = now
+                self.files.move_to_end(file_name)
+                return entry
+            self.files.pop(file_name).close()
+
+        entry = SharedFile(file_name, path, stat, self.chunk_size)
+        self.files[file_name] = entry
+        while len(self.files) > self.max_open:
+            _, oldest = self.files.popitem(last=False)
+            oldest.close()
+        return entry
+
+    # File size in bytes
+    def size(self, file_name):
+        with self.lock:
+            return self.get(file_name).size
+
+    # File size in chunks
+    def chunk_count(self, file_name):
+        with self.lock:
+            return self.get(file_name).chunks
+
+    # Read-only view of the whole mapping (no copy), slices of it are sent as they are
+    def view(self, key):
+        with self.lock:
+            return self.get(key).view[:]
+
+    # Manifest of the file content, computed once per file version
+    def manifest(self, key):
+        with self.lock:
+            entry = self.get(key)
+            if entry.manifest is None:
+                self.add_manifest(entry)
+            return entry.manifest
+
+    # Record the manifest of a file whose content was verified while downloading it, it is served from now on
+    def register(self, file_name, manifest):
+        with self.lock:
+            entry = self.open(file_name)
+            entry.manifest = manifest
+            self.roots[manifest.root.hex()] = (entry.name, entry.version)
+            self.names.add(entry.name)
+            if self.share_index:
+                self.share_index.add(entry.name, entry.version, manifest)
+
+    # Drop a file that is about to be rewritten, so it is never read through a stale mapping
+    def invalidate(self, file_name):
+        with self.lock:
+            entry = self.files.pop(file_name, None)
+            if entry is not None:
+                entry.close()
+
+    def close(self):
+        with self.lock:
+            for entry in self.files.values():
+                entry.close()
+            self.files.clear()
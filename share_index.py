@@ -0,0 +1,213 @@
+import json
+import mmap
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha1
+from threading import Lock
+from time import time
+
+from manifest import Manifest
+from partial_file import JOURNAL_SUFFIX, journal_path
+
+
+# Configuration constants
+INDEX_SUFFIX = ".index" # The index of the storage ./IP:PORT is kept in ./IP:PORT.index/
+INDEX_FILE = "index.json"
+SCAN_INTERVAL = 5.0 # Seconds between two scans of a storage for new, changed and removed files
+HASH_SLICE = 32 << 20 # Bytes of a file hashed by one task of the hashing processes, a multiple of every chunk size
+POOL_MIN_BYTES = 128 << 20 # Below this much to hash, files are hashed in the scanning thread
+HASH_WORKERS = os.cpu_count() or 1 # Processes hashing large scans
+
+
+# Complete files of a storage, partial downloads are not shared
+def complete_files(directory):
+    if not os.path.isdir(directory):
+        return []
+    files = []
+    for file_name in os.listdir(directory):
+        path = directory + '/' + file_name
+        if os.path.isdir(path) or file_name.endswith(JOURNAL_SUFFIX) or os.path.exists(journal_path(path)):
+            continue
+        files.append(file_name)
+    return files
+
+
+# Version of a file as the seed cache sees it: a file whose version changed is hashed again
+def file_version(stat):
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+# Chunk hashes of `length` bytes of a file from `offset`, run by the hashing processes.
+# None if the file was removed or truncated meanwhile
+def hash_slice(path, offset, length, chunk_size):
+    if length == 0:
+        return b""
+    try:
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), length, access=mmap.ACCESS_READ, offset=offset) as data:
+            view = memoryview(data)
+            try:
+                return b"".join(sha1(view[start:start + chunk_size]).digest() for start in range(0, length, chunk_size))
+            finally:
+                view.release()
+    except (OSError, ValueError):
+        return None
+
+
+# Persistent index of the shared files of a storage: the version (inode, size, mtime) of
+# every file, the content root of its manifest and when it was last announced, in
+# INDEX_FILE, and every manifest in a file of its own named after its root. A scan only
+# stat()s the files and hashes the new and changed ones, so a restarted peer neither hashes
+# nor announces again what it already did. Large scans are hashed by a pool of processes,
+# the files cut in slices of HASH_SLICE
+class ShareIndex:
+    def __init__(self, directory, chunk_size, path=None, workers=HASH_WORKERS):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.path = path or directory + INDEX_SUFFIX
+        self.workers = workers
+        self.files = {} # file name -> [inode, size, mtime ns, content root (hex), last announced]
+        self.lock = Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(f"{self.path}/{INDEX_FILE}") as file:
+                loaded = json.load(file)
+        except (OSError, ValueError):
+            return
+        # Manifests of another chunk size are of no use
+        if loaded.get("chunk_size") == self.chunk_size:
+            with self.lock:
+                self.files = loaded["files"]
+
+    # The index file is replaced as a whole, a crash leaves the previous one
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        temporary = f"{self.path}/{INDEX_FILE}.tmp"
+        with self.lock:
+            data = json.dumps({"chunk_size": self.chunk_size, "files": self.files})
+        with open(temporary, 'w') as file:
+            file.write(data)
+        os.replace(temporary, f"{self.path}/{INDEX_FILE}")
+
+    def names(self):
+        with self.lock:
+            return list(self.files)
+
+    def root(self, file_name):
+        with self.lock:
+            return self.files[file_name][3]
+
+    # content root (hex) -> (file name, version) of the indexed files
+    def roots(self):
+        with self.lock:
+            return {entry[3]: (file_name, tuple(entry[:3])) for file_name, entry in self.files.items()}
+
+    # Indexed manifest of a file version, None if the file is not indexed at this version
+    def manifest(self, file_name, version):
+        with self.lock:
+            entry = self.files.get(file_name)
+        if entry is None or tuple(entry[:3]) != version:
+            return None
+        try:
+            with open(f"{self.path}/{entry[3]}.manifest", 'rb') as file:
+                manifest = Manifest.decode(file.read())
+        except (OSError, ValueError):
+            return None
+        return manifest if manifest.root.hex() == entry[3] else None
+
+    # Record the manifest of a file version, e.g. one the seed cache computed or a download verified
+    def add(self, file_name, version, manifest):
+        root = manifest.root.hex()
+        os.makedirs(self.path, exist_ok=True)
+        if not os.path.exists(f"{self.path}/{root}.manifest"):
+            temporary = f"{self.path}/{root}.manifest.tmp"
+            with open(temporary, 'wb') as file:
+                file.write(manifest.data)
+            os.replace(temporary, f"{self.path}/{root}.manifest")
+        with self.lock:
+            old = self.files.get(file_name)
+            self.files[file_name] = [*version, root, 0.0]
+        if old is not None:
+            self.drop_manifest(old[3])
+
+    # Delete a manifest no indexed file has any more
+    def drop_manifest(self, root):
+        with self.lock:
+            if any(entry[3] == root for entry in self.files.values()):
+                return
+        try:
+            os.remove(f"{self.path}/{root}.manifest")
+        except FileNotFoundError:
+            pass
+
+    # Record that files were announced at `now`
+    def announced(self, names, now=None):
+        now = time() if now is None else now
+        with self.lock:
+            for file_name in names:
+                if file_name in self.files:
+                    self.files[file_name][4] = now
+        self.save()
+
+    # Indexed files never announced, or not since `since`
+    def unannounced(self, since=0.0):
+        with self.lock:
+            return [file_name for file_name, entry in self.files.items() if entry[4] <= since]
+
+    # Compare the storage with the index: new and changed files are hashed and indexed, removed
+    # ones dropped. Returns the names of the new and changed files and (name, root) of the removed ones
+    def scan(self):
+        current = {}
+        for file_name in complete_files(self.directory):
+            try:
+                current[file_name] = file_version(os.stat(self.directory + '/' + file_name))
+            except FileNotFoundError:
+                pass
+        with self.lock:
+            # A file indexed meanwhile (e.g. by the seed cache) was not listed yet but is not removed
+            removed = [(file_name, entry[3]) for file_name, entry in self.files.items()
+                       if file_name not in current and not os.path.exists(self.directory + '/' + file_name)]
+            for file_name, _ in removed:
+                del self.files[file_name]
+            changed = [file_name for file_name, version in current.items()
+                       if file_name not in self.files or tuple(self.files[file_name][:3]) != version]
+        for _, root in removed:
+            self.drop_manifest(root)
+
+        indexed = []
+        for file_name, hashes in self.hash_files([(file_name, current[file_name]) for file_name in changed]):
+            path = self.directory + '/' + file_name
+            try:
+                version = file_version(os.stat(path))
+            except FileNotFoundError:
+                continue
+            # A file written to while it was hashed is hashed again at the next scan
+            if version == current[file_name]:
+                self.add(file_name, version, Manifest(version[1], self.chunk_size, hashes))
+                indexed.append(file_name)
+        if indexed or removed:
+            self.save()
+        return indexed, removed
+
+    # (file name, chunk hashes) of files given as (name, version)
+    def hash_files(self, files):
+        tasks = [] # (file name, offset, length)
+        for file_name, (_, size, _) in files:
+            tasks += [(file_name, offset, min(HASH_SLICE, size - offset)) for offset in range(0, size, HASH_SLICE)] or [(file_name, 0, 0)]
+        total = sum(length for _, _, length in tasks)
+        arguments = [(self.directory + '/' + file_name, offset, length, self.chunk_size) for file_name, offset, length in tasks]
+        if self.workers > 1 and len(tasks) > 1 and total >= POOL_MIN_BYTES:
+            # Spawned rather than forked: the peer threads may hold locks at the time of a fork
+            with ProcessPoolExecutor(min(self.workers, len(tasks)), mp_context=multiprocessing.get_context("spawn")) as pool:
+                results = list(pool.map(hash_slice, *zip(*arguments)))
+        else:
+            results = [hash_slice(*argument) for argument in arguments]
+        slices = {} # file name -> hashes of its slices, None once one failed
+        for (file_name, _, _), result in zip(tasks, results):
+            if result is None:
+                slices[file_name] = None
+            elif slices.setdefault(file_name, []) is not None:
+                slices[file_name].append(result)
+        return [(file_name, b"".join(parts)) for file_name, parts in slices.items() if parts is not None]
@@ -0,0 +1,205 @@
+import json
+import os
+import sys
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Event, Lock, get_ident, enumerate as threads
+from time import time, sleep
+from urllib.parse import urlparse, parse_qs
+
+from metrics import metrics
+
+
+# Configuration constants
+SNAPSHOT_INTERVAL = 10 # Seconds between two writes of the snapshot file
+SAMPLE_INTERVAL = 0.005 # Seconds between two samples of the thread stacks while profiling
+MIN_SAMPLE_INTERVAL = 0.001 # Shortest sampling interval accepted, shorter ones would keep a CPU busy
+PROFILE_TOP = 30 # Functions and allocation sites listed in a report
+TRACE_FRAMES = 8 # Frames kept per allocation while memory is traced
+
+
+# Whether a thread is running rather than waiting (in a recv, a sleep or on a lock), as told
+# by Linux. Elsewhere every thread counts as running
+def is_running(native_id):
+    try:
+        with open(f"/proc/self/task/{native_id}/stat", "rb") as file:
+            stat = file.read()
+    except OSError:
+        return True
+    return stat[stat.rindex(b")") + 2:][:1] == b"R"
+
+
+# Statistical profiler of every thread of the process: the stacks of the running threads are
+# sampled every `interval` seconds by a thread of its own. A profiler hooked into the
+# interpreter (cProfile) only sees the thread that starts it, here the downloads, the
+# dispatcher and the DHT listener each run in their own thread, and sampling leaves the
+# hot paths as they are
+class StackSampler:
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.own = {} # (file, line, function) -> samples with it on top of a stack
+        self.total = {} # (file, line, function) -> samples with it anywhere in a stack
+        self.samples = 0
+        self.started = time()
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        me = get_ident()
+        while not self.stopped.wait(self.interval):
+            native = {thread.ident: thread.native_id for thread in threads()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me or not is_running(native.get(thread_id)):
+                    continue
+                self.samples += 1
+                seen = set()
+                top = True
+                while frame is not None:
+                    code = frame.f_code
+                    site = (code.co_filename, code.co_firstlineno, code.co_name)
+                    if top:
+                        self.own[site] = self.own.get(site, 0) + 1
+                        top = False
+                    if site not in seen:
+                        seen.add(site)
+                        self.total[site] = self.total.get(site, 0) + 1
+                    frame = frame.f_back
+
+    # Functions by the share of the samples spent in them and in what they call
+    def stop(self, top=PROFILE_TOP):
+        self.stopped.set()
+        self.thread.join()
+        lines = [f"{self.samples} samples of running threads in {time() - self.started:.1f}s, every {self.interval * 1000:.0f} ms",
+                 f"{'own %':>7} {'total %':>8}  function"]
+        samples = max(self.samples, 1)
+        for site, count in sorted(self.total.items(), key=lambda item: -item[1])[:top]:
+            filename, line, name = site
+            lines.append(f"{self.own.get(site, 0) * 100 / samples:7.1f} {count * 100 / samples:8.1f}  "
+                         f"{name} ({os.path.basename(filename)}:{line})")
+        return "\n".join(lines) + "\n"
+
+
+# Allocations traced with tracemalloc between start and stop, by the line that made them
+class MemoryTracer:
+    def __init__(self, frames=TRACE_FRAMES):
+        self.frames = frames
+
+    def start(self):
+        tracemalloc.start(self.frames)
+
+    def stop(self, top=PROFILE_TOP):
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+        lines = [f"traced memory {current / 1024:.0f} KB, peak {peak / 1024:.0f} KB"]
+        for stat in snapshot.statistics("lineno")[:top]:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size / 1024:10.1f} KB {stat.count:8d} blocks  {os.path.basename(frame.filename)}:{frame.lineno}")
+        return "\n".join(lines) + "\n"
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            status, body, content_type = self.server.stats.route(url.path, query)
+        except Exception as e:
+            status, body, content_type = 500, f"{e}\n", "text/plain"
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Local stats endpoint and snapshot file of the metrics of this process. On
+# http://127.0.0.1:PORT/:
+#   /stats                         metrics snapshot (JSON)
+#   /profile/start[?interval=s]    start sampling the stacks of every thread, every 1 ms at most
+#   /profile/stop                  stop, report the functions the threads spent their time in
+#   /memory/start, /memory/stop    same with the allocations traced by tracemalloc
+# With `path`, the snapshot is also written there every `interval` seconds
+class StatsServer:
+    def __init__(self, port=None, path=None, interval=SNAPSHOT_INTERVAL, registry=metrics):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.sampler = None
+        self.tracer = None
+        self.lock = Lock() # one capture switch at a time
+        self.running = True
+        self.http = None
+        if port is not None:
+            self.http = ThreadingHTTPServer(("127.0.0.1", port), StatsHandler)
+            self.http.daemon_threads = True
+            self.http.stats = self
+            self.port = self.http.server_address[1]
+
+    def start(self):
+        if self.http:
+            Thread(target=self.http.serve_forever, daemon=True).start()
+        if self.path:
+            Thread(target=self.write_snapshots, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        if self.http:
+            self.http.shutdown()
+            self.http.server_close()
+
+    # (status, body, content type) of a request
+    def route(self, path, query):
+        if path in ("/", "/stats"):
+            return 200, json.dumps(self.registry.snapshot(), indent=1) + "\n", "application/json"
+        with self.lock:
+            if path == "/profile/start":
+                if self.sampler:
+                    return 409, "already profiling\n", "text/plain"
+                try:
+                    interval = float(query.get("interval", SAMPLE_INTERVAL))
+                except ValueError:
+                    interval = None
+                # nan fails the comparison too
+                if interval is None or not interval >= MIN_SAMPLE_INTERVAL:
+                    return 400, f"interval must be a number of seconds of at least {MIN_SAMPLE_INTERVAL}\n", "text/plain"
+                self.sampler = StackSampler(interval)
+                self.sampler.start()
+                return 200, "profiling\n", "text/plain"
+            if path == "/profile/stop":
+                if not self.sampler:
+                    return 409, "not profiling\n", "text/plain"
+                sampler, self.sampler = self.sampler, None
+                return 200, sampler.stop(int(query.get("top", PROFILE_TOP))), "text/plain"
+            if path == "/memory/start":
+                if self.tracer:
+                    return 409, "already tracing\n", "text/plain"
+                self.tracer = MemoryTracer(int(query.get("frames", TRACE_FRAMES)))
+                self.tracer.start()
+                return 200, "tracing allocations\n", "text/plain"
+            if path == "/memory/stop":
+                if not self.tracer:
+                    return 409, "not tracing\n", "text/plain"
+                tracer, self.tracer = self.tracer, None
+                return 200, tracer.stop(int(query.get("top", PROFILE_TOP))), "text/plain"
+        return 404, "unknown path\n", "text/plain"
+
+    def write_snapshots(self):
+        while self.running:
+            sleep(self.interval)
+            self.write_snapshot()
+
+    # The file is replaced as a whole, a reader never sees a partial snapshot
+    def write_snapshot(self):
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w") as file:
+            json.dump(self.registry.snapshot(), file, indent=1)
+        os.replace(temporary, self.path)
@@ -0,0 +1,27 @@
+import os
+import sys
+import unittest
+
+# Make the project modules importable when running the tests from any directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from manifest import Manifest, HASH_SIZE, MANIFEST_HEADER, MAX_MANIFEST_CHUNKS, valid_manifest_size
+
+
+# Manifest sizes reported by seeders are checked before a download buffer is allocated
+class ManifestSizeTest(unittest.TestCase):
+    def test_sizes_of_real_manifests(self):
+        for length in (0, 1, 1024, 5000):
+            self.assertTrue(valid_manifest_size(len(Manifest.build(os.urandom(length), 1024).data)))
+
+    def test_bad_sizes(self):
+        for size in (0, MANIFEST_HEADER.size - 1, MANIFEST_HEADER.size + HASH_SIZE - 1,
+                     MANIFEST_HEADER.size + (MAX_MANIFEST_CHUNKS + 1) * HASH_SIZE, 2 ** 64 - 1):
+            self.assertFalse(valid_manifest_size(size), size)
+
+    def test_largest(self):
+        self.assertTrue(valid_manifest_size(MANIFEST_HEADER.size + MAX_MANIFEST_CHUNKS * HASH_SIZE))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import tempfile
+import unittest
+
+# Make the project modules importable when running the tests from any directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from node_state import NodeState
+from peer_store import PeerStore
+
+KEY = b"k" * 20
+
+
+# Peers evicted by the caps are journaled, so a restart does not bring them back
+class EvictionJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name + "/state"
+        self.state = NodeState(self.path)
+        self.state.compact(b"\0" * 20, lambda: [], lambda: [])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    # (key, ip, port) of the peers of the log once it is written
+    def restored(self):
+        self.state.close()
+        return {(key, ip, port) for key, ip, port, _ in NodeState(self.path).load()[2]}
+
+    def test_per_key_cap(self):
+        store = PeerStore(max_per_key=2)
+        store.journal = self.state
+        for i in range(5):
+            store.store(KEY, f"10.0.0.{i}", 6881)
+        self.assertEqual(self.restored(), {(KEY, "10.0.0.3", 6881), (KEY, "10.0.0.4", 6881)})
+
+    def test_total_cap(self):
+        store = PeerStore(max_records=3)
+        store.journal = self.state
+        for i in range(5):
+            store.store(bytes([i]) * 20, "10.0.0.1", 6881)
+        restored = self.restored()
+        self.assertEqual(len(restored), 3)
+        self.assertEqual(restored, {(record.key, *record.addr) for record in store.all_records()})
+
+    def test_ipv6_peer(self):
+        store = PeerStore(max_per_key=1)
+        store.journal = self.state
+        store.store(KEY, "2001:db8::1", 6881)
+        store.store(KEY, "2001:db8::2", 6881)
+        self.assertEqual(self.restored(), {(KEY, "2001:db8::2", 6881)})
+
+
+if __name__ == "__main__":
+    unittest.main()
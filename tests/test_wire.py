@@ -0,0 +1,133 @@
+import os
+import sys
+import unittest
+
+# Make the project modules importable when running the tests from any directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wire
+from wire import MalformedMessage
+
+
+CONTACTS = [wire.pack_contact(bytes([i]) * 20, f"10.0.0.{i}", 6881 + i) for i in range(1, 4)] + \
+           [wire.pack_contact(bytes([9]) * 20, "2001:db8::9", 6890)]
+PEERS = [wire.pack_peer("10.0.0.1", 6881), wire.pack_peer("2001:db8::1", 6882)]
+
+
+# Truncated, oversized and malformed bodies are rejected with MalformedMessage, never half-decoded
+class DecodeEntriesTest(unittest.TestCase):
+    def test_round_trip(self):
+        body = wire.encode_contacts(CONTACTS)
+        self.assertEqual(wire.decode_contacts(memoryview(body)), [
+            (bytes([1]) * 20, ("10.0.0.1", 6882)), (bytes([2]) * 20, ("10.0.0.2", 6883)),
+            (bytes([3]) * 20, ("10.0.0.3", 6884)), (bytes([9]) * 20, ("2001:db8::9", 6890))])
+        self.assertEqual(wire.decode_peer_entries(wire.encode_entries(PEERS, wire.PEER_SIZES, 1000)),
+                         [("10.0.0.1", 6881), ("2001:db8::1", 6882)])
+
+    def test_missing_counts(self):
+        for body in (b"", b"\x01"):
+            with self.assertRaises(MalformedMessage):
+                wire.decode_peer_entries(body)
+
+    def test_every_cut_is_rejected(self):
+        body = wire.encode_contacts(CONTACTS)
+        for length in range(len(body)):
+            with self.assertRaises(MalformedMessage):
+                wire.decode_contacts(body[:length])
+
+    def test_trailing_bytes(self):
+        with self.assertRaises(MalformedMessage):
+            wire.decode_contacts(wire.encode_contacts(CONTACTS) + b"\x00")
+
+    # Counts that don't match the body length, larger or smaller, are rejected
+    def test_counts_not_matching_length(self):
+        body = bytearray(wire.encode_entries(PEERS, wire.PEER_SIZES, 1000))
+        for counts in ((2, 1), (1, 2), (0, 1), (1, 0), (255, 255), (0, 0)):
+            body[:2] = bytes(counts)
+            with self.assertRaises(MalformedMessage):
+                wire.decode_peer_entries(bytes(body))
+
+    # Malformed counts never reach the struct cache, which stays bounded
+    def test_struct_cache_bounded(self):
+        wire.entries_struct.cache_clear()
+        for ipv4 in range(256):
+            for ipv6 in range(0, 256, 16):
+                with self.assertRaises(MalformedMessage):
+                    wire.decode_peer_entries(bytes((ipv4, ipv6, 0)))
+        self.assertEqual(wire.entries_struct.cache_info().currsize, 0)
+        for count in range(wire.ENTRY_STRUCTS * 2):
+            wire.decode_peer_entries(bytes((count, 0)) + bytes(count * wire.PEER_SIZES[0]))
+        self.assertLessEqual(wire.entries_struct.cache_info().currsize, wire.ENTRY_STRUCTS)
+
+
+class DecodeGetTest(unittest.TestCase):
+    def test_round_trip(self):
+        for ranges in ([], [(1 << 40, 1400)], [(i * 1400, 1400) for i in range(wire.MAX_ENTRIES)]):
+            self.assertEqual(wire.decode_get(memoryview(wire.encode_get(ranges, "movie.mkv"))), (ranges, "movie.mkv"))
+
+    def test_empty(self):
+        with self.assertRaises(MalformedMessage):
+            wire.decode_get(b"")
+
+    # A range count larger than the ranges sent
+    def test_truncated_ranges(self):
+        body = wire.encode_get([(0, 1400), (1400, 1400)], "")
+        for length in range(1, len(body)):
+            with self.assertRaises(MalformedMessage):
+                wire.decode_get(body[:length])
+        with self.assertRaises(MalformedMessage):
+            wire.decode_get(b"\xff" + bytes(12))
+
+    def test_too_many_ranges(self):
+        with self.assertRaises(ValueError):
+            wire.encode_get([(0, 1)] * (wire.MAX_ENTRIES + 1), "x")
+
+
+class DecodeStoreBatchTest(unittest.TestCase):
+    def test_round_trip(self):
+        keys = [bytes([i]) * 20 for i in range(3)]
+        bodies = list(wire.encode_store_batches(keys, PEERS))
+        self.assertEqual(len(bodies), 1)
+        self.assertEqual(wire.decode_store_batch(bodies[0]), (keys, [("10.0.0.1", 6881), ("2001:db8::1", 6882)]))
+
+    def test_empty(self):
+        with self.assertRaises(MalformedMessage):
+            wire.decode_store_batch(b"")
+
+    def test_truncated_keys(self):
+        with self.assertRaises(MalformedMessage):
+            wire.decode_store_batch(b"\x02" + bytes(30))
+
+    # Keys are complete but the peer entries after them are cut, missing or too long
+    def test_bad_entries(self):
+        body = next(wire.encode_store_batches([bytes(20)], PEERS))
+        for bad in (body[:21], body[:-1], body + b"\x00", body[:21] + b"\x05\x00"):
+            with self.assertRaises(MalformedMessage):
+                wire.decode_store_batch(bad)
+
+
+class DecodeMessageTest(unittest.TestCase):
+    def test_node_message(self):
+        data = wire.encode_node_message(wire.PING, 7, bytes(20))
+        self.assertEqual(wire.decode_node_message(data)[:3], (wire.PING, 7, bytes(20)))
+        with self.assertRaises(MalformedMessage):
+            wire.decode_node_message(data[:-1])
+        with self.assertRaises(MalformedMessage):
+            wire.decode_node_message(bytes([wire.PROTOCOL_VERSION + 1]) + data[1:])
+
+    def test_size_reply(self):
+        body = wire.encode_size_reply(3, 4000, 1 << 20, bytes(20))
+        self.assertEqual(wire.decode_size_reply(body), (3, 4000, 1 << 20, bytes(20)))
+        for bad in (body[:-1], body + b"\x00", b""):
+            with self.assertRaises(MalformedMessage):
+                wire.decode_size_reply(bad)
+
+    def test_parse_message(self):
+        self.assertIsNone(wire.parse_message(b"\x01\x03"))
+        self.assertIsNone(wire.parse_message(bytes([wire.PROTOCOL_VERSION + 1]) + bytes(5)))
+        buffer = bytearray(wire.encode_message(wire.GET, 9, b"body") + bytes(100))
+        self.assertEqual(bytes(wire.parse_message(buffer, 10)[2]), b"body")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,30 @@
+from time import time
+
+
+# Configuration constants
+RATE_BURST = 0.1 # Seconds of bandwidth that can be used at once after an idle period
+
+
+# Bytes per second allowance. Tokens accumulate at `rate` up to `burst` bytes; they may go
+# below zero, so a request larger than the burst is let through once the bucket is not
+# empty and the debt is paid back before the next one
+class TokenBucket:
+    def __init__(self, rate, burst=None, now=None):
+        self.rate = rate
+        self.burst = rate * RATE_BURST if burst is None else burst
+        self.tokens = self.burst
+        self.updated = time() if now is None else now
+
+    # Tokens left at `now`
+    def available(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        return self.tokens
+
+    def consume(self, amount):
+        self.tokens -= amount
+
+    # Seconds until the bucket is no longer empty
+    def delay(self, now):
+        return max(0.0, -self.available(now) / self.rate)
@@ -0,0 +1,323 @@
+from collections import deque
+
+
+# Configuration constants
+INITIAL_WINDOW = 4 # Packets in flight at the start of a transfer
+MAX_WINDOW = 256 # Upper bound of packets in flight
+INITIAL_RTO = 1.0 # Retransmission timeout before the first RTT sample (seconds)
+MIN_RTO = 0.05
+MAX_RTO = 5.0
+MAX_RETRIES = 50 # Retransmissions of a single packet before the transfer fails
+QUEUE_LOW = 4 # Packets queued at the sender below which the window keeps growing
+QUEUE_HIGH = 16 # Packets queued at the sender above which the window shrinks
+
+RATE_INTERVAL = 0.5 # Seconds between per-peer throughput samples
+RATE_ALPHA = 0.3 # Weight of the newest throughput sample
+RANGE_PACKETS = 64 # Range size handed out to a peer with an average rate
+BLACKLIST_FAILURES = 8 # Consecutive timeouts before a peer is blacklisted
+BLACKLIST_TIME = 30.0 # Seconds a blacklisted peer gets no requests
+ENDGAME_COPIES = 2 # Peers asked for the same packet in endgame mode
+
+
+# Requests sent to the unspecified address are answered from loopback,
+# so peers are keyed by the address their replies come from
+def normalize_addr(ip, port):
+    if ip in ("0.0.0.0", ""):
+        ip = "127.0.0.1"
+    return (ip, int(port))
+
+
+# Congestion window adapted to observed RTT and loss: AIMD on loss, plus a
+# delay check (TCP Vegas) that stops growth once requests start queueing
+class CongestionWindow:
+    def __init__(self, initial=INITIAL_WINDOW, maximum=MAX_WINDOW):
+        self.size = float(min(initial, maximum))
+        self.maximum = maximum
+        self.ssthresh = float(maximum)
+        self.srtt = None
+        self.rttvar = None
+        self.min_rtt = None
+        self.rto = INITIAL_RTO
+        self.last_decrease = 0.0
+
+    # Number of packets allowed in flight
+    def limit(self):
+        return max(1, int(self.size))
+
+    # Adjust the window on every delivered packet and update RTT estimate (RFC 6298)
+    def on_ack(self, rtt=None):
+        queued = 0.0
+        if rtt is not None:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+            self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+            # Requests waiting at the sender: window * (1 - base RTT / current RTT)
+            if rtt > 0:
+                queued = self.size * (1 - self.min_rtt / rtt)
+
+        if queued > QUEUE_HIGH:
+            self.ssthresh = min(self.ssthresh, self.size)
+            self.size = max(2.0, self.size - 1 / self.size)
+        elif self.size < self.ssthresh:
+            self.size += 1 # Slow start
+        elif queued < QUEUE_LOW:
+            self.size += 1 / self.size # Additive increase
+        self.size = min(self.size, float(self.maximum))
+
+    # Halve the window and back off the timeout on loss. Packets sent before
+    # the last decrease belong to the same loss event, so a burst of drops counts once
+    def on_loss(self, now, send_time):
+        if send_time < self.last_decrease:
+            return
+        self.last_decrease = now
+        self.ssthresh = max(2.0, self.size / 2)
+        self.size = self.ssthresh
+        self.rto = min(MAX_RTO, self.rto * 2)
+
+
+# Per-peer transfer statistics: window, throughput, RTT and failures
+class PeerStats:
+    def __init__(self, addr, now, max_window=MAX_WINDOW):
+        self.addr = addr
+        self.window = CongestionWindow(maximum=max_window)
+        self.in_flight = {} # packet number -> (send time, retries), kept in send order
+        self.assigned = deque() # range of packets reserved for this peer
+        self.rate = 0.0 # packets per second (EWMA)
+        self.delivered = 0
+        self.sample_start = now
+        self.sample_delivered = 0
+        self.failures = 0 # consecutive timeouts
+        self.total_failures = 0
+        self.corrupt = 0 # chunks that failed verification
+        self.blacklisted_until = 0.0
+
+    def active(self, now):
+        return self.blacklisted_until <= now
+
+    # Fold the packets delivered since the last sample into the rate estimate
+    def update_rate(self, now):
+        elapsed = now - self.sample_start
+        if elapsed < RATE_INTERVAL:
+            return
+        sample = (self.delivered - self.sample_delivered) / elapsed
+        self.rate = sample if self.rate == 0.0 else (1 - RATE_ALPHA) * self.rate + RATE_ALPHA * sample
+        self.sample_start = now
+        self.sample_delivered = self.delivered
+
+
+# Multi-source download scheduler. Every peer has its own congestion window and
+# pulls contiguous packet ranges sized in proportion to its measured rate.
+# Unresponsive peers are blacklisted and their packets go to the others; once
+# every missing packet is requested, the remaining ones are duplicated to
+# other peers (endgame mode) so the slowest peer does not hold up the end.
+# Packets can be transfer chunks of any size, `max_window` bounds the chunks in flight per peer
+class SwarmScheduler:
+    def __init__(self, total_packets, peers, now, completed=(), max_window=MAX_WINDOW):
+        self.total = total_packets
+        self.max_window = max_window
+        self.peers = {}
+        for peer_ip, peer_port in peers:
+            addr = normalize_addr(peer_ip, peer_port)
+            self.peers[addr] = PeerStats(addr, now, max_window)
+        if not self.peers:
+            raise Exception("No peers to download from")
+        self.received = set(completed) # packets already on disk count as received
+        self.pending = deque(n for n in range(total_packets) if n not in self.received) # packets not assigned to any peer
+        self.owners = {} # packet number -> addresses it is requested from
+        self.retries = {} # packet number -> times it was requested again
+        self.retransmits = 0
+        self.duplicates = 0
+
+    def done(self):
+        return len(self.received) == self.total
+
+    # Peers that may get requests, lifting the blacklist of the least failing
+    # peer if every peer is blacklisted
+    def active_peers(self, now):
+        active = [p for p in self.peers.values() if p.active(now)]
+        if not active:
+            peer = min(self.peers.values(), key=lambda p: p.blacklisted_until)
+            peer.blacklisted_until = 0.0
+            peer.failures = 0
+            active = [peer]
+        return active
+
+    # Reserve the next range of pending packets for a peer
+    def assign_range(self, peer, active):
+        total_rate = sum(p.rate for p in active)
+        if peer.rate > 0 and total_rate > 0:
+            share = peer.rate / total_rate
+        else:
+            share = 1 / len(active)
+        size = max(1, int(share * RANGE_PACKETS * len(active)))
+        while self.pending and size > 0:
+            number = self.pending.popleft()
+            if number not in self.received and number not in self.owners:
+                peer.assigned.append(number)
+                size -= 1
+
+    # Take the back half of the range with the longest expected drain time
+    def steal_range(self, peer):
+        victim = max(self.peers.values(), key=lambda p: len(p.assigned) / max(p.rate, 1.0))
+        for _ in range((len(victim.assigned) + 1) // 2):
+            peer.assigned.appendleft(victim.assigned.pop())
+
+    # Next packet a peer should request, None if it has nothing left
+    def next_packet(self, peer, active):
+        while True:
+            if not peer.assigned:
+                self.assign_range(peer, active)
+                if not peer.assigned:
+                    self.steal_range(peer)
+                if not peer.assigned:
+                    return None
+            number = peer.assigned.popleft()
+            if number not in self.received and number not in self.owners:
+                return number
+
+    def endgame(self):
+        return not self.pending and all(not p.assigned for p in self.peers.values())
+
+    # Requests in flight at all peers
+    def in_flight(self):
+        return sum(len(peer.in_flight) for peer in self.peers.values())
+
+    # Whether take() would send more right now: a peer has room in its window and packets are
+    # left that nobody was asked for. Changes nothing, unlike take()
+    def wants_more(self, now):
+        if len(self.received) + len(self.owners) >= self.total:
+            return False
+        return any(len(p.in_flight) < p.window.limit() for p in self.peers.values() if p.active(now))
+
+    # Requests that fit into the peers' windows right now, at most `limit` of them: list of (packet number, address)
+    def take(self, now, limit=None):
+        requests = []
+        if limit is not None and limit <= 0:
+            return requests
+        active = self.active_peers(now)
+        for peer in active:
+            peer.update_rate(now)
+            while len(peer.in_flight) < peer.window.limit() and (limit is None or len(requests) < limit):
+                number = self.next_packet(peer, active)
+                if number is None:
+                    break
+                self.send(peer, number, now)
+                requests.append((number, peer.addr))
+
+        if self.endgame():
+            # Oldest outstanding packets first, each to a faster peer that does not have it yet
+            outstanding = sorted(self.owners, key=lambda n: min(self.peers[a].in_flight[n][0] for a in self.owners[n]))
+            for number in outstanding:
+                if limit is not None and len(requests) >= limit:
+                    break
+                owners = self.owners[number]
+                if len(owners) >= ENDGAME_COPIES:
+                    continue
+                owner_rate = max(self.peers[a].rate for a in owners)
+                candidates = [p for p in active if p.addr not in owners and p.rate > owner_rate and len(p.in_flight) < p.window.limit()]
+                if not candidates:
+                    continue
+                peer = max(candidates, key=lambda p: p.rate)
+                self.send(peer, number, now)
+                self.duplicates += 1
+                requests.append((number, peer.addr))
+        return requests
+
+    def send(self, peer, number, now):
+        peer.in_flight[number] = (now, self.retries.get(number, 0))
+        self.owners.setdefault(number, set()).add(peer.addr)
+
+    # Register a packet received from `addr`, returns False for duplicates
+    def on_packet(self, number, addr, now):
+        if number in self.received or not 0 <= number < self.total:
+            return False
+        peer = self.peers.get(addr)
+        sent = peer.in_flight.pop(number, None) if peer else None
+        if sent is not None:
+            send_time, retries = sent
+            # Karn's algorithm: ambiguous RTT samples of retransmitted packets are skipped
+            peer.window.on_ack(now - send_time if retries == 0 else None)
+        if peer:
+            peer.delivered += 1
+            peer.failures = 0
+
+        # Cancel endgame duplicates still outstanding at other peers
+        for other in self.owners.pop(number, ()):
+            if other != addr:
+                self.peers[other].in_flight.pop(number, None)
+        self.received.add(number)
+        return True
+
+    # Handle timed-out requests: shrink the window of the peer, count the failure,
+    # blacklist the peer if it stopped answering and give its packets back to the pool.
+    # In-flight packets are ordered by send time, so only the head is checked
+    def expire(self, now):
+        for peer in self.peers.values():
+            lost = []
+            for number, (send_time, _) in peer.in_flight.items():
+                if now - send_time <= peer.window.rto:
+                    break
+                lost.append(number)
+            for number in lost:
+                send_time, retries = peer.in_flight.pop(number)
+                peer.window.on_loss(now, send_time)
+                peer.failures += 1
+                peer.total_failures += 1
+                self.release(number, peer.addr)
+
+            # A peer that never answered is dropped at its first timeout
+            unresponsive = peer.failures >= BLACKLIST_FAILURES or (lost and peer.delivered == 0)
+            if unresponsive and peer.active(now):
+                self.blacklist(peer, now)
+
+    # A peer sent a chunk that failed verification: it is blacklisted right away
+    # and the chunk goes back to the front of the pool for another peer
+    def on_corrupt(self, number, addr, now):
+        peer = self.peers.get(addr)
+        if peer is None or peer.in_flight.pop(number, None) is None:
+            return
+        peer.corrupt += 1
+        peer.total_failures += 1
+        self.blacklist(peer, now)
+        self.release(number, addr)
+
+    # Stop requesting from a peer for BLACKLIST_TIME and give its packets back to the pool
+    def blacklist(self, peer, now):
+        peer.blacklisted_until = now + BLACKLIST_TIME
+        peer.failures = 0
+        peer.window = CongestionWindow(maximum=self.max_window)
+        for number in list(peer.in_flight):
+            peer.in_flight.pop(number)
+            self.release(number, peer.addr)
+        while peer.assigned:
+            self.pending.appendleft(peer.assigned.pop())
+
+    # Return a packet to the front of the pool unless another peer still has it in flight
+    def release(self, number, addr):
+        owners = self.owners.get(number)
+        if owners is None:
+            return
+        owners.discard(addr)
+        if owners:
+            return
+        del self.owners[number]
+        retries = self.retries.get(number, 0) + 1
+        if retries > MAX_RETRIES:
+            raise Exception(f"Packet {number} lost after {MAX_RETRIES} retransmissions")
+        self.retries[number] = retries
+        self.retransmits += 1
+        self.pending.appendleft(number)
+
+    # Seconds until the earliest in-flight packet times out
+    def next_timeout(self, now):
+        timeout = INITIAL_RTO
+        for peer in self.peers.values():
+            if peer.in_flight:
+                earliest, _ = next(iter(peer.in_flight.values()))
+                timeout = min(timeout, earliest + peer.window.rto - now)
+        return max(0.001, timeout)
@@ -0,0 +1,142 @@
+from collections import deque
+from threading import Lock
+
+from token_bucket import TokenBucket
+from wire import GET, decode_get
+
+
+# Configuration constants
+MAX_QUEUED_REQUESTS = 4096 # Requests waiting to be served, beyond that load is dropped
+QUANTUM = 256 * 1024 # Bytes a client may be served per round of the fair queue, about one chunk request
+SMALL_REQUEST_COST = 64 # Bytes charged for a request that is not a chunk (size, manifest size)
+IDLE_WAIT = 0.5 # Seconds before serving is retried when every client waits for its rate
+RECEIVE_BATCH = 256 # Datagrams taken from the socket before the queued requests are served
+UPLOAD_BATCH = 64 # Requests served in a row before the socket is read again
+
+
+# Bytes a request makes the seeder send: the requested ranges of a GET
+def request_cost(msg_type: int, body: bytes):
+    if msg_type == GET:
+        try:
+            ranges, _ = decode_get(body)
+            return max(SMALL_REQUEST_COST, sum(length for _, length in ranges))
+        except Exception:
+            pass
+    return SMALL_REQUEST_COST
+
+
+# Requests of one client waiting to be served
+class ClientQueue:
+    __slots__ = ("requests", "deficit", "bucket", "served", "dropped")
+
+    def __init__(self, bucket):
+        self.requests = deque() # (cost, request)
+        self.deficit = 0 # bytes the client may still be served in the current round
+        self.bucket = bucket
+        self.served = 0
+        self.dropped = 0
+
+
+# Requests received by a seeder, served fairly across the requesting addresses: each one
+# has its own queue and the queues take turns by deficit round robin, QUANTUM bytes per
+# round (`quantum`), so a client asking for more or larger chunks gets no more bytes than the others.
+# Token buckets limit the bytes served per second in total (`rate`) and to each client
+# (`client_rate`); a client over its rate waits while the others are served. At most
+# `max_queued` requests wait in total: when full, the newest request of the longest
+# queue is dropped, its client times out and slows down
+class UploadScheduler:
+    def __init__(self, rate=None, client_rate=None, max_queued=MAX_QUEUED_REQUESTS, cost=request_cost, quantum=QUANTUM):
+        if max_queued < 1:
+            raise ValueError("At least 1 queued request")
+        self.bucket = TokenBucket(rate) if rate else None
+        self.client_rate = client_rate
+        self.max_queued = max_queued
+        self.cost = cost # (type, body) -> bytes
+        self.quantum = quantum
+        self.clients = {} # addr -> ClientQueue
+        self.active = deque() # addresses with queued requests, in turn order
+        self.queued = 0
+        self.peak = 0 # deepest queue seen
+        self.served = 0
+        self.served_bytes = 0
+        self.dropped = 0
+        self.lock = Lock()
+
+    # Queue a request (type, request id, body) of `addr`, False if it was dropped
+    def push(self, msg_type: int, request_id: int, body: bytes, addr):
+        cost = self.cost(msg_type, body)
+        with self.lock:
+            client = self.clients.get(addr)
+            if client is None:
+                bucket = TokenBucket(self.client_rate) if self.client_rate else None
+                client = self.clients[addr] = ClientQueue(bucket)
+            if self.queued >= self.max_queued:
+                longest_addr = max(self.active, key=lambda other: len(self.clients[other].requests))
+                longest = self.clients[longest_addr]
+                self.dropped += 1
+                if len(longest.requests) <= len(client.requests):
+                    client.dropped += 1
+                    self.forget(addr, client)
+                    return False
+                longest.requests.pop()
+                longest.dropped += 1
+                self.queued -= 1
+                if not longest.requests:
+                    self.active.remove(longest_addr)
+                    self.forget(longest_addr, longest)
+            if not client.requests:
+                self.active.append(addr)
+            client.requests.append((cost, (msg_type, request_id, body, addr)))
+            self.queued += 1
+            self.peak = max(self.peak, self.queued)
+        return True
+
+    # Next request to serve, (type, request id, body, addr), and 0; or None and the seconds
+    # until one may be served
+    def next(self, now):
+        with self.lock:
+            if self.bucket is not None and self.bucket.available(now) <= 0:
+                return None, self.bucket.delay(now)
+            delay = IDLE_WAIT
+            limited = 0 # clients in a row skipped for their rate
+            while self.active and limited < len(self.active):
+                addr = self.active[0]
+                client = self.clients[addr]
+                if client.bucket is not None and client.bucket.available(now) <= 0:
+                    delay = min(delay, client.bucket.delay(now))
+                    limited += 1
+                    self.active.rotate(-1)
+                    continue
+                limited = 0
+                cost, request = client.requests[0]
+                if client.deficit < cost:
+                    client.deficit += self.quantum
+                    self.active.rotate(-1)
+                    continue
+                client.requests.popleft()
+                client.deficit -= cost
+                self.queued -= 1
+                if self.bucket is not None:
+                    self.bucket.consume(cost)
+                if client.bucket is not None:
+                    client.bucket.consume(cost)
+                if not client.requests:
+                    client.deficit = 0
+                    self.active.popleft()
+                    self.forget(addr, client)
+                client.served += cost
+                self.served += 1
+                self.served_bytes += cost
+                return request, 0
+            return None, delay
+
+    # Drop the state of a client with nothing queued, unless it still owes tokens. Called with the lock held
+    def forget(self, addr, client):
+        if not client.requests and (client.bucket is None or client.bucket.tokens >= 0):
+            del self.clients[addr]
+
+    # Queue depth, drops and what was served
+    def stats(self):
+        with self.lock:
+            return {"queued": self.queued, "peak": self.peak, "dropped": self.dropped, "served": self.served,
+                    "served_bytes": self.served_bytes, "clients": len(self.active)}
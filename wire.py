@@ -0,0 +1,262 @@
+import socket
+import struct
+from functools import lru_cache
+from random import sample
+
+
+# Configuration constants
+PROTOCOL_VERSION = 1
+MAX_DATAGRAM = 1400 # Largest DHT datagram sent, replies are truncated to fit under the Ethernet MTU
+RECEIVE_SIZE = 65536 # Receive buffer of the DHT listener, datagrams are never cut short
+
+# Every datagram starts with HEADER: protocol version, message type, request id.
+# Peer messages
+SIZE = 1 # file name (UTF-8)
+SIZEOF = 2 # SIZE_REPLY [content root]
+GET = 3 # range count, RANGE..., file name (UTF-8)
+DATA = 4 # offset, payload
+# DHT messages, the header is followed by the id of the sender
+PING = 16
+PONG = 17
+FIND_NODE = 18 # target id
+NODES = 19 # IPv4 and IPv6 counts, contacts (node id, ip, port)
+FIND_PEERS = 20 # key
+PEERS = 21 # key, IPv4 and IPv6 counts, peers (ip, port)
+STORE = 22 # key, IPv4 and IPv6 counts, peers (ip, port)
+STORE_BATCH = 23 # key count, keys, IPv4 and IPv6 counts, peers (ip, port): the peers are stored under every key
+
+HEADER = struct.Struct("!BBI")
+NODE_HEADER = struct.Struct("!BBI20s")
+DATA_HEADER = struct.Struct("!BBIQ")
+SIZE_REPLY = struct.Struct("!IQI") # chunks, bytes, largest chunk served
+RANGE = struct.Struct("!QI") # offset, length
+KEY = struct.Struct("!20s")
+COUNTS = struct.Struct("!BB")
+MAX_ENTRIES = 255 # Entries of one address family in a reply
+IP_STRINGS = 4096 # IPv4 addresses whose text form the decoders keep, contacts and peers come back again and again
+ENTRY_STRUCTS = 64 # Structs of entry counts kept by the decoders, replies mostly carry the same few counts
+ID_MASK = 0xffffffff # Request ids wrap around at 32 bits
+
+PORT = struct.Struct("!H")
+
+# Entry formats and sizes by address family (IPv4, IPv6)
+CONTACT_FORMATS = ("20s4sH", "20s16sH")
+CONTACT_SIZES = (26, 38)
+PEER_FORMATS = ("4sH", "16sH")
+PEER_SIZES = (6, 18)
+
+
+# Datagram that can't be decoded
+class MalformedMessage(ValueError):
+    pass
+
+
+# Struct of the entry counts and the entries of both address families, so a whole reply is
+# unpacked in one call, and the index of the first IPv6 field (after the two counts and the IPv4 fields).
+# Only called for counts that match the length of the body
+@lru_cache(maxsize=ENTRY_STRUCTS)
+def entries_struct(formats, ipv4, ipv6):
+    fields = sum(not char.isdigit() for char in formats[0])
+    return struct.Struct(COUNTS.format + formats[0] * ipv4 + formats[1] * ipv6), 2 + fields * ipv4
+
+# Text form of a packed IPv4 address
+ipv4_string = lru_cache(maxsize=IP_STRINGS)(socket.inet_ntoa)
+
+
+# Split the first `length` bytes of a datagram into (type, request id, body view), None if malformed.
+# The body is a memoryview into `data`, so it is only valid until the buffer is reused
+def parse_message(data, length=None):
+    if length is None:
+        length = len(data)
+    if length < HEADER.size:
+        return None
+    version, msg_type, request_id = HEADER.unpack_from(data)
+    if version != PROTOCOL_VERSION:
+        return None
+    return msg_type, request_id, memoryview(data)[HEADER.size:length]
+
+
+def encode_message(msg_type, request_id, body=b""):
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, request_id & ID_MASK) + body
+
+
+def encode_size_reply(chunks, size, max_chunk_size, root=b""):
+    return SIZE_REPLY.pack(chunks, size, max_chunk_size) + root
+
+
+# (chunks, bytes, largest chunk served, content root or None) of a size reply
+def decode_size_reply(body):
+    if len(body) not in (SIZE_REPLY.size, SIZE_REPLY.size + KEY.size):
+        raise MalformedMessage("Bad size reply")
+    chunks, size, max_chunk_size = SIZE_REPLY.unpack_from(body)
+    root = bytes(body[SIZE_REPLY.size:]) or None
+    return chunks, size, max_chunk_size, root
+
+
+# Body of a get request for (offset, length) ranges of a file
+def encode_get(ranges, file_name):
+    if len(ranges) > MAX_ENTRIES:
+        raise ValueError("Too many ranges")
+    return b"".join([bytes((len(ranges),)), *[RANGE.pack(offset, length) for offset, length in ranges], file_name.encode()])
+
+
+# (ranges, file name) of a get request
+def decode_get(body):
+    if len(body) < 1:
+        raise MalformedMessage("Empty get request")
+    count = body[0]
+    end = 1 + count * RANGE.size
+    if len(body) < end:
+        raise MalformedMessage("Truncated get request")
+    # Most requests ask for a single range
+    if count == 1:
+        return [RANGE.unpack_from(body, 1)], str(body[end:], "utf-8")
+    return list(RANGE.iter_unpack(body[1:end])), str(body[end:], "utf-8")
+
+
+# Header of a data datagram, the payload is sent after it without being joined
+def data_header(request_id, offset):
+    return DATA_HEADER.pack(PROTOCOL_VERSION, DATA, request_id & ID_MASK, offset)
+
+
+# (offset, payload view) of a data body
+def decode_data(body):
+    if len(body) < 8:
+        raise MalformedMessage("Truncated data")
+    return int.from_bytes(body[:8], 'big'), body[8:]
+
+
+def encode_node_message(msg_type, transaction_id, sender_id, body=b""):
+    return NODE_HEADER.pack(PROTOCOL_VERSION, msg_type, transaction_id & ID_MASK, sender_id) + body
+
+
+# (type, transaction id, sender id, body view) of a DHT datagram
+def decode_node_message(data):
+    if len(data) < NODE_HEADER.size:
+        raise MalformedMessage("Truncated DHT message")
+    version, msg_type, transaction_id, sender_id = NODE_HEADER.unpack_from(data)
+    if version != PROTOCOL_VERSION:
+        raise MalformedMessage(f"Unsupported protocol version {version}")
+    return msg_type, transaction_id, sender_id, memoryview(data)[NODE_HEADER.size:]
+
+
+# Family index (0 IPv4, 1 IPv6) and packed ip + port of a peer
+def pack_peer(ip, port):
+    if ":" in ip:
+        return 1, socket.inet_pton(socket.AF_INET6, ip) + PORT.pack(int(port))
+    return 0, socket.inet_aton(ip) + PORT.pack(int(port))
+
+
+# Packed contact (family, node id + ip + port) of a node, computed once per node
+def pack_contact(node_id, ip, port):
+    family, packed = pack_peer(ip, port)
+    return family, node_id + packed
+
+
+# (ip, port) of a packed peer
+def unpack_peer(family, packed):
+    ip, port = struct.unpack("!" + PEER_FORMATS[family], packed)
+    return socket.inet_ntop(socket.AF_INET6 if family else socket.AF_INET, ip), port
+
+
+# (node id, ip, port) of a packed contact
+def unpack_contact(family, packed):
+    node_id, ip, port = struct.unpack("!" + CONTACT_FORMATS[family], packed)
+    return node_id, socket.inet_ntop(socket.AF_INET6 if family else socket.AF_INET, ip), port
+
+
+# Counts and packed entries of both address families, at most `room` bytes. `entries` are
+# (family, packed) in order of preference, the ones that don't fit are left out
+def encode_entries(entries, sizes, room):
+    room -= COUNTS.size
+    by_family = ([], [])
+    if len(entries) * sizes[1] <= room and len(entries) <= MAX_ENTRIES:
+        for family, packed in entries:
+            by_family[family].append(packed)
+    else:
+        for family, packed in entries:
+            if sizes[family] <= room and len(by_family[family]) < MAX_ENTRIES:
+                room -= sizes[family]
+                by_family[family].append(packed)
+    return b"".join([COUNTS.pack(len(by_family[0]), len(by_family[1])), *by_family[0], *by_family[1]])
+
+
+# Fields of the entries of both address families, unpacked with a single struct call. The
+# counts are checked against the body length before they are used
+def decode_entries(formats, sizes, body):
+    if len(body) < COUNTS.size:
+        raise MalformedMessage("Missing entry counts")
+    ipv4, ipv6 = body[0], body[1]
+    size = COUNTS.size + ipv4 * sizes[0] + ipv6 * sizes[1]
+    if len(body) < size:
+        raise MalformedMessage("Truncated entries")
+    if len(body) != size:
+        raise MalformedMessage("Trailing bytes after entries")
+    entries, end = entries_struct(formats, ipv4, ipv6)
+    fields = entries.unpack_from(body)
+    return fields[2:end], fields[end:]
+
+
+# Packed contacts, closest first: the farthest ones are left out if they don't fit in one datagram
+def encode_contacts(contacts, room=MAX_DATAGRAM - NODE_HEADER.size):
+    return encode_entries(contacts, CONTACT_SIZES, room)
+
+
+# Contacts (node id, (ip, port)) of a NODES body
+def decode_contacts(body):
+    ipv4, ipv6 = decode_entries(CONTACT_FORMATS, CONTACT_SIZES, body)
+    contacts = list(zip(ipv4[0::3], zip(map(ipv4_string, ipv4[1::3]), ipv4[2::3])))
+    if ipv6:
+        contacts += zip(ipv6[0::3], zip((socket.inet_ntop(socket.AF_INET6, ip) for ip in ipv6[1::3]), ipv6[2::3]))
+    return contacts
+
+
+# Key and packed peers of a PEERS or STORE body. A random sample of the peers
+# is sent if they don't all fit in one datagram
+def encode_peers(key, peers, room=MAX_DATAGRAM - NODE_HEADER.size):
+    room -= KEY.size
+    if len(peers) * PEER_SIZES[0] > room - COUNTS.size:
+        peers = sample(peers, len(peers))
+    return key + encode_entries(peers, PEER_SIZES, room)
+
+
+# (key, peers (ip, port)) of a PEERS or STORE body
+def decode_peers(body):
+    if len(body) < KEY.size:
+        raise MalformedMessage("Missing key")
+    return bytes(body[:KEY.size]), decode_peer_entries(body[KEY.size:])
+
+
+# Peers (ip, port) of the entries of both address families
+def decode_peer_entries(body):
+    ipv4, ipv6 = decode_entries(PEER_FORMATS, PEER_SIZES, body)
+    peers = list(zip(map(ipv4_string, ipv4[0::2]), ipv4[1::2]))
+    if ipv6:
+        peers += zip((socket.inet_ntop(socket.AF_INET6, ip) for ip in ipv6[0::2]), ipv6[1::2])
+    return peers
+
+
+# Bodies of the STORE_BATCH messages storing packed peers under many keys, as many keys per datagram as fit
+def encode_store_batches(keys, peers, room=MAX_DATAGRAM - NODE_HEADER.size):
+    entries = encode_entries(peers, PEER_SIZES, room - 1 - KEY.size)
+    per_message = min(MAX_ENTRIES, (room - 1 - len(entries)) // KEY.size)
+    for start in range(0, len(keys), per_message):
+        batch = keys[start:start + per_message]
+        yield b"".join([bytes((len(batch),)), *batch, entries])
+
+
+# (keys, peers (ip, port)) of a STORE_BATCH body
+def decode_store_batch(body):
+    if len(body) < 1:
+        raise MalformedMessage("Empty store batch")
+    end = 1 + body[0] * KEY.size
+    if len(body) < end:
+        raise MalformedMessage("Truncated keys")
+    return [bytes(body[i:i + KEY.size]) for i in range(1, end, KEY.size)], decode_peer_entries(body[end:])
+
+
+# Target id or key of a FIND_NODE or FIND_PEERS body
+def decode_key(body):
+    if len(body) != KEY.size:
+        raise MalformedMessage("Bad key")
+    return bytes(body)
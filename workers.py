@@ -0,0 +1,81 @@
+import multiprocessing
+import socket
+from hashlib import sha1
+from random import random
+
+from wire import ID_MASK, RECEIVE_SIZE, PEER_SIZES, pack_peer, unpack_peer
+
+
+# Configuration constants
+WORKER_BITS = 4 # Low bits of a DHT transaction id naming the worker that sent the query
+MAX_WORKERS = 1 << WORKER_BITS
+
+
+# Let a socket bind a port other sockets are bound to (SO_REUSEPORT, Linux and BSD). The
+# kernel hands every datagram to one of them, by a hash of its source address, so a client
+# always reaches the same socket
+def share_port(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+
+# One of the processes serving the ports of a peer and its DHT node. The workers share the
+# node id and each has a loopback socket, its channel, to pass DHT messages to the others:
+# a reply that reached the wrong worker goes to the one whose query it answers (named by the
+# low bits of the transaction id), and stored peers go to all of them so that every worker
+# answers lookups alike
+class WorkerGroup:
+    def __init__(self, index, count, node_id, channels):
+        self.index = index
+        self.count = count
+        self.node_id = node_id
+        self.channel = channels[index]
+        self.addresses = [channel.getsockname() for channel in channels]
+
+    # Transaction id of the `number`-th query of this worker
+    def transaction_id(self, number):
+        return (number << WORKER_BITS | self.index) & ID_MASK
+
+    # Worker whose query a reply answers
+    def owner(self, transaction_id):
+        return transaction_id & (MAX_WORKERS - 1)
+
+    # Pass a datagram received from `addr` to another worker
+    def forward(self, data, addr, worker):
+        family, packed = pack_peer(addr[0], addr[1])
+        self.channel.sendto(bytes((family,)) + packed + data, self.addresses[worker])
+
+    def broadcast(self, data, addr):
+        for worker in range(self.count):
+            if worker != self.index:
+                self.forward(data, addr, worker)
+
+    # Next datagram passed on by another worker and the address it came from
+    def receive(self):
+        data, _ = self.channel.recvfrom(RECEIVE_SIZE)
+        end = 1 + PEER_SIZES[data[0]]
+        return data[end:], unpack_peer(data[0], data[1:end])
+
+
+# Channels of `count` workers
+def open_channels(count):
+    channels = []
+    for _ in range(count):
+        channel = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        channel.bind(("127.0.0.1", 0))
+        channels.append(channel)
+    return channels
+
+
+# Runs `serve(group, *args)` in `count` processes forked from this one, so they inherit
+# what it prepared (open files, mappings, manifests). Returns the started processes
+def start_workers(count, serve, args=(), node_id=None):
+    if not 1 <= count <= MAX_WORKERS:
+        raise ValueError(f"Between 1 and {MAX_WORKERS} workers")
+    node_id = node_id or sha1(str(random()).encode()).digest()
+    channels = open_channels(count)
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=serve, args=(WorkerGroup(index, count, node_id, channels), *args), daemon=True)
+                 for index in range(count)]
+    for process in processes:
+        process.start()
+    return processes